@@ -0,0 +1,54 @@
+# Python 3.7
+# Author: Bofei Wang
+# Usage: python3 codec_benchmark.py [iterations]
+# coding: utf-8
+# this file compares the size and the encode and decode time of every codec
+# on the messages of the hot paths of the server
+
+import os
+import sys
+import time
+from typing import Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from Protocol import CODECS, Codec  # noqa: E402
+
+# messages the way the server and the client send them, by name
+SAMPLES: Dict[str, Dict] = {
+    'message request': {'action': 'message', 'message': 'hello there, how are you?', 'user': 'yoda'},
+    'message reply': {'action': 'message', 'status': 'SUCCESS'},
+    'receive_message': {'action': 'receive_message', 'from': 'hans', 'message': 'hello there, how are you?'},
+    'receive_broadcast 1KB': {'action': 'receive_broadcast', 'from': 'hans', 'message': 'b' * 1024},
+    'broadcast reply': {'action': 'broadcast', 'n_sent': 42, 'n_blocked': 3},
+    'whoelse reply': {'action': 'whoelse', 'reply': ['yoda', 'vader', 'luke', 'leia', 'han']},
+    'login request': {'action': 'login', 'username': 'hans', 'password': 'falcon', 'private_port': 54321,
+                      'codecs': ['binary', 'json']},
+}
+
+
+def measure(codec: Codec, message: Dict, iterations: int):
+    # return the payload size and the encode and decode time per message in microseconds
+    payload = codec.encode(message)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.encode(message)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(payload)
+    decode_time = time.perf_counter() - start
+    return len(payload), encode_time / iterations * 1e6, decode_time / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%-24s %-8s %8s %12s %12s' % ('message', 'codec', 'bytes', 'encode us', 'decode us'))
+    for name, message in SAMPLES.items():
+        for codec in CODECS.values():
+            size, encode_time, decode_time = measure(codec, message, iterations)
+            print('%-24s %-8s %8d %12.2f %12.2f' % (name, codec.name, size, encode_time, decode_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Python 3.7
+# Author: Bofei Wang
+# Usage: python3 compression_benchmark.py [iterations]
+# coding: utf-8
+# this file compares the bytes sent and the time spent compressing and decompressing
+# at every zlib level, for frames of the sizes the server sends
+# the bytes saved are worth the time when the link is slower than bytes saved / time spent,
+# the last column, in MB/s
+
+import os
+import random
+import sys
+import time
+import zlib
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from Protocol import BINARY, COMPRESSION_THRESHOLD, CompressedCodec, FrameDecoder, encode_message  # noqa: E402
+
+WORDS = ['hello', 'there', 'how', 'are', 'you', 'the', 'meeting', 'is', 'at', 'noon', 'see', 'you', 'later',
+         'did', 'anyone', 'read', 'the', 'notes', 'from', 'yesterday', 'lunch', 'sounds', 'good', 'to', 'me']
+
+LEVELS = [1, 3, 6, 9]
+
+
+def text(size: int) -> str:
+    # chat-like text of about size bytes, the same every run
+    words = random.Random(size)
+    out = []
+    length = 0
+    while length < size:
+        out.append(words.choice(WORDS))
+        length += len(out[-1]) + 1
+    return ' '.join(out)
+
+
+def receive_message(size: int) -> Dict:
+    return {'action': 'receive_message', 'from': 'hans', 'message': text(size)}
+
+
+# frames the way the server sends them, by name, each a list of frames sent together
+SAMPLES: Dict[str, List[bytes]] = {
+    'receive_message 40B': [encode_message(receive_message(40), BINARY)],
+    'receive_message 300B': [encode_message(receive_message(300), BINARY)],
+    'receive_broadcast 1KB': [encode_message({'action': 'receive_broadcast', 'from': 'hans',
+                                              'message': text(1024)}, BINARY)],
+    'receive_broadcast 10KB': [encode_message({'action': 'receive_broadcast', 'from': 'hans',
+                                               'message': text(10240)}, BINARY)],
+    'whoelse reply 200 users': [encode_message({'action': 'whoelse',
+                                                'reply': ['user%d' % i for i in range(200)]}, BINARY)],
+    'backlog 100 x 40B': [encode_message(receive_message(40 + i % 7), BINARY) for i in range(100)],
+}
+
+
+def measure(codec: CompressedCodec, frames: List[bytes], iterations: int):
+    # return the bytes sent and the compress and decompress time per send in microseconds
+    if len(frames) > 1:
+        data = codec.batch(frames)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            codec.batch(frames)
+    else:
+        payload = frames[0][4:]
+        data = codec.frame(payload)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            codec.frame(payload)
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations):
+        FrameDecoder().feed(data)
+    decompress_time = time.perf_counter() - start
+    return len(data), compress_time / iterations * 1e6, decompress_time / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('frames of %d bytes or more are compressed, zlib %s' % (COMPRESSION_THRESHOLD, zlib.ZLIB_VERSION))
+    print('%-24s %-5s %8s %8s %12s %12s %10s' % ('frames', 'level', 'bytes', 'sent', 'compress us',
+                                                 'decompress us', 'MB/s'))
+    for name, frames in SAMPLES.items():
+        size = sum(len(frame) for frame in frames)
+        for level in LEVELS:
+            sent, compress_time, decompress_time = measure(CompressedCodec(BINARY, level=level), frames,
+                                                           iterations)
+            # the link speed below which compressing is faster, the server compresses
+            # and the client decompresses
+            saved = size - sent
+            break_even = saved / (compress_time + decompress_time) if saved > 0 else 0.0
+            print('%-24s %-5d %8d %8d %12.2f %12.2f %10.1f' % (name, level, size, sent, compress_time,
+                                                               decompress_time, break_even))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# Python 3.7
+# Author: Bofei Wang
+# Usage: python3 load_generator.py [--users N] [--rate requests_per_second] [--duration seconds]
+#                                  [--mix message=70,broadcast=5,whoelse=20,startprivate=5,message_batch=0]
+#                                  [--batch-size n] [--message-size bytes] [--compression]
+#                                  [--codec binary|json] [--engine thread|asyncio] [--workers n] [--nodes n]
+#                                  [--port server_port --credentials credentials.txt]
+# coding: utf-8
+# this file drives a server with many headless clients and reports throughput and latency
+#
+# without --port a server is started in a temporary directory with N generated users,
+# or with --nodes a cluster of that many nodes on this host, the users spread over them,
+# with --port the users are read from a credentials.txt style file with plain passwords
+# requests are sent at the target rate whether or not earlier ones were answered, so a
+# slow server shows up as latency instead of a lower request rate
+# the bytes the users received are reported too, to compare runs with and without --compression
+
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+SERVER_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+sys.path.insert(0, SERVER_DIRECTORY)
+
+from CredentialStore import format_credential, hash_password  # noqa: E402
+from Protocol import CODECS, COMPRESSIONS, JSON, FrameDecoder, RECV_SIZE, decode_message, encode_message, \
+    with_compression  # noqa: E402
+
+# actions the load is made of, the ones a client waits for a reply to
+ACTIONS = ['message', 'broadcast', 'whoelse', 'startprivate', 'message_batch']
+
+# actions the server pushes to a client, not replies to a request
+PUSHED = ['receive_message', 'receive_broadcast', 'login_broadcast', 'logout_broadcast', 'timeout']
+
+
+class LatencyLog:
+    # latencies in seconds, by action
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+        # bytes read from the server by every user
+        self.bytes_received = 0
+
+    def add(self, action: str, latency: float):
+        self.latencies.setdefault(action, []).append(latency)
+
+    def report(self, elapsed: float):
+        print('%-14s %9s %10s %9s %9s %9s %9s' % ('action', 'count', 'per second', 'p50 ms', 'p99 ms', 'p999 ms',
+                                                 'max ms'))
+        for action in sorted(self.latencies):
+            latencies = sorted(self.latencies[action])
+            print('%-14s %9d %10.1f %9.2f %9.2f %9.2f %9.2f'
+                  % (action, len(latencies), len(latencies) / elapsed, percentile(latencies, 0.5) * 1e3,
+                     percentile(latencies, 0.99) * 1e3, percentile(latencies, 0.999) * 1e3, latencies[-1] * 1e3))
+        print('received %d bytes, %.1f KB per second' % (self.bytes_received, self.bytes_received / elapsed / 1024))
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    # the latency that fraction of sorted latencies is not above
+    return latencies[max(0, min(len(latencies) - 1, int(len(latencies) * fraction + 0.5) - 1))]
+
+
+class SyntheticUser:
+    # one headless client, requests are answered in the order they were sent
+
+    def __init__(self, username: str, password: str, log: LatencyLog, message_size: int = 0):
+        self.username = username
+        self.password = password
+        self.__log = log
+        # text after the time a message is sent at, making it about message_size bytes
+        self.__padding = ''.join(random.choice(' abcdefghijklmnopqrstuvwxyz') for _ in range(message_size - 28))
+        self.__codec = JSON
+        self.__decoder = FrameDecoder()
+        self.__reader = None
+        self.__writer = None
+        # (action, time sent) of every request not answered yet
+        self.__waiting: Deque[Tuple[str, float]] = deque()
+        self.unanswered = 0
+
+    async def log_in(self, host: str, port: int, codec: str, compression: bool):
+        self.__reader, self.__writer = await asyncio.open_connection(host, port)
+        sent = time.perf_counter()
+        self.__writer.write(encode_message({
+            'action': 'login',
+            'username': self.username,
+            'password': self.password,
+            'private_port': 0,
+            'codecs': [codec],
+            'compression': COMPRESSIONS if compression else []
+        }))
+        reply = decode_message((await self.__read_payloads())[0])
+        if reply.get('status') != 'SUCCESS':
+            raise RuntimeError(self.username + ' can not log in: ' + str(reply))
+        self.__log.add('login', time.perf_counter() - sent)
+        self.__codec = with_compression(CODECS[reply['codec']], reply.get('compression'))
+
+    def send(self, action: str, others: List[str]):
+        message = {'action': action}
+        if action == 'message':
+            message['user'] = random.choice(others)
+            message['message'] = self.__stamp()
+        elif action == 'message_batch':
+            message['messages'] = [[other, self.__stamp()] for other in others]
+        elif action == 'broadcast':
+            message['message'] = self.__stamp()
+        elif action == 'startprivate':
+            message['user'] = random.choice(others)
+        self.__waiting.append((action, time.perf_counter()))
+        self.__writer.write(encode_message(message, self.__codec))
+
+    def __stamp(self) -> str:
+        return 'sent at %.9f ' % time.perf_counter() + self.__padding
+
+    async def receive_forever(self):
+        while True:
+            for payload in await self.__read_payloads():
+                self.__handle(decode_message(payload, self.__codec))
+
+    def close(self):
+        self.unanswered = len(self.__waiting)
+        self.__writer.close()
+
+    def __handle(self, message: Dict):
+        now = time.perf_counter()
+        action = message.get('action')
+        if action in ['receive_message', 'receive_broadcast'] and message['message'].startswith('sent at '):
+            # the time it took from the sender to this user
+            self.__log.add('deliver_' + action[len('receive_'):], now - float(message['message'].split(' ')[2]))
+        elif action not in PUSHED and self.__waiting and self.__waiting[0][0] == action:
+            _, sent = self.__waiting.popleft()
+            self.__log.add(action, now - sent)
+
+    async def __read_payloads(self) -> List[bytes]:
+        while True:
+            data = await self.__reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError(self.username + ' was disconnected')
+            self.__log.bytes_received += len(data)
+            payloads = self.__decoder.feed(data)
+            if payloads:
+                return payloads
+
+
+def parse_mix(mix: str) -> Tuple[List[str], List[float]]:
+    # "message=70,whoelse=30" to (['message', 'whoelse'], [70.0, 30.0])
+    actions, weights = [], []
+    for part in mix.split(','):
+        action, weight = part.split('=')
+        if action not in ACTIONS:
+            raise ValueError("unknown action " + action)
+        actions.append(action)
+        weights.append(float(weight))
+    return actions, weights
+
+
+async def drive(users: List[SyntheticUser], args, actions: List[str], weights: List[float]):
+    # log every user in, then send requests at the target rate for the duration
+    for number, user in enumerate(users):
+        await user.log_in(args.host, args.ports[number % len(args.ports)], args.codec, args.compression)
+    receivers = [asyncio.ensure_future(user.receive_forever()) for user in users]
+    usernames = [user.username for user in users]
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= args.duration:
+            break
+        # catch up with the schedule, whatever the sleep overslept
+        due = int(elapsed * args.rate)
+        for action in random.choices(actions, weights, k=due - sent):
+            user = random.choice(users)
+            # a batch goes to batch size others, any other action picks one
+            n_others = min(args.batch_size, len(users) - 1) if action == 'message_batch' else 1
+            user.send(action, [username for username in random.sample(usernames, n_others + 1)
+                               if username != user.username][:n_others])
+        sent = due
+        await asyncio.sleep(0.001)
+    # let the last replies arrive
+    await asyncio.sleep(1.0)
+    for receiver in receivers:
+        receiver.cancel()
+    for user in users:
+        user.close()
+    print('sent %d requests in %.1f seconds, %d left unanswered'
+          % (sent, args.duration, sum(user.unanswered for user in users)))
+
+
+def write_fixture(directory: str, n_users: int, iterations: int) -> List[Tuple[str, str]]:
+    # write a credentials.txt of n_users generated users, return their (username, password)
+    # the passwords are hashed with few iterations, the load is not about the login
+    credentials = [('load%06d' % number, 'password%06d' % number) for number in range(n_users)]
+    with open(os.path.join(directory, 'credentials.txt'), 'w') as credential_file:
+        for username, password in credentials:
+            credential_file.write(username + ' ' + format_credential(hash_password(password, iterations=iterations))
+                                  + '\n')
+    return credentials
+
+
+def read_fixture(path: str, n_users: int) -> List[Tuple[str, str]]:
+    with open(path, 'r') as credential_file:
+        credentials = [tuple(line.split()) for line in credential_file if line.strip()]
+    return credentials[:n_users]
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(directory: str, args) -> List[subprocess.Popen]:
+    # start a server with its credentials, database and offline messages in directory
+    # with --nodes start that many nodes, each on a port of its own
+    command = [sys.executable, os.path.join(SERVER_DIRECTORY, 'server.py'), '', '10', '3600', '--engine', args.engine]
+    if args.nodes > 1:
+        args.ports = [free_port() for _ in range(args.nodes)]
+        nodes = ','.join('localhost:%d' % free_port() for _ in range(args.nodes))
+        commands = [command + ['--node', str(node), '--nodes', nodes] for node in range(args.nodes)]
+    else:
+        args.ports = [free_port()]
+        commands = [command + ['--workers', str(args.workers)]]
+    servers = []
+    for port, server_command in zip(args.ports, commands):
+        server_command[2] = str(port)
+        servers.append(subprocess.Popen(server_command, cwd=directory, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT))
+    for server, port in zip(servers, args.ports):
+        wait_for_server(server, args.host, port, servers)
+    return servers
+
+
+def wait_for_server(server: subprocess.Popen, host: str, port: int, servers: List[subprocess.Popen]):
+    for _ in range(100):
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    for other in servers:
+        other.kill()
+    raise RuntimeError("server did not start: " + server.stdout.read().decode())
+
+
+def stop_server(servers: List[subprocess.Popen]):
+    # ctrl+c the server, it prints its own time per action on the way out
+    for server in servers:
+        server.send_signal(signal.SIGINT)
+    for number, server in enumerate(servers):
+        try:
+            output, _ = server.communicate(timeout=5)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            output, _ = server.communicate()
+        print('server side:' if len(servers) == 1 else 'node %d side:' % number)
+        print(output.decode().strip())
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--users", type=int, default=100)
+    arg_parser.add_argument("--rate", type=float, default=1000, help="requests per second, over all users")
+    arg_parser.add_argument("--duration", type=float, default=10, help="seconds")
+    arg_parser.add_argument("--mix", default="message=70,broadcast=5,whoelse=20,startprivate=5")
+    arg_parser.add_argument("--batch-size", type=int, default=10, help="messages per message_batch request")
+    arg_parser.add_argument("--message-size", type=int, default=0, help="bytes of every message and broadcast")
+    arg_parser.add_argument("--codec", choices=list(CODECS), default="binary")
+    arg_parser.add_argument("--compression", action="store_true", help="ask the server for compression")
+    arg_parser.add_argument("--engine", choices=["thread", "asyncio"], default="asyncio")
+    arg_parser.add_argument("--workers", type=int, default=1, help="server processes sharing the port")
+    arg_parser.add_argument("--nodes", type=int, default=1, help="cluster nodes on this host, each on its own port")
+    arg_parser.add_argument("--hash-iterations", type=int, default=1000)
+    arg_parser.add_argument("--host", default="localhost")
+    arg_parser.add_argument("--port", type=int, help="use the server already running on this port")
+    arg_parser.add_argument("--credentials", help="users of the running server, with plain passwords")
+    args = arg_parser.parse_args()
+    try:
+        actions, weights = parse_mix(args.mix)
+    except ValueError as error:
+        arg_parser.error(str(error))
+    if args.users < 2:
+        arg_parser.error("at least 2 users are needed")
+    if args.nodes > 1 and args.workers > 1:
+        arg_parser.error("--workers and --nodes can not be used together")
+
+    with tempfile.TemporaryDirectory() as directory:
+        servers = []
+        if args.port is None:
+            credentials = write_fixture(directory, args.users, args.hash_iterations)
+            servers = start_server(directory, args)
+        else:
+            args.ports = [args.port]
+            credentials = read_fixture(args.credentials or os.path.join(SERVER_DIRECTORY, 'credentials.txt'),
+                                       args.users)
+        log = LatencyLog()
+        users = [SyntheticUser(username, password, log, args.message_size) for username, password in credentials]
+        try:
+            asyncio.get_event_loop().run_until_complete(drive(users, args, actions, weights))
+        finally:
+            if servers:
+                stop_server(servers)
+        log.report(args.duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Python 3.7
+# Author: Bofei Wang
+# Usage: python3 memory_benchmark.py [number_of_users]
+# coding: utf-8
+# this file reports the memory the UserManager uses per user, measured with tracemalloc
+# users are registered with hashed passwords, so no time is spent hashing
+
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from CredentialStore import format_credential, hash_password  # noqa: E402
+from UserManager import UserManager  # noqa: E402
+
+
+def allocated() -> int:
+    return tracemalloc.get_traced_memory()[0]
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    usernames = ['user%07d' % number for number in range(n_users)]
+    # the same hash for everyone, only the memory of the records matters here
+    password = format_credential(hash_password('password', iterations=1))
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        with open('credentials.txt', 'w') as credential_file:
+            credential_file.writelines(username + ' ' + password + '\n' for username in usernames)
+
+        tracemalloc.start()
+        start = allocated()
+        user_manager = UserManager(10, 60)
+        registered = allocated()
+        for username in usernames:
+            user_manager.authenticate(username, True)
+        logged_in = allocated()
+        # one user in ten blocks another one
+        for number in range(0, n_users, 10):
+            user_manager.block(usernames[number], usernames[(number + 1) % n_users])
+        blocking = allocated()
+        tracemalloc.stop()
+
+    print('users:', n_users)
+    print('registered, never logged in: %10d bytes in total' % (registered - start))
+    print('logged in:                   %10.1f bytes per user' % ((logged_in - registered) / n_users))
+    print('blocking one user:           %10.1f bytes per blocking user'
+          % ((blocking - logged_in) / len(range(0, n_users, 10))))
+
+
+if __name__ == '__main__':
+    main()
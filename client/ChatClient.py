@@ -0,0 +1,232 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the client library: a session with the server and its private
+# conversations, served by an EventLoop, see EventLoop.py
+# a process runs any number of sessions on one loop, e.g. bots:
+#     loop = EventLoop()
+#     for username, password in bots:
+#         ChatClient(loop, ('localhost', 12346), dispatcher).login(username, password)
+#     loop.run_forever()
+# every message from the server is handed to dispatcher, and every private message to
+# peer_dispatcher, as handle(data, client), on the thread of the loop
+# a session acknowledges the messages it reads, and if its connection to the server drops
+# it reconnects and resumes, getting the messages it did not read, see server/Session.py
+
+from socket import socket, AF_INET, SOCK_STREAM
+from typing import Callable, Dict, List, Optional, Tuple
+from Dispatcher import Dispatcher, InvalidMessage
+from EventLoop import Channel, EventLoop
+from PeerPool import PeerPool
+from Protocol import CODECS, COMPRESSIONS, JSON, decode_message, encode_message, with_compression
+
+# pending private connections the kernel queues for a session to accept
+PRIVATE_BACKLOG = 16
+
+# seconds to wait before acknowledging the messages read, one ack covers all of them
+ACK_DELAY = 0.1
+
+# acknowledge right away once this many messages are not acknowledged, well within the
+# messages the server keeps for a session
+ACK_WINDOW = 64
+
+# tries to resume after the connection to the server dropped, the first after RESUME_DELAY
+# seconds, each one waiting twice as long as the one before
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 0.5
+
+
+class ChatClient:
+    # one session with the server
+    # without a peer_dispatcher the session has no private port and can not be messaged privately
+    # on_close(client) is called if the server closes the connection, with logged_in still telling
+    # whether the session had logged in, and on_invalid(data, client)
+    # with a message whose handler does not accept it
+    # with compress, large frames from and to the server are compressed if the server can
+    # with acks, the session acknowledges what it reads and resumes if its connection drops,
+    # on_close is only called once it can not
+    # every method is called on the thread of the loop
+
+    def __init__(self, loop: EventLoop, server_address: Tuple[str, int], dispatcher: Dispatcher,
+                 peer_dispatcher: Optional[Dispatcher] = None,
+                 on_close: Optional[Callable[['ChatClient'], None]] = None,
+                 on_invalid: Optional[Callable[[Dict, 'ChatClient'], None]] = None,
+                 codecs: Optional[List[str]] = None, compress: bool = True, acks: bool = True):
+        self.loop = loop
+        self.username = ''
+        self.logged_in = False
+        # the token resuming the session on the server, None without one
+        self.token: Optional[str] = None
+        # the number of the last message read, and of the last one acknowledged
+        self.seq = 0
+        self.__acked = 0
+        self.__ack_timer = None
+        # the codec of the connection to the server, json until the server picks another at login
+        self.codec = JSON
+        self.__dispatcher = dispatcher
+        self.__peer_dispatcher = peer_dispatcher
+        self.__on_close = on_close
+        self.__on_invalid = on_invalid
+        self.__codecs = list(CODECS) if codecs is None else codecs
+        self.__compressions = list(COMPRESSIONS) if compress else []
+        self.__acks = acks
+        self.__server_address = server_address
+        # resuming: frames sent meanwhile wait for the session to be back
+        self.__resuming = False
+        self.__attempts = 0
+        self.__closing = False
+        self.__channel = Channel.connect(loop, server_address, self.__received, self.__closed)
+        # frames sent in this pass of the loop, written together at its end
+        self.__outbound: List[bytes] = []
+        self.__flush_timer = None
+        self.peers: Optional[PeerPool] = None
+        self.private_port = 0
+        if peer_dispatcher is not None:
+            listener = socket(AF_INET, SOCK_STREAM)
+            listener.bind(('localhost', 0))
+            listener.listen(PRIVATE_BACKLOG)
+            self.private_port = listener.getsockname()[1]
+            self.peers = PeerPool(loop, listener, self.__peer_received, self.__peer_lost)
+
+    def login(self, username: str, password: str):
+        # the reply is handed to the dispatcher like any other message
+        self.username = username
+        self.__outbound.append(encode_message({
+            "action": "login",
+            "username": username,
+            "password": password,
+            "private_port": self.private_port,
+            "codecs": self.__codecs,
+            "compression": self.__compressions,
+            "acks": self.__acks
+        }))
+        self.flush()
+
+    def send(self, message: Dict):
+        # send a message to the server with the codec of the connection
+        # every message sent in one pass of the loop, e.g. by one handler, goes out in one write
+        self.__outbound.append(encode_message(message, self.codec))
+        if self.__flush_timer is None:
+            self.__flush_timer = self.loop.call_later(0, self.flush)
+
+    def message_batch(self, messages: List[Tuple[str, str]]):
+        # send messages, (user, message) each, as one request with one reply
+        self.send({'action': 'message_batch', 'messages': [list(message) for message in messages]})
+
+    def flush(self):
+        # write the messages sent so far now
+        if self.__flush_timer is not None:
+            EventLoop.cancel(self.__flush_timer)
+            self.__flush_timer = None
+        if self.__outbound and not self.__resuming:
+            self.__channel.write(b''.join(self.__outbound))
+            self.__outbound.clear()
+
+    def start_private(self, username: str, address: Tuple[str, int]):
+        # start a conversation with username, at the address the server gave for startprivate
+        self.peers.open(username, address)
+
+    def stop_private(self, username: str) -> bool:
+        # end the conversation with username, return False if there was none
+        return self.peers is not None and self.peers.close(username, self.username)
+
+    def private_message(self, username: str, message: str) -> bool:
+        # send a private message, return False if there is no conversation with username
+        return self.peers is not None and self.peers.send(username, self.username, message)
+
+    def close(self):
+        # close every connection of the session, sending what is queued first
+        self.__closing = True
+        if self.__ack_timer is not None:
+            EventLoop.cancel(self.__ack_timer)
+        if self.peers is not None:
+            self.peers.close_all()
+        self.flush()
+        self.__channel.close(flush=True)
+
+    def __received(self, payload: bytes):
+        data = decode_message(payload, self.codec)
+        action = data.get('action')
+        if action in ['login', 'resume'] and data.get('status') == 'SUCCESS':
+            # everything after the reply uses the codec and compression picked by the server
+            self.logged_in = True
+            self.codec = with_compression(CODECS.get(data.get('codec'), JSON), data.get('compression'))
+            self.token = data.get('token')
+            if action == 'resume':
+                self.__resuming = False
+                self.__attempts = 0
+                self.flush()
+        elif action == 'resume':
+            # the session is over, e.g. timed out meanwhile
+            self.token = None
+            self.__dispatch(self.__dispatcher, data)
+            self.__channel.close()
+            self.__closed(None)
+            return
+        elif action in ['logout', 'timeout']:
+            self.token = None
+        if 'seq' in data:
+            if data['seq'] <= self.seq:
+                # read before, sent again
+                return
+            self.seq = data['seq']
+            self.__ack_soon()
+        self.__dispatch(self.__dispatcher, data)
+
+    def __ack_soon(self):
+        if self.seq - self.__acked >= ACK_WINDOW:
+            self.__ack()
+        elif self.__ack_timer is None:
+            self.__ack_timer = self.loop.call_later(ACK_DELAY, self.__ack)
+
+    def __ack(self):
+        if self.__ack_timer is not None:
+            EventLoop.cancel(self.__ack_timer)
+            self.__ack_timer = None
+        if self.seq > self.__acked and not self.__resuming:
+            self.__acked = self.seq
+            self.send({'action': 'ack', 'seq': self.seq})
+
+    def __resume(self):
+        # a new connection carrying on the session, see __closed
+        self.codec = JSON
+        self.__acked = self.seq
+        self.__channel = Channel.connect(self.loop, self.__server_address, self.__received, self.__closed)
+        self.__channel.write(encode_message({
+            "action": "resume",
+            "username": self.username,
+            "token": self.token,
+            "seq": self.seq,
+            "codecs": self.__codecs,
+            "compression": self.__compressions
+        }))
+
+    def __peer_received(self, data: Dict):
+        self.__dispatch(self.__peer_dispatcher, data)
+
+    def __peer_lost(self, username: str):
+        # told like a message, so the peer dispatcher handles every private event
+        self.__dispatch(self.__peer_dispatcher, {'action': 'lost', 'from': username})
+
+    def __dispatch(self, dispatcher: Dispatcher, data: Dict):
+        try:
+            dispatcher.dispatch(data, self)
+        except InvalidMessage:
+            # a known action in an unexpected format
+            if self.__on_invalid is not None:
+                self.__on_invalid(data, self)
+
+    def __closed(self, error: Optional[Exception]):
+        # logged_in stays as it was until on_close is called, which tells by it whether the
+        # session was closed before or after it logged in
+        if self.token is not None and not self.__closing and self.__attempts < RESUME_ATTEMPTS:
+            # try to resume the session on a new connection, the private ones stay open
+            self.__resuming = True
+            self.loop.call_later(RESUME_DELAY * 2 ** self.__attempts, self.__resume)
+            self.__attempts += 1
+            return
+        if self.peers is not None:
+            self.peers.close_all()
+        if self.__on_close is not None:
+            self.__on_close(self)
+        self.logged_in = False
@@ -0,0 +1,141 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the table of action handlers shared by the server and the client
+# client/Dispatcher.py is a copy of this file, keep the two in sync
+
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional
+
+
+class InvalidMessage(Exception):
+    # raised when a message has no handler or does not match the schema of its handler
+    pass
+
+
+class Deferred:
+    # returned by a handler that has to wait for work done elsewhere, e.g. by a worker pool
+    # the caller of the handler calls resume() once future is done, on its own thread,
+    # and every step is called with the result of future, in order
+
+    def __init__(self, future: Future, finish: Callable[[Any], Any]):
+        self.future = future
+        self.__steps = [finish]
+
+    def then(self, step: Callable[[Any], Any]) -> 'Deferred':
+        # call step(result) after the steps added so far
+        self.__steps.append(step)
+        return self
+
+    def resume(self):
+        # wait for future if it is not done yet and run the steps
+        result = self.future.result()
+        for step in self.__steps:
+            step(result)
+
+
+class ActionTiming:
+    # how often an action was handled and how long that took, in seconds
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Dispatcher:
+    # route every message to the handler registered for its action
+    # a handler declares
+    # - schema: the fields it reads and their types, checked before it is called
+    # - lock: the field naming the user whose lock it runs under, if any
+    # a handler that has to wait returns a Deferred, and must not hold a lock meanwhile
+    # finding a handler is one dict lookup, however many actions there are
+
+    def __init__(self, lock_for: Optional[Callable[[str], Any]] = None):
+        # lock_for(name) returns the lock a handler with a lock field runs under
+        self.__lock_for = lock_for
+        self.__handlers: Dict[str, Dispatcher.__Handler] = dict()
+        self.__fallback: Optional[Callable] = None
+
+    def register(self, action: str, schema: Optional[Dict[str, Any]] = None, lock: Optional[str] = None):
+        # decorator registering handle(message, *args) for action
+        # schema maps a field to its type, or to a tuple of accepted types
+        def decorator(handle: Callable) -> Callable:
+            if lock is not None and self.__lock_for is None:
+                raise ValueError("action " + action + " needs a lock but the dispatcher has none")
+            self.__handlers[action] = Dispatcher.__Handler(handle, schema or dict(), lock)
+            return handle
+
+        return decorator
+
+    def fallback(self, handle: Callable) -> Callable:
+        # decorator registering handle(message, *args) for actions without a handler
+        self.__fallback = handle
+        return handle
+
+    def actions(self) -> list:
+        return list(self.__handlers)
+
+    def dispatch(self, message: Dict, *args):
+        # call the handler of the action of message with message and args
+        # return what the handler returns
+        handler = self.__handlers.get(message.get('action'))
+        if handler is None:
+            if self.__fallback is None:
+                raise InvalidMessage("no handler for action " + str(message.get('action')))
+            return self.__fallback(message, *args)
+        handler.check(message)
+        start = perf_counter()
+        try:
+            if handler.lock is None:
+                return handler.handle(message, *args)
+            with self.__lock_for(message[handler.lock]):
+                return handler.handle(message, *args)
+        finally:
+            handler.record(perf_counter() - start)
+
+    def timings(self) -> Dict[str, ActionTiming]:
+        # a copy of the timing of every action handled at least once
+        timings = dict()
+        for action, handler in self.__handlers.items():
+            timing = handler.timing()
+            if timing.count:
+                timings[action] = timing
+        return timings
+
+    class __Handler:
+        # a registered handler with its schema, lock field and timing
+
+        def __init__(self, handle: Callable, schema: Dict[str, Any], lock: Optional[str]):
+            self.handle = handle
+            self.lock = lock
+            self.__schema = schema
+            self.__timing = ActionTiming()
+            self.__timing_lock = threading.Lock()
+
+        def check(self, message: Dict):
+            for field, field_type in self.__schema.items():
+                if field not in message:
+                    raise InvalidMessage("field " + field + " is missing")
+                if not isinstance(message[field], field_type):
+                    raise InvalidMessage("field " + field + " has the wrong type")
+
+        def record(self, duration: float):
+            with self.__timing_lock:
+                self.__timing.count += 1
+                self.__timing.total += duration
+                if duration > self.__timing.max:
+                    self.__timing.max = duration
+
+        def timing(self) -> ActionTiming:
+            with self.__timing_lock:
+                timing = ActionTiming()
+                timing.count = self.__timing.count
+                timing.total = self.__timing.total
+                timing.max = self.__timing.max
+                return timing
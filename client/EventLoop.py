@@ -0,0 +1,260 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the event loop of the client
+# one selector serves every socket of every session in the process, and stdin for the
+# interactive client, so a session costs its sockets and no thread
+# everything runs on the thread of the loop, other threads hand work over with
+# call_soon_threadsafe
+
+import errno
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+from Protocol import FrameDecoder, FrameError, RECV_SIZE
+
+
+class EventLoop:
+    # readiness callbacks, timers and callbacks from other threads
+
+    def __init__(self):
+        self.running = False
+        self.__selector = selectors.DefaultSelector()
+        # [when, sequence, callback] of every timer, the callback is None once cancelled
+        self.__timers: List[list] = []
+        self.__sequence = itertools.count()
+        self.__ready = deque()
+        self.__ready_lock = threading.Lock()
+        self.__wakeup, self.__waker = socket.socketpair()
+        self.__wakeup.setblocking(False)
+        self.__waker.setblocking(False)
+        self.watch(self.__wakeup, selectors.EVENT_READ, self.__drain_wakeup)
+
+    def watch(self, fileobj, events: int, callback: Callable[[int], None]):
+        # call callback(ready events) whenever fileobj is ready for any of events
+        # watching a file object again replaces its events and callback
+        try:
+            self.__selector.modify(fileobj, events, callback)
+        except KeyError:
+            self.__selector.register(fileobj, events, callback)
+
+    def unwatch(self, fileobj):
+        try:
+            self.__selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> list:
+        # call callback in delay seconds, return a timer for cancel
+        timer = [time.monotonic() + delay, next(self.__sequence), callback]
+        heapq.heappush(self.__timers, timer)
+        return timer
+
+    @staticmethod
+    def time() -> float:
+        # the clock of the timers
+        return time.monotonic()
+
+    @staticmethod
+    def cancel(timer: list):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback: Callable[[], None]):
+        # call callback on the thread of the loop, from any thread
+        with self.__ready_lock:
+            self.__ready.append(callback)
+        try:
+            self.__waker.send(b'\0')
+        except BlockingIOError:
+            # the loop has plenty of wake ups queued already
+            pass
+
+    def run_forever(self):
+        # serve until stop is called
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+    def run_once(self):
+        # wait until something is ready or the next timer is due, and serve it
+        timeout = None
+        if self.__timers:
+            timeout = max(0.0, self.__timers[0][0] - time.monotonic())
+        for key, events in self.__selector.select(timeout):
+            key.data(events)
+        now = time.monotonic()
+        while self.__timers and self.__timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.__timers)
+            if callback is not None:
+                callback()
+
+    def __drain_wakeup(self, _):
+        try:
+            while self.__wakeup.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        with self.__ready_lock:
+            ready, self.__ready = self.__ready, deque()
+        for callback in ready:
+            callback()
+
+
+class Channel:
+    # a non-blocking connection carrying frames, served by an EventLoop
+    # on_payload(payload) is called with every frame received, on_close(error) once when
+    # the connection ends, error is None if the other side closed it
+    # frames written before the connection is established, or while the kernel does not
+    # take them, are queued
+    # every write is whole frames, so the writes not sent in full can be taken back whole and
+    # sent on another connection
+
+    def __init__(self, loop: EventLoop, channel_socket: socket.socket, on_payload: Callable[[bytes], None],
+                 on_close: Callable[[Optional[Exception]], None], connected: bool = True):
+        self.closed = False
+        self.last_active = time.monotonic()
+        self.__loop = loop
+        self.__socket = channel_socket
+        self.__on_payload = on_payload
+        self.__on_close = on_close
+        # False until a connection started with connect is established
+        self.connected = connected
+        self.__decoder = FrameDecoder()
+        # the writes not sent in full, the first one from __offset on
+        self.__outbound = bytearray()
+        self.__write_sizes: Deque[int] = deque()
+        self.__offset = 0
+        # the events the loop watches for, EVENT_WRITE only while something is queued
+        self.__events = 0
+        channel_socket.setblocking(False)
+        self.__watch()
+
+    @classmethod
+    def connect(cls, loop: EventLoop, address: Tuple[str, int], on_payload: Callable[[bytes], None],
+                on_close: Callable[[Optional[Exception]], None]) -> 'Channel':
+        # start connecting to address, a failure is reported to on_close
+        channel_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        channel_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channel_socket.setblocking(False)
+        code = channel_socket.connect_ex(address)
+        channel = cls(loop, channel_socket, on_payload, on_close, connected=code == 0)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            # e.g. no route, reported like a connection refused later on
+            error = ConnectionError(code, 'can not connect to %s:%d' % address)
+            loop.call_later(0, lambda: channel.__fail(error))
+        return channel
+
+    def write(self, data: bytes):
+        # send data, whatever the kernel does not take now is sent when it can
+        if self.closed:
+            return
+        self.last_active = time.monotonic()
+        was_empty = not self.__outbound
+        self.__outbound += data
+        self.__write_sizes.append(len(data))
+        if self.connected and was_empty:
+            self.__flush()
+
+    def queued(self) -> int:
+        # bytes written but not taken by the kernel yet
+        return len(self.__outbound) - self.__offset
+
+    def take_queued(self) -> bytes:
+        # the writes not sent in full, whole, no longer sent by this channel
+        # a write the kernel took a part of is in there from its start, the other side
+        # can not have read it
+        data, self.__outbound = bytes(self.__outbound), bytearray()
+        self.__write_sizes.clear()
+        self.__offset = 0
+        return data
+
+    def close(self, flush: bool = False):
+        # close without calling on_close, with flush send what is queued first, blocking
+        if self.closed:
+            return
+        self.closed = True
+        self.__loop.unwatch(self.__socket)
+        if flush and self.connected and self.queued():
+            try:
+                self.__socket.setblocking(True)
+                self.__socket.sendall(self.__outbound[self.__offset:])
+            except OSError:
+                pass
+        self.__socket.close()
+
+    def getsockname(self):
+        return self.__socket.getsockname()
+
+    def __watch(self):
+        events = selectors.EVENT_READ
+        if not self.connected or self.__outbound:
+            events |= selectors.EVENT_WRITE
+        if events != self.__events:
+            self.__events = events
+            self.__loop.watch(self.__socket, events, self.__ready)
+
+    def __ready(self, events: int):
+        if events & selectors.EVENT_WRITE:
+            if not self.connected:
+                code = self.__socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code:
+                    self.__fail(ConnectionError(code, 'can not connect'))
+                    return
+                self.connected = True
+            self.__flush()
+        if events & selectors.EVENT_READ and not self.closed:
+            self.__read()
+
+    def __read(self):
+        try:
+            data = self.__socket.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as error:
+            self.__fail(error)
+            return
+        if not data:
+            self.__fail(None)
+            return
+        self.last_active = time.monotonic()
+        try:
+            payloads = self.__decoder.feed(data)
+        except FrameError as error:
+            # the stream can not be split into frames any more
+            self.__fail(error)
+            return
+        for payload in payloads:
+            self.__on_payload(payload)
+            if self.closed:
+                return
+
+    def __flush(self):
+        try:
+            with memoryview(self.__outbound) as outbound, outbound[self.__offset:] as unsent:
+                sent = self.__socket.send(unsent)
+        except BlockingIOError:
+            sent = 0
+        except OSError as error:
+            self.__fail(error)
+            return
+        # drop the writes sent in full, keep the one the kernel took a part of
+        self.__offset += sent
+        done = 0
+        while self.__write_sizes and self.__offset - done >= self.__write_sizes[0]:
+            done += self.__write_sizes.popleft()
+        if done:
+            del self.__outbound[:done]
+            self.__offset -= done
+        self.__watch()
+
+    def __fail(self, error: Optional[Exception]):
+        self.close()
+        self.__on_close(error)
@@ -0,0 +1,173 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the private connections of a client to other clients
+# there is at most one connection to a client, whichever side opened it, and every private
+# conversation with that client goes over it, each frame naming its sender and receiver
+# the connections are served by the event loop of the client, see EventLoop.py, and the
+# ones idle for IDLE_TIMEOUT are closed
+# a conversation outlives its connection: a message to a peer whose connection was closed,
+# by either side, opens a new one
+
+import functools
+import selectors
+import socket
+from typing import Callable, Dict, Optional, Set, Tuple
+from EventLoop import Channel, EventLoop
+from Protocol import FrameError, decode_message, encode_message
+
+# seconds without a frame either way before a connection is closed
+IDLE_TIMEOUT = 300.0
+
+# the private port of a client: (host, port)
+Address = Tuple[str, int]
+
+
+class PeerLink:
+    # one connection to another client
+
+    def __init__(self, address: Optional[Address], host: str):
+        # the private port of the peer, None until an accepted connection says hello
+        self.address = address
+        self.host = host
+        self.channel: Optional[Channel] = None
+        # opened again after the connection before it failed with frames queued
+        self.retry = False
+
+
+class PeerPool:
+    # the private connections and conversations of a session
+    # on_message(data) is called with every frame another client sends, but hellos, and
+    # on_lost(username) when a conversation ends because the peer can not be reached
+    # every method is called on the thread of the loop
+
+    def __init__(self, loop: EventLoop, listener: socket.socket, on_message: Callable[[Dict], None],
+                 on_lost: Callable[[str], None], idle_timeout: float = IDLE_TIMEOUT):
+        self.__loop = loop
+        self.__listener = listener
+        self.__port = listener.getsockname()[1]
+        self.__on_message = on_message
+        self.__on_lost = on_lost
+        self.__idle_timeout = idle_timeout
+        # private port of a peer to the connection to it
+        self.__links: Dict[Address, PeerLink] = dict()
+        # every open connection, with the ones that did not say hello yet
+        self.__open_links: Set[PeerLink] = set()
+        # username of a peer to its private port, one per conversation started
+        self.__peers: Dict[str, Address] = dict()
+        listener.setblocking(False)
+        loop.watch(listener, selectors.EVENT_READ, self.__accept)
+        self.__eviction = loop.call_later(idle_timeout / 10, self.__evict_idle)
+
+    def open(self, username: str, address: Address):
+        # start a conversation with username, reusing the connection to address if there is one
+        self.__peers[username] = address
+        if address not in self.__links:
+            self.__connect(address)
+
+    def close(self, username: str, from_user: str) -> bool:
+        # end the conversation with username, return False if there was none
+        # the connection stays open for other conversations, or until it is idle
+        address = self.__peers.pop(username, None)
+        if address is None:
+            return False
+        link = self.__links.get(address)
+        if link is not None:
+            link.channel.write(encode_message({'action': 'stop', 'from': from_user, 'to': username}))
+        return True
+
+    def is_open(self, username: str) -> bool:
+        return username in self.__peers
+
+    def send(self, username: str, from_user: str, message: str) -> bool:
+        # send a private message, return False if there is no conversation with username
+        address = self.__peers.get(username)
+        if address is None:
+            return False
+        link = self.__links.get(address) or self.__connect(address)
+        link.channel.write(encode_message({'action': 'private', 'from': from_user, 'to': username,
+                                           'message': message}))
+        return True
+
+    def close_all(self):
+        # close every connection, sending what is queued first
+        EventLoop.cancel(self.__eviction)
+        self.__loop.unwatch(self.__listener)
+        for link in list(self.__open_links):
+            link.channel.close(flush=True)
+        self.__open_links.clear()
+        self.__links.clear()
+
+    def __connect(self, address: Address) -> PeerLink:
+        link = PeerLink(address, address[0])
+        link.channel = Channel.connect(self.__loop, address, functools.partial(self.__received, link),
+                                       functools.partial(self.__closed, link))
+        # tell the peer where this client listens, so it can reuse the connection
+        link.channel.write(encode_message({'action': 'hello', 'port': self.__port}))
+        self.__links[address] = link
+        self.__open_links.add(link)
+        return link
+
+    def __accept(self, _):
+        try:
+            peer_socket, (host, _) = self.__listener.accept()
+        except BlockingIOError:
+            return
+        peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = PeerLink(None, host)
+        link.channel = Channel(self.__loop, peer_socket, functools.partial(self.__received, link),
+                               functools.partial(self.__closed, link))
+        self.__open_links.add(link)
+
+    def __received(self, link: PeerLink, payload: bytes):
+        try:
+            data = decode_message(payload)
+            if not isinstance(data, dict):
+                raise ValueError('not a message')
+            # clients without the pool send bare {'from': ..., 'message': ...} frames
+            data.setdefault('action', 'private')
+            if data['action'] == 'hello':
+                address = (link.host, int(data['port']))
+        except (FrameError, ValueError, KeyError, TypeError):
+            # not from a client, anyone may connect to the private port, only this
+            # connection is closed
+            link.channel.close()
+            self.__forget(link)
+            return
+        if data['action'] == 'hello':
+            link.address = address
+            # both sides may have connected at once, then either connection works
+            self.__links.setdefault(link.address, link)
+        else:
+            self.__on_message(data)
+
+    def __closed(self, link: PeerLink, error: Optional[Exception]):
+        # closed by the peer, or failed, a later message opens a new connection
+        self.__forget(link)
+        unsent = link.channel.take_queued()
+        if not unsent or link.address is None or link.address not in self.__peers.values():
+            return
+        if link.retry and not link.channel.connected:
+            # the peer is gone
+            for username, address in list(self.__peers.items()):
+                if address == link.address:
+                    del self.__peers[username]
+                    self.__on_lost(username)
+            return
+        # send what did not get through once more on a new connection
+        retry = self.__connect(link.address)
+        retry.retry = True
+        retry.channel.write(unsent)
+
+    def __evict_idle(self):
+        idle_since = self.__loop.time() - self.__idle_timeout
+        for link in list(self.__open_links):
+            if link.channel.last_active < idle_since:
+                link.channel.close()
+                self.__forget(link)
+        self.__eviction = self.__loop.call_later(self.__idle_timeout / 10, self.__evict_idle)
+
+    def __forget(self, link: PeerLink):
+        self.__open_links.discard(link)
+        if link.address is not None and self.__links.get(link.address) is link:
+            del self.__links[link.address]
@@ -0,0 +1,442 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the wire protocol shared by the server and the client
+# client/Protocol.py is a copy of this file, keep the two in sync
+
+import json
+import struct
+import zlib
+from typing import Dict, List, Optional
+
+# every frame is a 4 bytes big endian payload length followed by the payload
+HEADER = struct.Struct('!I')
+
+# a frame larger than this means the stream is corrupted
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# flags in the top bits of the length, only sent to a client that asked for compression
+# COMPRESSED: the payload is zlib compressed
+# BATCH: the payload is more frames, e.g. a backlog of offline messages, sent as one
+COMPRESSED = 0x80000000
+BATCH = 0x40000000
+LENGTH_MASK = 0x3FFFFFFF
+
+# compressions by name, in the order a client prefers them
+COMPRESSIONS = ['zlib']
+
+# payloads shorter than this are sent as they are, compressing them saves little
+COMPRESSION_THRESHOLD = 256
+
+# zlib level, the fastest: it sends a few percent more bytes than 6 and compresses a 10KB
+# broadcast about 5 times faster, see benchmark/compression_benchmark.py
+COMPRESSION_LEVEL = 1
+
+# bytes to ask for in a single recv, one read may carry many frames
+RECV_SIZE = 65536
+
+
+class FrameError(Exception):
+    # raised when the byte stream can not be split into frames
+    pass
+
+
+def encode_frame(payload: bytes, flags: int = 0) -> bytes:
+    # prefix a payload with its length and flags
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError("frame of " + str(len(payload)) + " bytes is too large")
+    return HEADER.pack(len(payload) | flags) + payload
+
+
+# action names in the order of their one byte codes in the binary codec
+# codes are part of the wire format, only ever append to this list
+ACTIONS = ['login', 'logout', 'message', 'broadcast', 'block', 'unblock', 'whoelse', 'whoelsesince',
+           'startprivate', 'receive_message', 'receive_broadcast', 'login_broadcast', 'logout_broadcast',
+           'timeout', 'message_batch', 'history', 'ack', 'resume']
+
+# keys with a one byte code in the binary codec, other keys are sent as strings
+# only ever append to this list
+KEYS = ['action', 'username', 'password', 'private_port', 'status', 'reply', 'user', 'message', 'from',
+        'n_sent', 'n_blocked', 'since', 'address', 'port', 'codecs', 'codec', 'messages', 'failed',
+        'compression', 'cursor', 'limit', 'seq', 'token', 'acks', 'missed']
+
+# the usual shapes of a message, by action, for the binary codec
+# a message of one of these shapes with only string values is sent as its values in
+# this order, without keys or types, that is every message on the hot paths
+# only ever append to these lists
+LAYOUTS = {
+    'message': [('user', 'message'), ('status',)],
+    'broadcast': [('message',)],
+    'block': [('user',), ('status',)],
+    'unblock': [('user',), ('status',)],
+    'startprivate': [('user',)],
+    'receive_message': [('from', 'message')],
+    'receive_broadcast': [('from', 'message')],
+    'login_broadcast': [('from', 'message')],
+    'logout_broadcast': [('from', 'message')],
+}
+
+# a byte that is not the code of an action or a key, the name follows as a string
+UNKNOWN_CODE = 0xFF
+
+# value types of the binary codec
+STRING, INTEGER, LIST, TRUE, FALSE, NONE, FLOAT, DICT = range(8)
+
+FLOAT_FORMAT = struct.Struct('!d')
+
+
+class Codec:
+    # turns a message into the payload of a frame and back
+    name = ''
+    # the compression of the frames, see CompressedCodec
+    compression: Optional[str] = None
+
+    def encode(self, message: Dict) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, payload: bytes) -> Dict:
+        raise NotImplementedError
+
+    def frame(self, payload: bytes) -> bytes:
+        # the frame carrying payload
+        return encode_frame(payload)
+
+    def batch(self, frames: List[bytes]) -> bytes:
+        # the bytes sending frames together
+        return b''.join(frames)
+
+
+class JsonCodec(Codec):
+    # a message is a json object, always understood by both sides
+    name = 'json'
+
+    def encode(self, message: Dict) -> bytes:
+        return json.dumps(message).encode()
+
+    def decode(self, payload: bytes) -> Dict:
+        return json.loads(payload.decode())
+
+
+class BinaryCodec(Codec):
+    # a compact encoding of the same messages
+    # a payload is the action code, then the layout:
+    #   1 and up: the values of LAYOUTS[action][layout - 1], each a varint length and utf-8
+    #   0: a varint number of fields, each a key code and a typed value
+    # strings are a varint length and utf-8, integers are zigzag varints
+
+    name = 'binary'
+
+    def __init__(self):
+        self.__action_codes = {action: code for code, action in enumerate(ACTIONS)}
+        self.__key_codes = {key: code for code, key in enumerate(KEYS)}
+
+    def encode(self, message: Dict) -> bytes:
+        action = message.get('action')
+        code = self.__action_codes.get(action, UNKNOWN_CODE)
+        if code != UNKNOWN_CODE:
+            for layout, keys in enumerate(LAYOUTS.get(action, ()), 1):
+                if len(message) == len(keys) + 1 and all(type(message.get(key)) is str for key in keys):
+                    out = bytearray((code, layout))
+                    for key in keys:
+                        write_string(out, message[key])
+                    return bytes(out)
+        out = bytearray((code, 0))
+        fields = [(key, value) for key, value in message.items() if key != 'action' or code == UNKNOWN_CODE]
+        write_varint(out, len(fields))
+        for key, value in fields:
+            self.__write_key(out, key)
+            self.__write_value(out, value)
+        return bytes(out)
+
+    def decode(self, payload: bytes) -> Dict:
+        try:
+            code, layout = payload[0], payload[1]
+            message = dict()
+            if code != UNKNOWN_CODE:
+                message['action'] = ACTIONS[code]
+            offset = 2
+            if layout:
+                for key in LAYOUTS[ACTIONS[code]][layout - 1]:
+                    message[key], offset = read_string(payload, offset)
+            else:
+                n_fields, offset = read_varint(payload, offset)
+                for _ in range(n_fields):
+                    key, offset = self.__read_key(payload, offset)
+                    message[key], offset = self.__read_value(payload, offset)
+        except (IndexError, KeyError, UnicodeDecodeError) as error:
+            raise FrameError("malformed binary payload: " + repr(error))
+        if offset != len(payload):
+            raise FrameError("malformed binary payload: trailing bytes")
+        return message
+
+    def __write_key(self, out: bytearray, key: str):
+        code = self.__key_codes.get(key)
+        if code is None:
+            out.append(UNKNOWN_CODE)
+            write_string(out, key)
+        else:
+            out.append(code)
+
+    def __read_key(self, payload: bytes, offset: int):
+        code = payload[offset]
+        if code == UNKNOWN_CODE:
+            return read_string(payload, offset + 1)
+        return KEYS[code], offset + 1
+
+    def __write_value(self, out: bytearray, value):
+        # bool before int, a bool is an int too
+        if isinstance(value, str):
+            out.append(STRING)
+            write_string(out, value)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif value is None:
+            out.append(NONE)
+        elif isinstance(value, int):
+            out.append(INTEGER)
+            write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            out.append(FLOAT)
+            out += FLOAT_FORMAT.pack(value)
+        elif isinstance(value, (list, tuple)):
+            out.append(LIST)
+            write_varint(out, len(value))
+            for item in value:
+                self.__write_value(out, item)
+        elif isinstance(value, dict):
+            out.append(DICT)
+            write_varint(out, len(value))
+            for key, item in value.items():
+                self.__write_key(out, key)
+                self.__write_value(out, item)
+        else:
+            raise TypeError("can not encode " + type(value).__name__)
+
+    def __read_value(self, payload: bytes, offset: int):
+        value_type = payload[offset]
+        offset += 1
+        if value_type == STRING:
+            return read_string(payload, offset)
+        if value_type == INTEGER:
+            value, offset = read_varint(payload, offset)
+            return (value >> 1) ^ -(value & 1), offset
+        if value_type == TRUE:
+            return True, offset
+        if value_type == FALSE:
+            return False, offset
+        if value_type == NONE:
+            return None, offset
+        if value_type == FLOAT:
+            if offset + FLOAT_FORMAT.size > len(payload):
+                raise IndexError("float out of range")
+            return FLOAT_FORMAT.unpack_from(payload, offset)[0], offset + FLOAT_FORMAT.size
+        if value_type == LIST:
+            length, offset = read_varint(payload, offset)
+            items = []
+            for _ in range(length):
+                item, offset = self.__read_value(payload, offset)
+                items.append(item)
+            return items, offset
+        if value_type == DICT:
+            length, offset = read_varint(payload, offset)
+            items = dict()
+            for _ in range(length):
+                key, offset = self.__read_key(payload, offset)
+                items[key], offset = self.__read_value(payload, offset)
+            return items, offset
+        raise KeyError("unknown value type " + str(value_type))
+
+
+def write_varint(out: bytearray, value: int):
+    # append a non negative integer, 7 bits per byte, low bits first
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(payload: bytes, offset: int):
+    # return the integer at offset and the offset after it
+    value = 0
+    shift = 0
+    while True:
+        byte = payload[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def write_string(out: bytearray, value: str):
+    data = value.encode()
+    length = len(data)
+    if length < 0x80:
+        out.append(length)
+    else:
+        write_varint(out, length)
+    out += data
+
+
+def read_string(payload: bytes, offset: int):
+    length, offset = read_varint(payload, offset)
+    end = offset + length
+    if end > len(payload):
+        raise IndexError("string out of range")
+    return payload[offset:end].decode(), end
+
+
+class CompressedCodec(Codec):
+    # another codec, with frames of COMPRESSION_THRESHOLD bytes or more compressed
+    # a batch of frames is compressed as a whole, small messages compress well together
+
+    compression = 'zlib'
+
+    def __init__(self, codec: Codec, threshold: int = COMPRESSION_THRESHOLD, level: int = COMPRESSION_LEVEL):
+        self.name = codec.name
+        self.__codec = codec
+        self.__threshold = threshold
+        self.__level = level
+
+    def encode(self, message: Dict) -> bytes:
+        return self.__codec.encode(message)
+
+    def decode(self, payload: bytes) -> Dict:
+        return self.__codec.decode(payload)
+
+    def frame(self, payload: bytes) -> bytes:
+        return self.__compressed_frame(payload, 0) or encode_frame(payload)
+
+    def batch(self, frames: List[bytes]) -> bytes:
+        # frames are compressed together MAX_FRAME_SIZE bytes at most, the most a batch may
+        # take once decompressed
+        batches = []
+        start = 0
+        size = 0
+        for end, frame in enumerate(frames):
+            if size + len(frame) > MAX_FRAME_SIZE and end > start:
+                batches.append(self.__batch(frames[start:end]))
+                start = end
+                size = 0
+            size += len(frame)
+        batches.append(self.__batch(frames[start:]))
+        return b''.join(batches)
+
+    def __batch(self, frames: List[bytes]) -> bytes:
+        joined = b''.join(frames)
+        if len(frames) < 2:
+            return joined
+        return self.__compressed_frame(joined, BATCH) or joined
+
+    def __compressed_frame(self, payload: bytes, flags: int) -> Optional[bytes]:
+        # the compressed frame, None if it is not worth it
+        if len(payload) < self.__threshold:
+            return None
+        compressed = zlib.compress(payload, self.__level)
+        if len(compressed) >= len(payload):
+            return None
+        return encode_frame(compressed, flags | COMPRESSED)
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+# every codec by name, in the order a client prefers them
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in [BINARY, JSON]}
+
+# the same codecs with compression, one each so that frames are compressed once per codec
+COMPRESSED_CODECS: Dict[str, Codec] = {name: CompressedCodec(codec) for name, codec in CODECS.items()}
+
+
+def choose_codec(offered: List[str]) -> Codec:
+    # the first codec of a client that is known here, json if there is none
+    # a login request is always json, as is the reply to it, the codec is used after that
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def choose_compression(offered: List[str]) -> Optional[str]:
+    # the first compression of a client that is known here, None if there is none
+    for name in offered:
+        if name in COMPRESSIONS:
+            return name
+    return None
+
+
+def with_compression(codec: Codec, compression: Optional[str]) -> Codec:
+    # codec, compressing its frames if compression is not None
+    if compression is None:
+        return CODECS[codec.name]
+    return COMPRESSED_CODECS[codec.name]
+
+
+def encode_message(message: Dict, codec: Codec = JSON) -> bytes:
+    # serialise a message into a complete frame ready to be sent
+    return codec.frame(codec.encode(message))
+
+
+def decode_message(payload: bytes, codec: Codec = JSON) -> Dict:
+    # parse the payload of a frame back into a message
+    return codec.decode(payload)
+
+
+class FrameDecoder:
+    # incrementally split a TCP byte stream into frames
+    # partial frames are buffered until the rest of them arrives
+
+    def __init__(self):
+        self.__buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        # add received bytes, return the payload of every completed frame
+        # compressed frames are decompressed, and a batch gives the payload of every frame in it
+        self.__buffer += data
+        payloads = []
+        offset = 0
+        buffer_size = len(self.__buffer)
+        while buffer_size - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.__buffer, offset)
+            flags = length & ~LENGTH_MASK
+            length &= LENGTH_MASK
+            if length > MAX_FRAME_SIZE:
+                raise FrameError("frame of " + str(length) + " bytes is too large")
+            end = offset + HEADER.size + length
+            if end > buffer_size:
+                # wait for the rest of the frame
+                break
+            payload = bytes(self.__buffer[offset + HEADER.size:end])
+            offset = end
+            if flags:
+                payloads.extend(unpack_frame(payload, flags))
+            else:
+                payloads.append(payload)
+        if offset:
+            del self.__buffer[:offset]
+        return payloads
+
+    def buffered(self) -> int:
+        # number of bytes waiting for the rest of their frame
+        return len(self.__buffer)
+
+
+def unpack_frame(payload: bytes, flags: int) -> List[bytes]:
+    # the payloads carried by the payload of a frame with flags
+    if flags & COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, MAX_FRAME_SIZE)
+        except zlib.error as error:
+            raise FrameError("frame can not be decompressed: " + str(error))
+        if decompressor.unconsumed_tail:
+            raise FrameError("decompressed frame is too large")
+    if not flags & BATCH:
+        return [payload]
+    decoder = FrameDecoder()
+    payloads = decoder.feed(payload)
+    if decoder.buffered():
+        raise FrameError("batch ends in the middle of a frame")
+    return payloads
@@ -4,15 +4,16 @@
 # coding: utf-8
 # modified from the multi-threading sample code
 
-import json
 import atexit
-import threading
-import time
+import os
 import sys
 import signal
-import readline
-from socket import *
-from typing import Dict
+import selectors
+import time
+from typing import Callable, Dict, Optional
+from ChatClient import ChatClient
+from Dispatcher import Dispatcher
+from EventLoop import EventLoop
 
 
 # captures ctrl+c exit keyboard signal
@@ -27,42 +28,21 @@ if len(sys.argv) != 3:
 server_name = sys.argv[1]
 server_port = int(sys.argv[2])
 
-# would communicate with server after every second
-UPDATE_INTERVAL = 1
-
-# if set true, main thread will exit at next 0.1 second
-to_exit = False
-
 # if set true, a time out message will be displayed to the terminal
 # and the program will exit
 is_timeout = False
 
-# connect to the server
-clientSocket = socket(AF_INET, SOCK_STREAM)
-clientSocket.connect((server_name, server_port))
+# serves the connection to the server, the private connections and stdin, see EventLoop.py
+loop = EventLoop()
 
-# get the thread
-t_lock = threading.Condition()
+# what was typed after the last complete line handled
+stdin_buffer = bytearray()
 
-# map of username to private tcp socket
-private_socket_map: Dict = dict()
+# called with the next line typed, None while waiting for the server
+line_handler: Optional[Callable[[str], None]] = None
 
-# private connection socket
-private_recv_socket = socket(AF_INET, SOCK_STREAM)
-private_recv_socket.bind(('localhost', 0))
-private_recv_socket.listen(1)
-private_recv_port = private_recv_socket.getsockname()[1]
-
-# get the username and password and login
-username = input("username: ")
-# username may be overwritten
-USERNAME = username
-message = json.dumps({
-    "action": "login",
-    "username": username,
-    "password": input("password: "),
-    "private_port": private_recv_port
-})
+# the username typed, kept for the next login attempt
+username = ''
 
 
 # logout handler
@@ -71,71 +51,49 @@ def logout():
         print("\rYou are timed out.")
     else:
         print("\rYou are logged out.")
-        clientSocket.send(json.dumps({
+        client.send({
             "action": "logout"
-        }).encode())
-        clientSocket.close()
+        })
+    client.close()
 
 
-# print without breaking input thread
-# https://stackoverflow.com/a/4653306/12208789 resolve line buffer issue
+# print a line over the prompt, then the prompt again
 def safe_print(*args):
-    sys.stdout.write('\r' + ' ' * (len(readline.get_line_buffer()) + 2) + '\r')
+    sys.stdout.write('\r')
     print(*args)
-    sys.stdout.write('> ' + readline.get_line_buffer())
+    sys.stdout.write('> ')
     sys.stdout.flush()
 
 
-# return a function as connection handler for a specific socket for multi threading
-def private_connection_handler(connection_socket, client_address):
-    def real_connection_handler():
-        while True:
-            data = connection_socket.recv(1024)
-            if not data:
-                # if data is empty, the socket is closed or is in the
-                # process of closing. In this case, close this thread
-                safe_print('Private connection stopped.')
-                exit(0)
+# every message another client sends, see PeerPool
+peer_dispatcher = Dispatcher()
 
-            # received data from the client, now we know who we are talking with
-            data = data.decode()
-            data = json.loads(data)
-            from_user = data["from"]
-            message = data["message"]
 
-            safe_print('[PRIVATE]', from_user, ':', message)
+@peer_dispatcher.register('private', {'from': str, 'message': str})
+def on_private_message(data: Dict, client: ChatClient):
+    safe_print('[PRIVATE]', data['from'], ':', data['message'])
 
-    return real_connection_handler
 
+@peer_dispatcher.register('stop', {'from': str})
+def on_private_stop(data: Dict, client: ChatClient):
+    # the other user stopped the conversation, a new startprivate starts another
+    safe_print('Private connection stopped.')
 
-# handles all incoming data and replies to those
-def private_recv_handler():
-    while True:
-        # create a new connection for a new client
-        connection_socket, client_address = private_recv_socket.accept()
-        safe_print('Private connection started.')
 
-        # create a new function handler for the client
-        private_socket_handler = private_connection_handler(connection_socket, client_address)
+@peer_dispatcher.register('lost', {'from': str})
+def on_private_lost(data: Dict, client: ChatClient):
+    # the other user can not be reached any more
+    safe_print('Private connection lost.')
 
-        # create a new thread for the client socket
-        private_socket_thread = threading.Thread(name=str(client_address), target=private_socket_handler)
-        private_socket_thread.daemon = False
-        private_socket_thread.start()
 
-
-def private_connect(address: str, port: int, username: str):
-    # connect with address directly in p2p mode
-    new_private_socket = socket(AF_INET, SOCK_STREAM)
-    new_private_socket.connect((address, port))
-    private_socket_map[username] = new_private_socket
-    safe_print('Private connection connected.')
+@peer_dispatcher.fallback
+def on_unexpected_peer_message(data: Dict, client: ChatClient):
+    pass
 
 
 def private_disconnect(username: str):
     # disconnect with user
-    if username in private_socket_map and private_socket_map[username]:
-        private_socket_map[username].close()
+    if client.stop_private(username):
         safe_print('Closed.')
     else:
         safe_print('Not connected.')
@@ -143,185 +101,292 @@ def private_disconnect(username: str):
 
 def private_message(username: str, message: str):
     # send a private message to user
-    if username in private_socket_map and private_socket_map[username]:
-        private_socket_map[username].send(json.dumps({
-            'from': USERNAME,
-            'message': message
-        }).encode())
-    else:
+    if not client.private_message(username, message):
         safe_print('Not connected.')
 
 
-# handles all incoming data and selectively display useful information to user
-def recv_handler():
-    global to_exit, is_timeout
-    while True:
-        login_result = clientSocket.recv(1024)
-        data = json.loads(login_result.decode())
-        if data['action'] == 'message':
-            # reply to a user-initiated message
-            if data['status'] == 'MESSAGE_SELF':
-                safe_print("Cannot message yourself.")
-            elif data['status'] == 'USER_NOT_EXIST':
-                safe_print("User does not exist.")
-            elif data['status'] == 'USER_BLOCKED':
-                safe_print("That user blocked you.")
-            elif data['status'] == 'SUCCESS':
-                # message sent successfully
-                pass
-        elif data['action'] in ['receive_message', 'receive_broadcast']:
-            # receiving a message
-            safe_print(data["from"], ':', data['message'])
-        elif data['action'] == 'block':
-            # reply to a user-initiated block
-            if data['status'] == 'MESSAGE_SELF':
-                safe_print("Cannot block yourself.")
-            elif data['status'] == 'USER_NOT_EXIST':
-                safe_print("User does not exist.")
-            else:
-                safe_print("Block success.")
-        elif data['action'] == 'unblock':
-            # reply to a user-initiated unblock
-            if data['status'] == 'MESSAGE_SELF':
-                safe_print("Cannot unblock yourself.")
-            elif data['status'] == 'USER_NOT_EXIST':
-                safe_print("User does not exist.")
-            else:
-                safe_print("Unblock success.")
-        elif data['action'] == 'broadcast':
-            # reply to a user-initiated broadcast
-            safe_print('broadcast success to', data['n_sent'], 'users.', data['n_blocked'],
-                       'users blocked you so they can not see the message.')
-        elif data['action'] == 'timeout':
-            # client timed out by the server
-            to_exit = True
-            is_timeout = True
-        elif data['action'] == 'whoelse':
-            # reply to a user-initiated whoelse
-            safe_print("Online users:")
-            safe_print("\n".join(data['reply']))
-        elif data['action'] == 'whoelsesince':
-            # reply to a user-initiated whoelsesince
-            safe_print("whoelsesince:")
-            safe_print("\n".join(data['reply']))
-        elif data['action'] == 'login_broadcast':
-            # receive login braodcast
-            safe_print(data['from'], 'is logged in.')
-        elif data['action'] == 'logout_broadcast':
-            # receive login braodcast
-            safe_print(data['from'], 'is logged out.')
-        elif data['action'] == 'startprivate':
-            # receive login braodcast
-            if data['reply'] == 'USER_NOT_EXIST':
-                safe_print("startprivate: user does not exist.")
-            elif data['reply'] == 'USER_SELF':
-                safe_print("startprivate: cannot private yourself.")
-            elif data['reply'] == 'USER_BLOCKED':
-                safe_print("startprivate: that user blocked you.")
-            elif data['reply'] == 'USER_OFFLINE':
-                safe_print("startprivate: that user is offline.")
-            elif data['reply'] == 'SUCCESS':
-                address = data['address']
-                port = int(data['port'])
-                username = data['username']
-                private_connect(address, port, username)
-            else:
-                safe_print("Unexpected reply.")
-        else:
-            # unexpected format
-            safe_print(data)
-
-
-# handles all outgoing data
-def send_handler():
-    global to_exit
-    while True:
-        # handle input and send to server
-        command = input("> ").strip()
-        if command.startswith("logout"):
-            to_exit = True
-        elif command.startswith("message"):
-            _, user, message = command.split(' ', 2)
-            clientSocket.send(json.dumps({
-                "action": "message",
-                "message": message,
-                "user": user
-            }).encode())
-        elif command.startswith("broadcast"):
-            _, message = command.split(' ', 1)
-            clientSocket.send(json.dumps({
-                "action": "broadcast",
-                "message": message,
-            }).encode())
-        elif command.startswith("block"):
-            _, user = command.split()
-            clientSocket.send(json.dumps({
-                "action": "block",
-                "user": user,
-            }).encode())
-        elif command.startswith("unblock"):
-            _, user = command.split()
-            clientSocket.send(json.dumps({
-                "action": "unblock",
-                "user": user,
-            }).encode())
-        elif command.startswith("whoelsesince"):
-            _, since = command.split()
-            clientSocket.send(json.dumps({
-                "action": "whoelsesince",
-                "since": since
-            }).encode())
-        elif command.startswith("whoelse"):
-            clientSocket.send(json.dumps({
-                "action": "whoelse"
-            }).encode())
-        elif command.startswith("startprivate"):
-            _, user = command.split()
-            clientSocket.send(json.dumps({
-                "action": "startprivate",
-                "user": user
-            }).encode())
-        elif command.startswith("stopprivate"):
-            _, user = command.split()
-            private_disconnect(user)
-        elif command.startswith("private"):
-            _, user, message = command.split(' ', 2)
-            private_message(user, message)
-
-
-# start the interaction between client and server
-def interact():
-    global private_recv_socket
-    recv_thread = threading.Thread(name="RecvHandler", target=recv_handler)
-    recv_thread.daemon = True
-    recv_thread.start()
-
-    send_thread = threading.Thread(name="SendHandler", target=send_handler)
-    send_thread.daemon = True
-    send_thread.start()
-
-    recv_thread = threading.Thread(name="PrivateRecvHandler", target=private_recv_handler)
-    recv_thread.daemon = True
-    recv_thread.start()
-
-    while True:
-        time.sleep(0.1)
-
-        # when set true, exit the main thread
-        if to_exit:
-            exit(0)
-
-
-# log in then start interaction if successfully authenticated
-def log_in():
-    global message
-    clientSocket.send(message.encode())
-
-    # wait for the reply from the server
-    login_result = clientSocket.recv(1024)
-    login_result = json.loads(login_result.decode())
-
-    if login_result["action"] == 'login' and login_result["status"] == "SUCCESS":
+# every message the server sends, see ChatClient
+server_dispatcher = Dispatcher()
+
+
+@server_dispatcher.register('message', {'status': str})
+def on_message_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated message
+    if data['status'] == 'MESSAGE_SELF':
+        safe_print("Cannot message yourself.")
+    elif data['status'] == 'USER_NOT_EXIST':
+        safe_print("User does not exist.")
+    elif data['status'] == 'USER_BLOCKED':
+        safe_print("That user blocked you.")
+    elif data['status'] == 'SUCCESS':
+        # message sent successfully
+        pass
+
+
+@server_dispatcher.register('message_batch', {'n_sent': int, 'failed': dict})
+def on_message_batch_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated messagebatch, the messages sent need no notice
+    for user, status in sorted(data['failed'].items()):
+        if status == 'MESSAGE_SELF':
+            safe_print("Cannot message yourself.")
+        elif status == 'USER_NOT_EXIST':
+            safe_print(user, "does not exist.")
+        elif status == 'USER_BLOCKED':
+            safe_print(user, "blocked you.")
+
+
+@server_dispatcher.register('receive_message', {'from': str, 'message': str})
+@server_dispatcher.register('receive_broadcast', {'from': str, 'message': str})
+def on_receive_message(data: Dict, client: ChatClient):
+    # receiving a message
+    safe_print(data["from"], ':', data['message'])
+
+
+@server_dispatcher.register('block', {'status': str})
+def on_block_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated block
+    if data['status'] == 'MESSAGE_SELF':
+        safe_print("Cannot block yourself.")
+    elif data['status'] == 'USER_NOT_EXIST':
+        safe_print("User does not exist.")
+    else:
+        safe_print("Block success.")
+
+
+@server_dispatcher.register('unblock', {'status': str})
+def on_unblock_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated unblock
+    if data['status'] == 'MESSAGE_SELF':
+        safe_print("Cannot unblock yourself.")
+    elif data['status'] == 'USER_NOT_EXIST':
+        safe_print("User does not exist.")
+    else:
+        safe_print("Unblock success.")
+
+
+@server_dispatcher.register('broadcast', {'n_sent': int, 'n_blocked': int})
+def on_broadcast_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated broadcast
+    safe_print('broadcast success to', data['n_sent'], 'users.', data['n_blocked'],
+               'users blocked you so they can not see the message.')
+
+
+@server_dispatcher.register('timeout')
+def on_timeout(data: Dict, client: ChatClient):
+    # client timed out by the server
+    global is_timeout
+    is_timeout = True
+    loop.stop()
+
+
+@server_dispatcher.register('whoelse', {'reply': list})
+def on_whoelse_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated whoelse
+    safe_print("Online users:")
+    safe_print("\n".join(data['reply']))
+
+
+@server_dispatcher.register('whoelsesince', {'reply': list})
+def on_whoelsesince_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated whoelsesince
+    safe_print("whoelsesince:")
+    safe_print("\n".join(data['reply']))
+
+
+@server_dispatcher.register('history', {'status': str})
+def on_history_reply(data: Dict, client: ChatClient):
+    # reply to a user-initiated history, a page of messages, newest first
+    if data['status'] == 'USER_NOT_EXIST':
+        safe_print("history: user does not exist.")
+        return
+    if data['status'] == 'NOT_LOGGED_IN':
+        safe_print("history: you are not logged in.")
+        return
+    if data['status'] == 'NOT_AVAILABLE':
+        safe_print("history: not kept by this server.")
+        return
+    for sent, from_user, message in reversed(data['messages']):
+        safe_print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sent)), from_user + ':', message)
+    if 'cursor' in data:
+        safe_print('older messages: history', data['user'] or '*', data['cursor'])
+
+
+@server_dispatcher.register('resume', {'status': str})
+def on_resume_reply(data: Dict, client: ChatClient):
+    # the connection to the server dropped, and the session went on over a new one
+    if data['status'] == 'SUCCESS':
+        safe_print("Reconnected to the server.")
+    else:
+        safe_print("Could not resume the session.")
+
+
+@server_dispatcher.register('login_broadcast', {'from': str})
+def on_login_broadcast(data: Dict, client: ChatClient):
+    # receive login braodcast
+    safe_print(data['from'], 'is logged in.')
+
+
+@server_dispatcher.register('logout_broadcast', {'from': str})
+def on_logout_broadcast(data: Dict, client: ChatClient):
+    # receive login braodcast
+    safe_print(data['from'], 'is logged out.')
+
+
+@server_dispatcher.register('startprivate', {'reply': str})
+def on_startprivate_reply(data: Dict, client: ChatClient):
+    if data['reply'] == 'USER_NOT_EXIST':
+        safe_print("startprivate: user does not exist.")
+    elif data['reply'] == 'USER_SELF':
+        safe_print("startprivate: cannot private yourself.")
+    elif data['reply'] == 'USER_BLOCKED':
+        safe_print("startprivate: that user blocked you.")
+    elif data['reply'] == 'USER_OFFLINE':
+        safe_print("startprivate: that user is offline.")
+    elif data['reply'] == 'SUCCESS':
+        # connect with the user directly in p2p mode, or reuse the connection to it
+        client.start_private(data['username'], (data['address'], int(data['port'])))
+        safe_print('Private connection connected.')
+    else:
+        safe_print("Unexpected reply.")
+
+
+@server_dispatcher.fallback
+def on_unexpected(data: Dict, client: ChatClient):
+    # unexpected format
+    safe_print(data)
+
+
+def on_server_closed(client: ChatClient):
+    if not client.logged_in:
+        print("FATAL: server closed the connection")
+        exit(1)
+    loop.stop()
+
+
+# ask for a line, handler is called with it
+def prompt(text: str, handler: Callable[[str], None]):
+    global line_handler
+    line_handler = handler
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+# reads whatever was typed
+def on_stdin(events: int):
+    data = os.read(sys.stdin.fileno(), 4096)
+    if not data:
+        # nothing more will be typed, keep receiving
+        loop.unwatch(sys.stdin)
+        return
+    stdin_buffer.extend(data)
+    handle_lines()
+
+
+# hands every complete line to the handler asking for it, lines typed ahead wait for one
+def handle_lines():
+    global line_handler
+    while line_handler is not None and b'\n' in stdin_buffer and loop.running:
+        line, _, rest = bytes(stdin_buffer).partition(b'\n')
+        stdin_buffer[:] = rest
+        handler, line_handler = line_handler, None
+        handler(line.decode().strip())
+
+
+def on_username(line: str):
+    global username
+    username = line
+    prompt("password: ", on_password)
+
+
+def on_password(line: str):
+    # wait for the reply of the server before reading more
+    client.login(username, line)
+
+
+def on_command(command: str):
+    handle_command(command)
+    if loop.running:
+        prompt("> ", on_command)
+
+
+# handles one command and sends it to the server
+def handle_command(command: str):
+    if command.startswith("logout"):
+        loop.stop()
+    elif command.startswith("messagebatch"):
+        # the same message to several users, with one reply
+        _, users, message = command.split(' ', 2)
+        client.message_batch([(user, message) for user in users.split(',') if user])
+    elif command.startswith("message"):
+        _, user, message = command.split(' ', 2)
+        client.send({
+            "action": "message",
+            "message": message,
+            "user": user
+        })
+    elif command.startswith("broadcast"):
+        _, message = command.split(' ', 1)
+        client.send({
+            "action": "broadcast",
+            "message": message,
+        })
+    elif command.startswith("block"):
+        _, user = command.split()
+        client.send({
+            "action": "block",
+            "user": user,
+        })
+    elif command.startswith("unblock"):
+        _, user = command.split()
+        client.send({
+            "action": "unblock",
+            "user": user,
+        })
+    elif command.startswith("whoelsesince"):
+        _, since = command.split()
+        client.send({
+            "action": "whoelsesince",
+            "since": since
+        })
+    elif command.startswith("whoelse"):
+        client.send({
+            "action": "whoelse"
+        })
+    elif command.startswith("history"):
+        # history user, or history * for the broadcasts, then the cursor of older messages
+        arguments = command.split()
+        if len(arguments) not in (2, 3):
+            safe_print("usage: history <user|*> [cursor]")
+            return
+        request = {
+            "action": "history",
+            "user": '' if arguments[1] == '*' else arguments[1]
+        }
+        if len(arguments) > 2:
+            try:
+                request["cursor"] = int(arguments[2])
+            except ValueError:
+                safe_print("usage: history <user|*> [cursor]")
+                return
+        client.send(request)
+    elif command.startswith("startprivate"):
+        _, user = command.split()
+        client.send({
+            "action": "startprivate",
+            "user": user
+        })
+    elif command.startswith("stopprivate"):
+        _, user = command.split()
+        private_disconnect(user)
+    elif command.startswith("private"):
+        _, user, message = command.split(' ', 2)
+        private_message(user, message)
+
+
+# handles the reply to the login, and starts the interaction if successfully authenticated
+@server_dispatcher.register('login', {'status': str})
+def on_login_reply(data: Dict, client: ChatClient):
+    if data["status"] == "SUCCESS":
         # successfully authenticated
         print("You are logged in")
 
@@ -329,26 +394,24 @@ def log_in():
         atexit.register(logout)
 
         # start interaction
-        interact()
-    elif login_result["action"] == 'login' and login_result["status"] == "ALREADY_LOGGED_IN":
+        prompt("> ", on_command)
+        handle_lines()
+    elif data["status"] == "ALREADY_LOGGED_IN":
         print("You have already logged in.")
-    elif login_result["action"] == 'login' and login_result["status"] == "INVALID_PASSWORD_BLOCKED":
+        loop.stop()
+    elif data["status"] == "INVALID_PASSWORD_BLOCKED":
         print("Invalid password. Your account has been blocked. Please try again later.")
-    elif login_result["action"] == 'login' and login_result["status"] == "BLOCKED":
+        loop.stop()
+    elif data["status"] == "BLOCKED":
         print("Due to multiple consecutive fails to log in, you have been blocked.")
-    elif login_result["action"] == 'login' and login_result["status"] == "INVALID_PASSWORD":
+        loop.stop()
+    elif data["status"] == "INVALID_PASSWORD":
         # invalid password, try again
-        message = json.dumps({
-            "action": "login",
-            "username": username,
-            "password": input("Invalid password. Please try again:"),
-            "private_port": private_recv_port
-        })
-        log_in()
-    elif login_result["action"] == 'login' and login_result["status"] == "ALREADY_LOGGED_IN":
-        print(login_result["status"])
-    elif login_result["action"] == 'login' and login_result["status"] == "USERNAME_NOT_EXIST":
-        print(login_result["status"])
+        prompt("Invalid password. Please try again:", on_password)
+        handle_lines()
+    elif data["status"] == "USERNAME_NOT_EXIST":
+        print(data["status"])
+        loop.stop()
     else:
         # things unexpected
         print("FATAL: unexpected message")
@@ -359,5 +422,11 @@ def log_in():
 signal.signal(signal.SIGINT, keyboard_interrupt_handler)
 
 if __name__ == "__main__":
-    # start to authenticate user
-    log_in()
+    # connect to the server, the session and its private connections are served by the loop
+    client = ChatClient(loop, (server_name, server_port), server_dispatcher, peer_dispatcher,
+                        on_server_closed, on_unexpected)
+
+    # get the username and password and login
+    loop.watch(sys.stdin, selectors.EVENT_READ, on_stdin)
+    prompt("username: ", on_username)
+    loop.run_forever()
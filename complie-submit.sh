@@ -5,8 +5,25 @@ mkdir .temp/client
 cp report.pdf .temp
 cp server/server.py .temp/server
 cp server/UserManager.py .temp/server
+cp server/CredentialStore.py .temp/server
+cp server/Protocol.py .temp/server
+cp server/AsyncEngine.py .temp/server
+cp server/DeadlineScheduler.py .temp/server
+cp server/MessageStore.py .temp/server
+cp server/HistoryStore.py .temp/server
+cp server/Session.py .temp/server
+cp server/Connection.py .temp/server
+cp server/Dispatcher.py .temp/server
+cp server/Metrics.py .temp/server
+cp server/Profiler.py .temp/server
+cp server/Cluster.py .temp/server
 cp server/credentials.txt .temp/server
 cp client/client.py .temp/client
+cp client/Protocol.py .temp/client
+cp client/Dispatcher.py .temp/client
+cp client/ChatClient.py .temp/client
+cp client/EventLoop.py .temp/client
+cp client/PeerPool.py .temp/client
 
 cd .temp/ || exit
 tar -cvf assign.tar server client report.pdf
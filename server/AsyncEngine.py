@@ -0,0 +1,177 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the asyncio engine for the server to use
+# every connection is served by one event loop instead of one thread each
+
+import asyncio
+import time
+from collections import deque
+from socket import socket
+from typing import Callable, Optional
+from Protocol import FrameDecoder, FrameError, JSON
+from Connection import Backpressure, OutboundLimits
+
+# pending connections the kernel queues for the event loop to accept
+BACKLOG = 4096
+
+
+class AsyncConnection(asyncio.Protocol, Backpressure):
+    # a client connection served by the event loop
+    # it offers the same sendall as the Connection of the thread engine, so the
+    # request handler works the same way on both engines
+
+    def __init__(self, handle_request: Callable, limits: OutboundLimits):
+        Backpressure.__init__(self, limits)
+        self.__handle_request = handle_request
+        self.__decoder = FrameDecoder()
+        # payloads received but not handled yet, and the request waiting for a worker if any
+        self.__payloads = deque()
+        self.__waiting = None
+        # the codec of every frame after the login reply, see Protocol.choose_codec
+        self.codec = JSON
+        self.__transport = None
+        self.__address = None
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        self.__address = transport.get_extra_info('peername')
+        # the transport calls resume_writing once its buffer is below the low watermark
+        transport.set_write_buffer_limits(self.limits.high_watermark, self.limits.low_watermark)
+
+    def connection_lost(self, error: Optional[Exception]):
+        self.lost()
+
+    def data_received(self, data: bytes):
+        # one read may carry several requests, or only a part of one
+        try:
+            self.__payloads.extend(self.__decoder.feed(data))
+        except FrameError:
+            # the stream can not be split into requests any more, connection_lost follows
+            self.__transport.close()
+            return
+        self.__handle_payloads()
+
+    def __handle_payloads(self):
+        # handle requests in order, a request waiting for a worker holds back the rest
+        # of this client, while the loop goes on serving every other client
+        while self.__payloads and self.__waiting is None:
+            deferred = self.__handle_request(self, self.__address, self.__payloads.popleft())
+            if deferred is not None:
+                self.__waiting = deferred
+                self.__transport.pause_reading()
+                loop = asyncio.get_event_loop()
+                deferred.future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.__resume))
+
+    def __resume(self):
+        deferred, self.__waiting = self.__waiting, None
+        deferred.resume()
+        self.__handle_payloads()
+        if self.__waiting is None:
+            self.__transport.resume_reading()
+
+    def sendall(self, data: bytes):
+        # the transport buffers whatever the kernel does not take right away
+        if self.__transport.is_closing():
+            return
+        if self._overflows(self.__transport.get_write_buffer_size()):
+            self._overflow(data)
+        else:
+            self.__transport.write(data)
+
+    def queued(self) -> int:
+        # number of bytes waiting to be written
+        return self.__transport.get_write_buffer_size()
+
+    def hold(self) -> bool:
+        # above the high watermark the transport has paused writing, and calls resume_writing
+        return self._hold(self.__transport.get_write_buffer_size())
+
+    def resume_writing(self):
+        if self._drained(self.__transport.get_write_buffer_size()):
+            self._resumed()
+
+    def getsockname(self):
+        return self.__transport.get_extra_info('sockname')
+
+    def close(self):
+        self.__transport.close()
+
+
+class DeadlineTimer:
+    # call on_due once next_deadline() has passed, without polling
+    # re-armed after every request, in case a request added an earlier deadline
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, next_deadline: Callable[[], Optional[float]],
+                 on_due: Callable):
+        self.__loop = loop
+        self.__next_deadline = next_deadline
+        self.__on_due = on_due
+        self.__handle: Optional[asyncio.TimerHandle] = None
+        self.__armed_deadline = 0.0
+
+    def arm(self):
+        deadline = self.__next_deadline()
+        if self.__handle is not None:
+            if deadline is not None and self.__armed_deadline <= deadline:
+                # already going to fire early enough
+                return
+            self.__handle.cancel()
+            self.__handle = None
+        if deadline is not None:
+            # deadlines are wall clock times, the loop runs on its own clock
+            self.__armed_deadline = deadline
+            self.__handle = self.__loop.call_at(self.__loop.time() + max(0.0, deadline - time.time()),
+                                                self.__fire)
+
+    def __fire(self):
+        self.__handle = None
+        self.__on_due()
+        self.arm()
+
+
+def raise_open_file_limit():
+    # every connection is a file descriptor, allow as many as the system does
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def serve_forever(server_socket: socket, handle_request: Callable, limits: OutboundLimits,
+                  next_deadline: Callable[[], Optional[float]], on_deadline: Callable,
+                  on_start: Optional[Callable[[Callable], None]] = None):
+    # serve every connection accepted on server_socket from a single event loop
+    # handle_request(connection, client_address, payload) is called for every request,
+    # it returns a Deferred if the request waits for a worker
+    # limits bounds the bytes queued for each client
+    # on_deadline is called whenever next_deadline() has passed
+    # on_start(run) is called before serving, run(callback, *args) calls callback in the
+    # loop from any thread, as if it was a request
+    raise_open_file_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    timer = DeadlineTimer(loop, next_deadline, on_deadline)
+
+    def run(callback: Callable, *args):
+        def run_and_rearm():
+            callback(*args)
+            timer.arm()
+
+        loop.call_soon_threadsafe(run_and_rearm)
+
+    def handle_and_rearm(connection, client_address, payload):
+        deferred = handle_request(connection, client_address, payload)
+        if deferred is not None:
+            return deferred.then(lambda _: timer.arm())
+        timer.arm()
+        return None
+
+    if on_start is not None:
+        on_start(run)
+    loop.run_until_complete(loop.create_server(lambda: AsyncConnection(handle_and_rearm, limits),
+                                               sock=server_socket, backlog=BACKLOG))
+    loop.run_forever()
@@ -0,0 +1,559 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the multi-process mode of the server
+#
+# with --workers N the server process starts N worker processes and relays events
+# between them, it serves no client itself
+# every worker is a whole server: it accepts clients on the same port through
+# SO_REUSEPORT and keeps a full replica of the UserManager, so every read, e.g.
+# whoelse or a block check, is answered locally
+# every change of the shared state, a login attempt, a logout, a time out, a block
+# or an unblock, is sent to the hub as an event instead of being applied right away
+# the hub sends every event to every worker, the sender included, in one order, and
+# every worker applies it when it arrives, so all replicas go through the same changes
+# in the same order and a worker only replies once its own event came back
+# messages to a user connected to another worker are sent to that worker only
+#
+# with --node i --nodes host:port,... the servers are nodes of a cluster instead, each
+# started on its own, maybe on another host, and linked to the others over TCP
+# there is no hub: the events about a user go through the node the user belongs to,
+# by consistent hashing of the username, which relays them to every node in one order,
+# see NodeMesh, and the events of one user are all that has to be in order
+
+import hashlib
+import itertools
+import os
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from Protocol import BINARY, FrameDecoder, RECV_SIZE, encode_frame
+
+# every event sent to the hub starts with the worker it is for, or EVERYONE
+TARGET = struct.Struct('!h')
+EVERYONE = -1
+
+# seconds the workers get to shut down before they are killed
+SHUTDOWN_TIMEOUT = 5.0
+
+# points of every node on the hash ring
+VIRTUAL_NODES = 64
+
+# seconds between two attempts to connect to another node
+RECONNECT_INTERVAL = 0.5
+
+# the first frame on a link between nodes: the node opening it and the run of that node
+HELLO = struct.Struct('!hQ')
+
+# every later frame on a link starts with its number, counting up from 1 for every run of
+# the sending node, and the acknowledgements sent back are the last number applied
+SEQUENCE = struct.Struct('!Q')
+
+# frames applied before a node acknowledges them, the sender keeps this many at least
+ACK_INTERVAL = 64
+
+# seconds a link is quiet before a node acknowledges fewer frames, so a node that stops
+# sending for a while is not sent those frames again when the other node starts again
+ACK_DELAY = 0.05
+
+
+def chain(future: Future, step: Callable[[Any], Future]) -> Future:
+    # a future of the result of step(result of future), without blocking anyone
+    chained = Future()
+
+    def copy_result(done: Future):
+        if done.exception() is not None:
+            chained.set_exception(done.exception())
+        else:
+            chained.set_result(done.result())
+
+    def run_step(done: Future):
+        try:
+            step(done.result()).add_done_callback(copy_result)
+        except Exception as error:
+            chained.set_exception(error)
+
+    future.add_done_callback(run_step)
+    return chained
+
+
+class Hub:
+    # relays the events of the workers, in the order they arrive
+    # the hub never blocks on a worker: what a worker does not take right away is
+    # buffered, so a worker that is busy sending events can not stall the others
+
+    def __init__(self, links: List[socket.socket]):
+        self.__selector = selectors.DefaultSelector()
+        self.__links = links
+        self.__decoders = [FrameDecoder() for _ in links]
+        self.__outboxes = [bytearray() for _ in links]
+        for worker, link in enumerate(links):
+            link.setblocking(False)
+            self.__selector.register(link, selectors.EVENT_READ, worker)
+
+    def serve_forever(self):
+        # return once a worker is gone
+        while True:
+            for key, events in self.__selector.select():
+                worker = key.data
+                if events & selectors.EVENT_READ and not self.__read(worker):
+                    return
+                if events & selectors.EVENT_WRITE:
+                    self.__write(worker)
+
+    def __read(self, worker: int) -> bool:
+        try:
+            data = self.__links[worker].recv(RECV_SIZE)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            return False
+        for payload in self.__decoders[worker].feed(data):
+            (target,) = TARGET.unpack_from(payload)
+            frame = encode_frame(payload[TARGET.size:])
+            for receiver in range(len(self.__links)) if target == EVERYONE else [target]:
+                self.__queue(receiver, frame)
+        return True
+
+    def __queue(self, worker: int, frame: bytes):
+        if not self.__outboxes[worker]:
+            self.__selector.modify(self.__links[worker], selectors.EVENT_READ | selectors.EVENT_WRITE, worker)
+        self.__outboxes[worker] += frame
+
+    def __write(self, worker: int):
+        outbox = self.__outboxes[worker]
+        try:
+            sent = self.__links[worker].send(outbox)
+        except BlockingIOError:
+            return
+        except OSError:
+            # the worker is gone, reading its link tells the hub
+            sent = len(outbox)
+        del outbox[:sent]
+        if not outbox:
+            self.__selector.modify(self.__links[worker], selectors.EVENT_READ, worker)
+
+
+def supervise(n_workers: int):
+    # run server.py n_workers times, each as a worker linked to a hub in this process
+    # relay their events until one of them is gone, then stop all of them and exit
+    links = []
+    workers = []
+    for worker in range(n_workers):
+        hub_end, worker_end = socket.socketpair()
+        workers.append(subprocess.Popen([sys.executable] + sys.argv + ['--worker', str(worker),
+                                                                       '--hub-fd', str(worker_end.fileno())],
+                                        pass_fds=[worker_end.fileno()], start_new_session=True))
+        worker_end.close()
+        links.append(hub_end)
+
+    def forward(signal_number, frame):
+        for process in workers:
+            process.send_signal(signal_number)
+
+    def shut_down(signal_number=signal.SIGINT, frame=None):
+        forward(signal_number, frame)
+        for process in workers:
+            try:
+                process.wait(SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        os._exit(0)
+
+    # the workers have sessions of their own, so ctrl+c reaches them through here, once
+    signal.signal(signal.SIGINT, shut_down)
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+    hub = threading.Thread(name="Hub", target=Hub(links).serve_forever)
+    hub.daemon = True
+    hub.start()
+    while hub.is_alive():
+        hub.join(0.5)
+    print("ERROR: a worker stopped, stopping the server")
+    shut_down(signal.SIGTERM)
+
+
+class ClusterLink:
+    # how a worker, or a node, reaches the others
+    # apply(event) is called with every event for this member, and the future returned
+    # by publish is set to what apply returned for that event here
+    # the events about a user are applied in the same order by every member
+
+    def __init__(self, member: int):
+        self.member = member
+        self.__serial = 0
+        self.__serial_lock = threading.Lock()
+        # serial of every event published by this member and not applied yet, to its future
+        self.__published: Dict[int, Future] = dict()
+        self.__apply: Optional[Callable[[Dict], Any]] = None
+        self.__run: Optional[Callable] = None
+
+    def start(self, apply: Callable[[Dict], Any], run: Optional[Callable] = None):
+        # start applying events
+        # run(callback, event) calls callback(event) where it is safe to apply events,
+        # e.g. in an event loop, by default they are applied by a thread of the link
+        self.__apply = apply
+        self.__run = run or self._default_run()
+        self._connect()
+
+    def publish(self, event: Dict, key: str) -> Future:
+        # send event to every member, this one included, in the order of the events about key
+        # return a future of what applying it here returned
+        future = Future()
+        with self.__serial_lock:
+            self.__serial += 1
+            event['origin'] = self.member
+            event['serial'] = self.__serial
+            self.__published[self.__serial] = future
+        self._publish(event, key)
+        return future
+
+    def send(self, event: Dict, member: int):
+        # send event to one other member, nothing comes back
+        event['origin'] = self.member
+        self._send(event, member)
+
+    def _received(self, event: Dict):
+        # apply an event that came in
+        self.__run(self.__handle, event)
+
+    def _default_run(self) -> Callable:
+        return lambda callback, event: callback(event)
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _publish(self, event: Dict, key: str):
+        raise NotImplementedError
+
+    def _send(self, event: Dict, member: int):
+        raise NotImplementedError
+
+    def __handle(self, event: Dict):
+        future = None
+        if event.get('origin') == self.member and 'serial' in event:
+            future = self.__published.pop(event['serial'], None)
+        try:
+            result = self.__apply(event)
+        except Exception as error:
+            if future is None:
+                print("ERROR: applying", event.get('action'), "failed:", error)
+            else:
+                future.set_exception(error)
+            return
+        if future is not None:
+            future.set_result(result)
+
+
+def event_payload(target: int, event: Dict) -> bytes:
+    # the payload of an event for target, a member or EVERYONE
+    return TARGET.pack(target) + BINARY.encode(event)
+
+
+def event_frame(target: int, event: Dict) -> bytes:
+    return encode_frame(event_payload(target, event))
+
+
+class HubLink(ClusterLink):
+    # the link of a worker to the hub, events are applied by the thread reading it
+
+    def __init__(self, worker: int, hub_fd: int):
+        ClusterLink.__init__(self, worker)
+        self.__socket = socket.socket(fileno=hub_fd)
+        self.__send_lock = threading.Lock()
+
+    def _connect(self):
+        reader = threading.Thread(name="HubLink", target=self.__read_forever)
+        reader.daemon = True
+        reader.start()
+
+    def _publish(self, event: Dict, key: str):
+        # the hub puts every event in one order, whatever it is about
+        self.__send(event_frame(EVERYONE, event))
+
+    def _send(self, event: Dict, member: int):
+        self.__send(event_frame(member, event))
+
+    def __send(self, frame: bytes):
+        with self.__send_lock:
+            self.__socket.sendall(frame)
+
+    def __read_forever(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.__socket.recv(RECV_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                # the hub is gone, so are the other workers
+                print("FATAL: lost the link to the other workers")
+                os._exit(1)
+            for payload in decoder.feed(data):
+                self._received(BINARY.decode(payload))
+
+
+class HashRing:
+    # consistent hashing of keys to nodes
+    # every node has VIRTUAL_NODES points on a ring of 32 bit hashes, and a key belongs
+    # to the node of the first point at or after its own hash, so a node joining or
+    # leaving only moves the keys next to its points
+
+    def __init__(self, n_nodes: int, virtual_nodes: int = VIRTUAL_NODES):
+        points = sorted((ring_hash('%d-%d' % (node, point)), node)
+                        for node in range(n_nodes) for point in range(virtual_nodes))
+        self.__hashes = [point_hash for point_hash, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> int:
+        position = bisect_left(self.__hashes, ring_hash(key))
+        return self.__nodes[position % len(self.__nodes)]
+
+
+def ring_hash(key: str) -> int:
+    # the same on every node, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], 'big')
+
+
+class Peer:
+    # the persistent link to another node
+    # frames are queued and written by a thread of their own, which connects when the
+    # link is down, so the other node may start later or restart
+    # a frame is kept until the other node acknowledges it, and the frames it has not
+    # acknowledged are sent again on a new link, the other node drops the ones it has
+    # already applied, so every event is applied once
+
+    def __init__(self, node: int, address: Tuple[str, int], hello: bytes):
+        self.__node = node
+        self.__address = address
+        # the first frame on every link, see HELLO
+        self.__hello = hello
+        # (number, frame) of every frame not acknowledged yet, oldest first
+        self.__frames: Deque[Tuple[int, bytes]] = deque()
+        self.__queued = 0
+        # the number of the last frame written on the current link
+        self.__written = 0
+        self.__ready = threading.Condition()
+
+    def start(self):
+        sender = threading.Thread(name="Peer-%d" % self.__node, target=self.__send_forever)
+        sender.daemon = True
+        sender.start()
+
+    def queue(self, payload: bytes):
+        with self.__ready:
+            self.__queued += 1
+            self.__frames.append((self.__queued, encode_frame(SEQUENCE.pack(self.__queued) + payload)))
+            self.__ready.notify()
+
+    def __send_forever(self):
+        link = None
+        while True:
+            with self.__ready:
+                while not self.__frames or self.__frames[-1][0] <= self.__written:
+                    self.__ready.wait()
+                # the frames are numbered without gaps, skip the ones written already
+                first = max(0, self.__written - self.__frames[0][0] + 1)
+                data = b''.join(frame for _, frame in itertools.islice(self.__frames, first, None))
+                written = self.__frames[-1][0]
+            try:
+                if link is None:
+                    link = socket.create_connection(self.__address)
+                    link.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    reader = threading.Thread(name="PeerAcks-%d" % self.__node, target=self.__read_acks,
+                                              args=(link,))
+                    reader.daemon = True
+                    reader.start()
+                    link.sendall(self.__hello)
+                link.sendall(data)
+                with self.__ready:
+                    self.__written = written
+            except OSError:
+                # send every frame not acknowledged again on a new link
+                if link is not None:
+                    link.close()
+                    link = None
+                with self.__ready:
+                    self.__written = 0
+                time.sleep(RECONNECT_INTERVAL)
+
+    def __read_acks(self, link: socket.socket):
+        # drop the frames the other node acknowledges on link, until the link is closed
+        buffered = b''
+        while True:
+            try:
+                data = link.recv(RECV_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+            buffered += data
+            if len(buffered) < SEQUENCE.size:
+                continue
+            # only the last acknowledgement matters, it covers the ones before
+            end = len(buffered) - len(buffered) % SEQUENCE.size
+            (acked,) = SEQUENCE.unpack_from(buffered, end - SEQUENCE.size)
+            buffered = buffered[end:]
+            with self.__ready:
+                while self.__frames and self.__frames[0][0] <= acked:
+                    self.__frames.popleft()
+
+
+class NodeMesh(ClusterLink):
+    # the links of a node to every other node of the cluster
+    # a user belongs to one node, picked by consistent hashing of the username, and the
+    # events about a user are sent to that node, which applies them and relays them to
+    # every other node, in the order it got them, so every node applies them in that order
+    # events for one node, e.g. messages, go straight to it
+    # events are applied by a thread of the mesh, one at a time
+
+    def __init__(self, node: int, addresses: List[Tuple[str, int]]):
+        ClusterLink.__init__(self, node)
+        self.__address = addresses[node]
+        self.__ring = HashRing(len(addresses))
+        # a new number for every run, so the other nodes know the frames are numbered anew
+        hello = encode_frame(HELLO.pack(node, int.from_bytes(os.urandom(HELLO.size - 2), 'big')))
+        self.__peers = {peer: Peer(peer, address, hello) for peer, address in enumerate(addresses) if peer != node}
+        self.__relay_lock = threading.Lock()
+        # node to (run, number of the last frame applied) of the frames it sent, and the lock
+        # held to check and apply a frame, a node may be sending on an old and a new link
+        self.__applied: Dict[int, Tuple[int, int]] = dict()
+        self.__applied_lock = threading.Lock()
+        self.__events: Deque = deque()
+        self.__events_ready = threading.Condition()
+
+    def _default_run(self) -> Callable:
+        applier = threading.Thread(name="EventApplier", target=self.__apply_forever)
+        applier.daemon = True
+        applier.start()
+        return self.__queue_event
+
+    def _connect(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.__address)
+        listener.listen(len(self.__peers) + 1)
+        accepter = threading.Thread(name="NodeListener", target=self.__accept_forever, args=(listener,))
+        accepter.daemon = True
+        accepter.start()
+        for peer in self.__peers.values():
+            peer.start()
+
+    def _publish(self, event: Dict, key: str):
+        owner = self.__ring.owner(key)
+        if owner == self.member:
+            self.__relay(event)
+        else:
+            self.__peers[owner].queue(event_payload(EVERYONE, event))
+
+    def _send(self, event: Dict, member: int):
+        self.__peers[member].queue(event_payload(member, event))
+
+    def __relay(self, event: Dict):
+        # apply an event about a user of this node here and on every other node
+        payload = event_payload(self.member, event)
+        with self.__relay_lock:
+            for peer in self.__peers.values():
+                peer.queue(payload)
+            self._received(event)
+
+    def __accept_forever(self, listener: socket.socket):
+        while True:
+            link, _ = listener.accept()
+            link.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = threading.Thread(name="NodeLink", target=self.__read_forever, args=(link,))
+            reader.daemon = True
+            reader.start()
+
+    def __read_forever(self, link: socket.socket):
+        # the frames another node sends, until it closes the link
+        # the first read, every ACK_INTERVAL frames, and the frames applied before the link
+        # is quiet for ACK_DELAY are acknowledged with the number of the last frame applied
+        decoder = FrameDecoder()
+        node = None
+        acked = -1
+        with link:
+            while True:
+                try:
+                    data = link.recv(RECV_SIZE)
+                except socket.timeout:
+                    link.settimeout(None)
+                    applied = self.__applied[node][1]
+                    try:
+                        link.sendall(SEQUENCE.pack(applied))
+                    except OSError:
+                        return
+                    acked = applied
+                    continue
+                except OSError:
+                    return
+                if not data:
+                    return
+                for payload in decoder.feed(data):
+                    if node is None:
+                        node, run = HELLO.unpack(payload)
+                        with self.__applied_lock:
+                            if self.__applied.get(node, (None, 0))[0] != run:
+                                # the node started again, its frames are numbered anew
+                                self.__applied[node] = (run, 0)
+                        continue
+                    (sequence,) = SEQUENCE.unpack_from(payload)
+                    with self.__applied_lock:
+                        if sequence <= self.__applied[node][1]:
+                            # sent again after the link dropped, applied already
+                            continue
+                        self.__applied[node] = (run, sequence)
+                        self.__handle_frame(payload[SEQUENCE.size:])
+                if node is not None:
+                    applied = self.__applied[node][1]
+                    if acked < 0 or applied - acked >= ACK_INTERVAL:
+                        try:
+                            link.sendall(SEQUENCE.pack(applied))
+                        except OSError:
+                            return
+                        acked = applied
+                    # the rest once the link is quiet, unless more frames come first
+                    link.settimeout(None if applied == acked else ACK_DELAY)
+
+    def __handle_frame(self, payload: bytes):
+        (target,) = TARGET.unpack_from(payload)
+        event = BINARY.decode(payload[TARGET.size:])
+        if target == EVERYONE:
+            # an event about a user of this node
+            self.__relay(event)
+        else:
+            self._received(event)
+
+    def __queue_event(self, callback: Callable, event: Dict):
+        with self.__events_ready:
+            self.__events.append((callback, event))
+            self.__events_ready.notify()
+
+    def __apply_forever(self):
+        while True:
+            with self.__events_ready:
+                while not self.__events:
+                    self.__events_ready.wait()
+                callback, event = self.__events.popleft()
+            callback(event)
+
+
+def parse_addresses(addresses: str) -> List[Tuple[str, int]]:
+    # "host:port,host:port" to [(host, port), (host, port)]
+    parsed = []
+    for address in addresses.split(','):
+        host, _, port = address.rpartition(':')
+        parsed.append((host or 'localhost', int(port)))
+    return parsed
@@ -0,0 +1,284 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the outbound side of client connections
+# a send never blocks the caller, bytes the kernel does not take right away are
+# queued, for the thread engine they are written later by one writer thread for
+# all connections
+# the queue of a client is bounded, a client that falls too far behind is handled
+# by the slow consumer policy instead of growing the queue forever
+
+import selectors
+import threading
+from collections import deque
+from socket import socket, socketpair, MSG_DONTWAIT, SHUT_RDWR
+from typing import Callable, Deque, Optional
+from Protocol import JSON
+from Metrics import metrics
+
+# slow consumer policies, what to do with a frame once the queue is full
+# drop: discard the frame
+# disconnect: close the connection
+# spill: hand the frame to the spill handler, e.g. to keep it as an offline message
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+SPILL = 'spill'
+POLICIES = [DROP, DISCONNECT, SPILL]
+
+SLOW_CONSUMER_FRAMES = metrics.counter('chat_slow_consumer_frames_total',
+                                       'Frames a client was too slow for, by slow consumer policy', ['policy'])
+
+
+class OutboundLimits:
+    # the bounds of the outbound queue of every connection
+    # once more than high_watermark bytes are queued, frames go to the policy
+    # until the queue is back below low_watermark
+
+    def __init__(self, high_watermark: int = 1024 * 1024, low_watermark: int = 256 * 1024,
+                 policy: str = SPILL):
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError("watermarks must satisfy 0 <= low <= high")
+        if policy not in POLICIES:
+            raise ValueError("unknown slow consumer policy " + policy)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+
+
+class Backpressure:
+    # slow consumer handling shared by the connections of both engines
+
+    def __init__(self, limits: OutboundLimits):
+        self.limits = limits
+        # frames dropped or spilled because the client was too slow
+        self.overflowed = 0
+        self.__congested = False
+        self.__spill: Optional[Callable[[bytes], None]] = None
+        self.__resume: Optional[Callable[[], None]] = None
+        self.__lost: Optional[Callable[[], None]] = None
+
+    def set_spill_handler(self, spill: Callable[[bytes], None]):
+        # spill(frame) is called with every frame that did not fit with the spill policy
+        self.__spill = spill
+
+    def set_resume_handler(self, resume: Callable[[], None]):
+        # resume() is called once a congested queue is back below the low watermark
+        self.__resume = resume
+
+    def set_lost_handler(self, lost: Callable[[], None]):
+        # lost() is called once the connection is gone, closed by either side
+        self.__lost = lost
+
+    def lost(self):
+        # called by the engine once it stops reading the connection
+        lost, self.__lost = self.__lost, None
+        if lost is not None:
+            lost()
+
+    def is_congested(self) -> bool:
+        return self.__congested
+
+    def hold(self) -> bool:
+        # if the queue is above the high watermark, take no more frames and call the resume
+        # handler once it is back below the low watermark, e.g. to send more of a backlog
+        # return False if the queue is not, and so may never call the resume handler
+        raise NotImplementedError
+
+    def _hold(self, queued: int) -> bool:
+        if queued <= self.limits.high_watermark:
+            return False
+        self.__congested = True
+        return True
+
+    def _overflows(self, queued: int) -> bool:
+        # return True if a frame must not join the queued bytes
+        # a frame is taken as long as the queue is within the high watermark, so
+        # a queue only becomes congested once it is really above it
+        if not self.__congested and queued <= self.limits.high_watermark:
+            return False
+        self.__congested = True
+        self.overflowed += 1
+        return True
+
+    def _overflow(self, data: bytes):
+        # apply the policy to a frame that did not fit, outside of any connection lock
+        if metrics.enabled:
+            SLOW_CONSUMER_FRAMES.inc(self.limits.policy)
+        if self.limits.policy == DISCONNECT:
+            self.close()
+        elif self.limits.policy == SPILL and self.__spill is not None:
+            self.__spill(data)
+
+    def _drained(self, queued: int) -> bool:
+        # return True if the queue just left the congested state
+        if self.__congested and queued <= self.limits.low_watermark:
+            self.__congested = False
+            return True
+        return False
+
+    def _resumed(self):
+        if self.__resume is not None:
+            self.__resume()
+
+    def close(self):
+        raise NotImplementedError
+
+
+class Connection(Backpressure):
+    # a client socket whose sends are queued instead of blocking
+    # the receiving side is still read by the thread of the client
+
+    def __init__(self, connection_socket: socket, writer: 'SocketWriter', limits: OutboundLimits):
+        super().__init__(limits)
+        self.__socket = connection_socket
+        self.__writer = writer
+        # the codec of every frame after the login reply, see Protocol.choose_codec
+        self.codec = JSON
+        self.__queue: Deque[memoryview] = deque()
+        self.__queued = 0
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+    def sendall(self, data: bytes):
+        # send data after everything queued before it, without waiting for the peer
+        # the same bytes object can be handed to many connections
+        with self.__lock:
+            if self.__closed:
+                return
+            overflows = self._overflows(self.__queued)
+            if not overflows:
+                if self.__queue:
+                    self.__enqueue(memoryview(data))
+                    return
+                sent = self.__send(memoryview(data))
+                if sent < len(data):
+                    self.__enqueue(memoryview(data)[sent:])
+                    self.__writer.watch(self)
+        if overflows:
+            self._overflow(data)
+
+    def queued(self) -> int:
+        # number of bytes waiting to be written
+        return self.__queued
+
+    def hold(self) -> bool:
+        with self.__lock:
+            return self._hold(self.__queued)
+
+    def getsockname(self):
+        return self.__socket.getsockname()
+
+    def fileno(self) -> int:
+        return self.__socket.fileno()
+
+    def is_closed(self) -> bool:
+        return self.__closed
+
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__queue.clear()
+            self.__queued = 0
+        self.__writer.forget(self)
+        try:
+            # wake up the thread reading the socket and tell the peer
+            self.__socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.__socket.close()
+
+    def flush(self) -> bool:
+        # write as much of the queue as the kernel takes, called by the writer thread
+        # return True once the queue is empty
+        with self.__lock:
+            while self.__queue:
+                data = self.__queue[0]
+                sent = self.__send(data)
+                if self.__closed:
+                    break
+                self.__queued -= sent
+                if sent < len(data):
+                    self.__queue[0] = data[sent:]
+                    break
+                self.__queue.popleft()
+            empty = not self.__queue
+            resumed = self._drained(self.__queued)
+        if resumed:
+            self._resumed()
+        return empty
+
+    def __enqueue(self, data: memoryview):
+        self.__queue.append(data)
+        self.__queued += len(data)
+
+    def __send(self, data: memoryview) -> int:
+        # return the number of bytes taken by the kernel, must hold the lock
+        if self.__closed:
+            return len(data)
+        try:
+            return self.__socket.send(data, MSG_DONTWAIT)
+        except BlockingIOError:
+            return 0
+        except OSError:
+            # the peer is gone, drop whatever is left
+            self.__closed = True
+            self.__queue.clear()
+            self.__queued = 0
+            return len(data)
+
+
+class SocketWriter:
+    # one thread that waits for queued connections to become writable and flushes them
+
+    def __init__(self):
+        self.__selector = selectors.DefaultSelector()
+        self.__lock = threading.Lock()
+        # connections to start or stop watching, applied by the writer thread
+        self.__to_watch: Deque[Connection] = deque()
+        self.__to_forget: Deque[Connection] = deque()
+        self.__wakeup_receiver, self.__wakeup_sender = socketpair()
+        self.__wakeup_receiver.setblocking(False)
+        self.__selector.register(self.__wakeup_receiver, selectors.EVENT_READ)
+        writer_thread = threading.Thread(name="SocketWriter", target=self.__write_forever)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def watch(self, connection: Connection):
+        # flush connection once it becomes writable
+        with self.__lock:
+            self.__to_watch.append(connection)
+            wakeup = len(self.__to_watch) + len(self.__to_forget) == 1
+        if wakeup:
+            self.__wakeup_sender.send(b'\0')
+
+    def forget(self, connection: Connection):
+        with self.__lock:
+            self.__to_forget.append(connection)
+            wakeup = len(self.__to_watch) + len(self.__to_forget) == 1
+        if wakeup:
+            self.__wakeup_sender.send(b'\0')
+
+    def __write_forever(self):
+        watched = dict()
+        while True:
+            for key, _ in self.__selector.select():
+                if key.fileobj is self.__wakeup_receiver:
+                    try:
+                        self.__wakeup_receiver.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif key.data.flush():
+                    self.__selector.unregister(key.fileobj)
+                    del watched[key.data]
+            with self.__lock:
+                to_watch, self.__to_watch = self.__to_watch, deque()
+                to_forget, self.__to_forget = self.__to_forget, deque()
+            for connection in to_forget:
+                if connection in watched:
+                    self.__selector.unregister(watched.pop(connection))
+            for connection in to_watch:
+                if connection not in watched and not connection.is_closed():
+                    watched[connection] = connection.fileno()
+                    self.__selector.register(watched[connection], selectors.EVENT_WRITE, connection)
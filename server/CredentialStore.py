@@ -0,0 +1,215 @@
+# Python 3.7
+# Author: Bofei Wang
+# Usage: python3 CredentialStore.py < credentials.txt > hashed_credentials.txt
+# coding: utf-8
+# this file contains the CredentialStore class for the UserManager to use
+# run on its own, it hashes the passwords of a credentials file
+
+import hashlib
+import hmac
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterator, Optional, Set, Tuple
+
+# work factor of the password hash, pbkdf2-hmac-sha256 rounds
+HASH_ITERATIONS = 100000
+
+# bytes of random salt per password
+SALT_SIZE = 16
+
+# a hashed password in a credentials file, e.g. pbkdf2_sha256$100000$<salt hex>$<hash hex>
+HASH_SCHEME = 'pbkdf2_sha256'
+
+# check the credentials file for changes this often, in seconds
+RELOAD_INTERVAL = 1.0
+
+# lines of the credentials file imported at a time
+IMPORT_CHUNK = 1000
+
+# a password hash with the salt and the work factor it was made with
+Credential = Tuple[bytes, bytes, int]
+
+
+def hash_password(password: str, salt: Optional[bytes] = None, iterations: int = HASH_ITERATIONS) -> Credential:
+    # return (salt, hash, iterations) of password, with a new random salt unless one is given
+    if salt is None:
+        salt = os.urandom(SALT_SIZE)
+    return salt, hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations), iterations
+
+
+def format_credential(credential: Credential) -> str:
+    # the form of a hashed password in a credentials file
+    salt, password_hash, iterations = credential
+    return '$'.join([HASH_SCHEME, str(iterations), salt.hex(), password_hash.hex()])
+
+
+def parse_credential(password: str) -> Optional[Credential]:
+    # turn a hashed password of a credentials file into (salt, hash, iterations)
+    # return None for a plain password
+    fields = password.split('$')
+    if len(fields) == 4 and fields[0] == HASH_SCHEME:
+        try:
+            return bytes.fromhex(fields[2]), bytes.fromhex(fields[3]), int(fields[1])
+        except ValueError:
+            pass
+    return None
+
+
+class CredentialStore:
+    # the salted password hashes of every user, looked up one user at a time
+    #
+    # the credentials file is imported into an indexed sqlite database next to it,
+    # only when the file changed since the last import, so a restart opens the
+    # database instead of reading every account
+    # a changed file is imported into a new database in the background, which then
+    # replaces the old one at once, logins keep using the old one meanwhile
+    # passwords are verified by a pool of worker threads, the hash releases the GIL,
+    # so neither the caller nor the other users wait for the hashing
+
+    def __init__(self, credentials_path: str, database_path: str,
+                 on_reload: Optional[Callable[[Set[str]], None]] = None):
+        # on_reload(removed) is called after a reload with the users no longer in the file
+        self.__credentials_path = credentials_path
+        self.__database_path = database_path
+        self.__on_reload = on_reload
+        self.__lock = threading.Lock()
+        self.__workers = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                            thread_name_prefix="PasswordVerifier")
+        self.__database: Optional[sqlite3.Connection] = None
+        self.__source_version = self.__version()
+        if self.__stored_version() != self.__source_version:
+            self.__import(self.__source_version)
+        self.__database = self.__open()
+        watcher = threading.Thread(name="CredentialWatcher", target=self.__watch_forever)
+        watcher.daemon = True
+        watcher.start()
+
+    def has_user(self, username: str) -> bool:
+        return self.__lookup(username) is not None
+
+    def usernames(self) -> Iterator[str]:
+        # every username, read from the database in pages
+        last = ''
+        while True:
+            with self.__lock:
+                page = [row[0] for row in self.__database.execute(
+                    'SELECT username FROM users WHERE username > ? ORDER BY username LIMIT 1000', (last,))]
+            if not page:
+                return
+            yield from page
+            last = page[-1]
+
+    def verify(self, username: str, password: str) -> Future:
+        # check password in the worker pool
+        # return a future of True if it is the password of username
+        return self.__workers.submit(self.__verify, username, password)
+
+    def __verify(self, username: str, password: str) -> bool:
+        credential = self.__lookup(username)
+        if credential is None:
+            return False
+        salt, password_hash, iterations = credential
+        return hmac.compare_digest(hash_password(password, salt, iterations)[1], password_hash)
+
+    def __lookup(self, username: str) -> Optional[Credential]:
+        with self.__lock:
+            row = self.__database.execute('SELECT salt, hash, iterations FROM users WHERE username = ?',
+                                          (username,)).fetchone()
+        return None if row is None else (row[0], row[1], row[2])
+
+    def __version(self) -> str:
+        # changes whenever the credentials file is written
+        status = os.stat(self.__credentials_path)
+        return str(status.st_mtime_ns) + ':' + str(status.st_size)
+
+    def __stored_version(self) -> Optional[str]:
+        # the version of the credentials file the database was imported from
+        if not os.path.exists(self.__database_path):
+            return None
+        try:
+            database = sqlite3.connect(self.__database_path)
+            try:
+                return database.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            finally:
+                database.close()
+        except (sqlite3.Error, TypeError):
+            return None
+
+    def __open(self) -> sqlite3.Connection:
+        # used from many threads, always under the lock
+        return sqlite3.connect(self.__database_path, check_same_thread=False)
+
+    def __import(self, version: str):
+        # build a new database from the credentials file and put it in place of the old one
+        new_path = self.__database_path + '.new'
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        database = sqlite3.connect(new_path)
+        try:
+            database.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            database.execute('CREATE TABLE users (username TEXT PRIMARY KEY, salt BLOB, hash BLOB, '
+                             'iterations INTEGER) WITHOUT ROWID')
+            with open(self.__credentials_path, 'r') as credential_file:
+                while True:
+                    lines = list(islice(credential_file, IMPORT_CHUNK))
+                    if not lines:
+                        break
+                    chunk = [line.split() for line in lines if line.strip()]
+                    database.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+                                         self.__parse_chunk(chunk))
+            database.execute("INSERT INTO meta VALUES ('version', ?)", (version,))
+            database.commit()
+        finally:
+            database.close()
+        os.replace(new_path, self.__database_path)
+
+    def __parse_chunk(self, chunk) -> list:
+        # return (username, salt, hash, iterations) of every [username, password] line
+        # plain passwords are hashed by the worker pool, many at a time
+        credentials = [parse_credential(password) for _, password in chunk]
+        hashing = [(position, self.__workers.submit(hash_password, chunk[position][1]))
+                   for position, credential in enumerate(credentials) if credential is None]
+        for position, future in hashing:
+            credentials[position] = future.result()
+        return [(username,) + credential for (username, _), credential in zip(chunk, credentials)]
+
+    def __watch_forever(self):
+        while True:
+            time.sleep(RELOAD_INTERVAL)
+            try:
+                version = self.__version()
+            except OSError:
+                # e.g. the file is being replaced, look again later
+                continue
+            if version == self.__source_version:
+                continue
+            try:
+                self.__reload(version)
+                self.__source_version = version
+            except (OSError, ValueError, sqlite3.Error) as error:
+                # keep the credentials loaded so far, try again on the next look
+                print("ERROR: reloading credentials.txt failed:", error)
+
+    def __reload(self, version: str):
+        old_users = set(self.usernames())
+        self.__import(version)
+        database = self.__open()
+        with self.__lock:
+            self.__database, old_database = database, self.__database
+        old_database.close()
+        removed = old_users.difference(self.usernames())
+        if self.__on_reload is not None:
+            self.__on_reload(removed)
+
+
+if __name__ == '__main__':
+    # hash the passwords of a credentials file, so it can be kept without plain passwords
+    for line in sys.stdin:
+        if line.strip():
+            name, secret = line.split()
+            print(name, format_credential(parse_credential(secret) or hash_password(secret)))
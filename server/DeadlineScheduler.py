@@ -0,0 +1,66 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the DeadlineScheduler class for the server to use
+
+import heapq
+from itertools import count
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+class DeadlineScheduler:
+    # keep at most one deadline per key in a min-heap, so the next event to
+    # fire is always on top and scheduling or firing an event is O(log n)
+    # rescheduled and cancelled keys leave stale entries in the heap, they are
+    # skipped when they reach the top and purged when they pile up
+
+    def __init__(self):
+        self.__heap: List[Tuple[float, int, Hashable]] = []
+        self.__deadlines: Dict[Hashable, float] = dict()
+        # breaks ties between equal deadlines so keys are never compared
+        self.__counter = count()
+
+    def schedule(self, key: Hashable, deadline: float):
+        # fire key at deadline, replacing any deadline the key already has
+        self.__deadlines[key] = deadline
+        heapq.heappush(self.__heap, (deadline, next(self.__counter), key))
+        if len(self.__heap) > 2 * len(self.__deadlines) + 64:
+            self.__purge()
+
+    def cancel(self, key: Hashable):
+        self.__deadlines.pop(key, None)
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        return self.__deadlines.get(key)
+
+    def next_deadline(self) -> Optional[float]:
+        # return the earliest live deadline, None if nothing is scheduled
+        self.__drop_stale()
+        if self.__heap:
+            return self.__heap[0][0]
+        return None
+
+    def pop_due(self, now: float) -> List[Hashable]:
+        # remove and return every key whose deadline is not after now
+        due = []
+        while self.__heap and self.__heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self.__heap)
+            if self.__deadlines.get(key) == deadline:
+                del self.__deadlines[key]
+                due.append(key)
+        return due
+
+    def __len__(self):
+        return len(self.__deadlines)
+
+    def __drop_stale(self):
+        while self.__heap:
+            deadline, _, key = self.__heap[0]
+            if self.__deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self.__heap)
+
+    def __purge(self):
+        # rebuild the heap from the live deadlines only
+        self.__heap = [(deadline, next(self.__counter), key) for key, deadline in self.__deadlines.items()]
+        heapq.heapify(self.__heap)
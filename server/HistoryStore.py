@@ -0,0 +1,260 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the HistoryStore class for the server to use
+
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, Optional, Tuple
+from Protocol import FLOAT_FORMAT, HEADER, encode_frame, read_string, write_string
+
+# start a new segment once the active one is this large
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# most segments kept, the oldest one is deleted when a new one would be one too many, so the
+# history keeps the last 1 GiB or so of messages
+MAX_SEGMENTS = 64
+
+# positions copied at once by a reader, which reads them from disk without the lock
+READ_CHUNK = 64
+
+# wait this long for more writes before writing the log to disk, so one fsync commits a group of writes
+FSYNC_INTERVAL = 0.1
+
+# the receiver of a broadcast, and the conversation every broadcast is in
+BROADCAST = ''
+
+# a position in the log: segment << POSITION_BITS | offset
+POSITION_BITS = 32
+
+
+class HistoryStore:
+    # keep every message and broadcast sent, so a conversation can be read back later
+    #
+    # messages are appended to segment files in directory, each record a frame of
+    #   the time sent, a float, then the sender, the receiver and the message as strings
+    # a broadcast has BROADCAST as its receiver
+    # only the time and the position of every message are kept in memory, by conversation,
+    # so finding where a page starts is a binary search and only the page is read from disk
+    # like the MessageStore, a background thread commits the writes in groups, the sender
+    # of a message never waits for the disk
+    # at most max_segments segments are kept, older messages are deleted with their segment
+    # a cursor counts the messages of a conversation from its first one, deleted or not, so
+    # the cursors handed out stay valid
+
+    def __init__(self, directory: str, max_segments: int = MAX_SEGMENTS):
+        self.__directory = directory
+        self.__max_segments = max_segments
+        # conversation to the times and the positions of its messages, oldest first
+        self.__times: Dict[Tuple[str, str], array] = dict()
+        self.__positions: Dict[Tuple[str, str], array] = dict()
+        # conversation to the number of its messages deleted, the cursor of its first one kept
+        self.__deleted: Dict[Tuple[str, str], int] = dict()
+        self.__first_segment = 1
+        self.__segment = 0
+        self.__segment_size = 0
+        self.__file = None
+        self.__lock = threading.Lock()
+        self.__dirty = threading.Condition(self.__lock)
+        self.__unsynced = False
+        os.makedirs(directory, exist_ok=True)
+        self.__replay()
+        if self.__segment:
+            # keep appending to the last segment, its torn tail is already cut off
+            self.__segment_size = os.path.getsize(self.__path(self.__segment))
+            self.__file = open(self.__path(self.__segment), 'ab')
+        else:
+            self.__open_segment(1)
+        while self.__segment - self.__first_segment >= self.__max_segments:
+            self.__delete_oldest()
+        flusher = threading.Thread(name="HistoryStoreFlusher", target=self.__flush_forever)
+        flusher.daemon = True
+        flusher.start()
+
+    def append(self, sent: float, from_user: str, to_user: str, message: str):
+        # record a message sent at time sent, to_user is BROADCAST for a broadcast
+        record = bytearray(FLOAT_FORMAT.pack(sent))
+        write_string(record, from_user)
+        write_string(record, to_user)
+        write_string(record, message)
+        frame = encode_frame(bytes(record))
+        with self.__lock:
+            position = self.__segment << POSITION_BITS | self.__segment_size
+            self.__file.write(frame)
+            self.__segment_size += len(frame)
+            if not self.__unsynced:
+                self.__unsynced = True
+                self.__dirty.notify()
+            self.__index(conversation(from_user, to_user), sent, position)
+            if self.__segment_size >= SEGMENT_SIZE:
+                os.fsync(self.__file.fileno())
+                self.__file.close()
+                self.__open_segment(self.__segment + 1)
+                if self.__segment - self.__first_segment >= self.__max_segments:
+                    self.__delete_oldest()
+
+    def read(self, user: str, other: str, before: Optional[int] = None,
+             since: float = 0.0) -> Iterator[Tuple[int, float, str, str]]:
+        # yield (cursor, time, from_user, message) of the messages between user and other,
+        # other is BROADCAST for every broadcast, newest first, from the message before
+        # cursor before, or the newest, down to the first sent at since or later
+        # a message is read from disk when it is asked for, the messages deleted meanwhile
+        # end the iteration
+        key = conversation(user, other)
+        with self.__lock:
+            if key not in self.__times:
+                return
+            # a reader opens the segment on its own, it must see every write
+            self.__file.flush()
+            times = self.__times[key]
+            deleted = self.__deleted[key]
+            end = len(times) if before is None else max(0, min(before - deleted, len(times)))
+            start = deleted + bisect_left(times, since, 0, end)
+            end += deleted
+        opened = 0
+        segment_file = None
+        try:
+            while end > start:
+                with self.__lock:
+                    # the oldest segment may be deleted while the ones copied are read
+                    deleted = self.__deleted.get(key)
+                    if deleted is None or end <= deleted:
+                        return
+                    first = max(start, deleted, end - READ_CHUNK)
+                    positions = self.__positions[key][first - deleted:end - deleted]
+                for cursor in range(end - 1, first - 1, -1):
+                    position = positions[cursor - first]
+                    segment = position >> POSITION_BITS
+                    if segment != opened:
+                        if segment_file is not None:
+                            segment_file.close()
+                        try:
+                            segment_file = open(self.__path(segment), 'rb')
+                        except FileNotFoundError:
+                            return
+                        opened = segment
+                    segment_file.seek(position & ((1 << POSITION_BITS) - 1))
+                    (length,) = HEADER.unpack(segment_file.read(HEADER.size))
+                    sent, from_user, _, message = decode_record(segment_file.read(length))
+                    yield cursor, sent, from_user, message
+                end = first
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+
+    def sync(self):
+        # write everything to disk now
+        with self.__lock:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__unsynced = False
+
+    def __len__(self):
+        with self.__lock:
+            return sum(len(times) for times in self.__times.values())
+
+    def __path(self, segment: int) -> str:
+        return os.path.join(self.__directory, 'history-%08d.log' % segment)
+
+    def __open_segment(self, segment: int):
+        self.__segment = segment
+        self.__segment_size = 0
+        self.__file = open(self.__path(segment), 'ab')
+
+    def __index(self, key: Tuple[str, str], sent: float, position: int):
+        if key not in self.__times:
+            self.__times[key] = array('d')
+            self.__positions[key] = array('q')
+            self.__deleted[key] = 0
+        times = self.__times[key]
+        if times and sent < times[-1]:
+            # the clock went back, keep the times sorted for the binary search
+            sent = times[-1]
+        times.append(sent)
+        self.__positions[key].append(position)
+
+    def __delete_oldest(self):
+        # delete the oldest segment and forget its messages, the caller holds the lock
+        # a conversation with none left is forgotten with its cursors
+        end = (self.__first_segment + 1) << POSITION_BITS
+        for key in list(self.__positions):
+            positions = self.__positions[key]
+            count = bisect_left(positions, end)
+            if count == len(positions):
+                del self.__times[key], self.__positions[key], self.__deleted[key]
+            elif count:
+                del self.__times[key][:count], positions[:count]
+                self.__deleted[key] += count
+        try:
+            os.remove(self.__path(self.__first_segment))
+        except FileNotFoundError:
+            pass
+        self.__first_segment += 1
+
+    def __flush_forever(self):
+        while True:
+            with self.__lock:
+                while not self.__unsynced:
+                    self.__dirty.wait()
+            # let more writes join this commit
+            time.sleep(FSYNC_INTERVAL)
+            with self.__lock:
+                self.__file.flush()
+                self.__unsynced = False
+                file_descriptor = os.dup(self.__file.fileno())
+            # fsync without the lock, writers keep appending meanwhile
+            try:
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+
+    def __replay(self):
+        # rebuild the index from the segments left by the last run
+        segments = sorted(int(name[len('history-'):-len('.log')]) for name in os.listdir(self.__directory)
+                          if name.startswith('history-') and name.endswith('.log'))
+        if segments:
+            self.__first_segment = segments[0]
+        for segment in segments:
+            self.__segment = segment
+            path = self.__path(segment)
+            with open(path, 'rb') as segment_file:
+                data = segment_file.read()
+            offset = 0
+            while len(data) - offset >= HEADER.size:
+                (length,) = HEADER.unpack_from(data, offset)
+                end = offset + HEADER.size + length
+                if end > len(data):
+                    break
+                try:
+                    sent, from_user, to_user, _ = decode_record(data[offset + HEADER.size:end])
+                except (IndexError, UnicodeDecodeError):
+                    break
+                self.__index(conversation(from_user, to_user), sent, segment << POSITION_BITS | offset)
+                offset = end
+            if offset < len(data):
+                # a record torn by a crash in the middle of a write is cut off
+                with open(path, 'r+b') as segment_file:
+                    segment_file.truncate(offset)
+
+
+def conversation(user: str, other: str) -> Tuple[str, str]:
+    # the key of the messages between two users either way, or of every broadcast
+    if other == BROADCAST:
+        return BROADCAST, BROADCAST
+    return (user, other) if user < other else (other, user)
+
+
+def decode_record(record: bytes) -> Tuple[float, str, str, str]:
+    # the time, sender, receiver and message of a record
+    if len(record) < FLOAT_FORMAT.size:
+        raise IndexError("record out of range")
+    (sent,) = FLOAT_FORMAT.unpack_from(record, 0)
+    from_user, offset = read_string(record, FLOAT_FORMAT.size)
+    to_user, offset = read_string(record, offset)
+    message, offset = read_string(record, offset)
+    if offset != len(record):
+        raise IndexError("trailing bytes in record")
+    return sent, from_user, to_user, message
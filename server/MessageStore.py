@@ -0,0 +1,292 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the MessageStore class for the server to use
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from Protocol import HEADER, encode_frame
+
+# start a new segment once the active one is this large
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# wait this long for more writes before an fsync, so one fsync commits a group of writes
+FSYNC_INTERVAL = 0.01
+
+# copy the live messages of the oldest segment forward once this few of its records are live
+COMPACT_RATIO = 0.25
+
+
+class MessageStore:
+    # keep messages sent to offline users until they log in
+    # every recipient has its own queue, so delivering the backlog of a user
+    # costs the size of that backlog only
+    #
+    # messages are appended to segment files in directory, so they survive a restart
+    # a segment is a sequence of frames, each frame is a json record of either
+    #   {'op': 'push', 'id', 'from_user', 'to_user', 'message'} a queued message
+    #   {'op': 'done', 'to_user', 'upto'} messages up to id upto were delivered
+    # only the location of a queued message is kept in memory, and a segment is
+    # deleted once none of its messages is waiting any more
+
+    def __init__(self, directory: str):
+        self.__directory = directory
+        # recipient to (id, segment, offset) of every queued message, oldest first
+        self.__index: Dict[str, Deque[Tuple[int, int, int]]] = dict()
+        # segment to the number of its messages still queued
+        self.__live: Dict[int, int] = dict()
+        # segment to the number of messages ever written to it
+        self.__written: Dict[int, int] = dict()
+        # segment to the recipients that have messages in it
+        self.__recipients: Dict[int, Set[str]] = dict()
+        self.__next_id = 1
+        self.__segment = 0
+        self.__segment_size = 0
+        self.__file = None
+        self.__lock = threading.Lock()
+        # group commit: writers mark the log dirty, one thread fsyncs for all of them
+        self.__dirty = threading.Condition(self.__lock)
+        self.__unsynced = False
+        os.makedirs(directory, exist_ok=True)
+        self.__replay()
+        if self.__segment:
+            # keep appending to the last segment, its torn tail is already cut off
+            self.__segment_size = os.path.getsize(self.__path(self.__segment))
+            self.__file = open(self.__path(self.__segment), 'ab')
+        else:
+            self.__open_segment(1)
+        self.__delete_delivered_segments()
+        flusher = threading.Thread(name="MessageStoreFlusher", target=self.__flush_forever)
+        flusher.daemon = True
+        flusher.start()
+
+    def push(self, from_user: str, to_user: str, message: str):
+        # queue a message for to_user
+        with self.__lock:
+            message_id = self.__next_id
+            self.__next_id += 1
+            offset = self.__append({
+                'op': 'push',
+                'id': message_id,
+                'from_user': from_user,
+                'to_user': to_user,
+                'message': message
+            })
+            if to_user not in self.__index:
+                self.__index[to_user] = deque()
+            self.__index[to_user].append((message_id, self.__segment, offset))
+            self.__add_live(self.__segment, to_user)
+            self.__written[self.__segment] += 1
+            self.__roll_if_full()
+
+    def drain(self, to_user: str, limit: Optional[int] = None) -> List[Dict]:
+        # remove and return the messages queued for to_user, oldest first, at most limit of them
+        with self.__lock:
+            if to_user not in self.__index:
+                return []
+            if limit is None or limit >= len(self.__index[to_user]):
+                locations = self.__index.pop(to_user)
+            else:
+                queued = self.__index[to_user]
+                locations = [queued.popleft() for _ in range(limit)]
+            self.__file.flush()
+            messages = self.__read_all(locations)
+            self.__append({'op': 'done', 'to_user': to_user, 'upto': locations[-1][0]})
+            # a segment still holding messages of to_user keeps it as a recipient
+            left = {segment for _, segment, _ in self.__index.get(to_user, ())}
+            for _, segment, _ in locations:
+                self.__live[segment] -= 1
+                if segment not in left:
+                    self.__recipients[segment].discard(to_user)
+            self.__delete_delivered_segments()
+            self.__roll_if_full()
+            return [{
+                'from_user': message['from_user'],
+                'to_user': message['to_user'],
+                'message': message['message']
+            } for message in messages]
+
+    def pending(self, to_user: str) -> int:
+        # number of messages queued for to_user
+        with self.__lock:
+            if to_user not in self.__index:
+                return 0
+            return len(self.__index[to_user])
+
+    def sync(self):
+        # write everything to disk now
+        with self.__lock:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__unsynced = False
+
+    def __len__(self):
+        with self.__lock:
+            return sum(len(locations) for locations in self.__index.values())
+
+    def __path(self, segment: int) -> str:
+        return os.path.join(self.__directory, 'segment-%08d.log' % segment)
+
+    def __open_segment(self, segment: int):
+        self.__segment = segment
+        self.__segment_size = 0
+        self.__live[segment] = 0
+        self.__written[segment] = 0
+        self.__recipients[segment] = set()
+        self.__file = open(self.__path(segment), 'ab')
+
+    def __append(self, record: Dict) -> int:
+        # append a record to the active segment and return its offset
+        # it reaches the disk with the next group commit
+        offset = self.__segment_size
+        frame = encode_frame(json.dumps(record).encode())
+        self.__file.write(frame)
+        self.__segment_size += len(frame)
+        if not self.__unsynced:
+            self.__unsynced = True
+            self.__dirty.notify()
+        return offset
+
+    def __read_all(self, locations) -> List[Dict]:
+        # read the records at (id, segment, offset) locations, opening each segment once
+        records = []
+        segment_file = None
+        opened = 0
+        try:
+            for _, segment, offset in locations:
+                if segment != opened:
+                    if segment_file is not None:
+                        segment_file.close()
+                    segment_file = open(self.__path(segment), 'rb')
+                    opened = segment
+                segment_file.seek(offset)
+                (length,) = HEADER.unpack(segment_file.read(HEADER.size))
+                records.append(json.loads(segment_file.read(length).decode()))
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+        return records
+
+    def __add_live(self, segment: int, to_user: str):
+        self.__live[segment] += 1
+        self.__recipients[segment].add(to_user)
+
+    def __roll_if_full(self):
+        if self.__segment_size < SEGMENT_SIZE:
+            return
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__file.close()
+        self.__open_segment(self.__segment + 1)
+        self.__compact_oldest()
+
+    def __compact_oldest(self):
+        # a few undelivered messages would keep the oldest segment alive forever,
+        # so copy them to the active segment once most of it is delivered
+        while True:
+            oldest = min(self.__live)
+            if oldest == self.__segment or self.__live[oldest] > COMPACT_RATIO * self.__written[oldest]:
+                return
+            self.__copy_forward(oldest)
+
+    def __copy_forward(self, oldest: int):
+        for to_user in self.__recipients[oldest]:
+            locations = self.__index[to_user]
+            for position, location in enumerate(locations):
+                if location[1] == oldest:
+                    record = self.__read_all([location])[0]
+                    locations[position] = (location[0], self.__segment, self.__append(record))
+                    self.__add_live(self.__segment, to_user)
+                    self.__written[self.__segment] += 1
+        # the copies must be on disk before the originals go away
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__live[oldest] = 0
+        self.__recipients[oldest] = set()
+        self.__delete_delivered_segments()
+
+    def __delete_delivered_segments(self):
+        # delete from the oldest segment only, a done record must not be deleted
+        # while the messages it marks as delivered are still on disk
+        while True:
+            oldest = min(self.__live)
+            if oldest == self.__segment or self.__live[oldest] > 0:
+                return
+            os.remove(self.__path(oldest))
+            del self.__live[oldest]
+            del self.__written[oldest]
+            del self.__recipients[oldest]
+
+    def __flush_forever(self):
+        while True:
+            with self.__lock:
+                while not self.__unsynced:
+                    self.__dirty.wait()
+            # let more writes join this commit
+            time.sleep(FSYNC_INTERVAL)
+            with self.__lock:
+                self.__file.flush()
+                self.__unsynced = False
+                file_descriptor = os.dup(self.__file.fileno())
+            # fsync without the lock, writers keep appending meanwhile
+            try:
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+
+    def __replay(self):
+        # rebuild the index from the segments left by the last run
+        segments = sorted(int(name[len('segment-'):-len('.log')]) for name in os.listdir(self.__directory)
+                          if name.startswith('segment-') and name.endswith('.log'))
+        # recipient to message id to (segment, offset), and recipient to delivered id
+        queued: Dict[str, Dict[int, Tuple[int, int]]] = dict()
+        delivered: Dict[str, int] = dict()
+        for segment in segments:
+            self.__live[segment] = 0
+            self.__written[segment] = 0
+            self.__recipients[segment] = set()
+            self.__segment = segment
+            for offset, record in self.__read_segment(segment):
+                to_user = record['to_user']
+                if record['op'] == 'push':
+                    self.__written[segment] += 1
+                    self.__next_id = max(self.__next_id, record['id'] + 1)
+                    if record['id'] > delivered.get(to_user, 0):
+                        # a message copied forward replaces its older copy
+                        queued.setdefault(to_user, dict())[record['id']] = (segment, offset)
+                elif record['op'] == 'done':
+                    delivered[to_user] = max(delivered.get(to_user, 0), record['upto'])
+                    messages = queued.get(to_user, dict())
+                    for message_id in [message_id for message_id in messages if message_id <= record['upto']]:
+                        del messages[message_id]
+        for to_user, messages in queued.items():
+            if messages:
+                self.__index[to_user] = deque((message_id,) + messages[message_id] for message_id in sorted(messages))
+                for _, segment, _ in self.__index[to_user]:
+                    self.__add_live(segment, to_user)
+
+    def __read_segment(self, segment: int):
+        # yield (offset, record) of every complete record of a segment
+        # a record torn by a crash in the middle of a write is cut off
+        path = self.__path(segment)
+        with open(path, 'rb') as segment_file:
+            data = segment_file.read()
+        offset = 0
+        while len(data) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + length
+            if end > len(data):
+                break
+            try:
+                record = json.loads(data[offset + HEADER.size:end].decode())
+            except ValueError:
+                break
+            yield offset, record
+            offset = end
+        if offset < len(data):
+            with open(path, 'r+b') as segment_file:
+                segment_file.truncate(offset)
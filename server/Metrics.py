@@ -0,0 +1,199 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the counters and histograms of the server, in the prometheus text format
+# metrics are off unless the server is started with --metrics-port, and while they are off
+# the instrumented code only checks metrics.enabled
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# upper bounds of the histogram buckets, in seconds, from 10 us to 1 s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    # {name="value",...} or nothing without labels
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    # a value that only goes up, one per combination of label values
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.__values: Dict[Tuple, float] = dict()
+        self.__lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s counter' % self.name]
+        with self.__lock:
+            values = list(self.__values.items())
+        for label_values, value in values:
+            lines.append('%s%s %s' % (self.name, format_labels(self.label_names, label_values), repr(value)))
+        return lines
+
+
+class Histogram:
+    # how many observations fell into each bucket, one histogram per combination of label values
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.__buckets = tuple(buckets)
+        # label values to [count per bucket..., count above the last bucket, sum]
+        self.__series: Dict[Tuple, List[float]] = dict()
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self.__lock:
+            series = self.__series.get(label_values)
+            if series is None:
+                series = self.__series[label_values] = [0] * (len(self.__buckets) + 2)
+            series[bisect_left(self.__buckets, value)] += 1
+            series[-1] += value
+
+    def time(self, *label_values) -> 'Timer':
+        # context manager observing how long its block took
+        return Timer(self, label_values)
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        with self.__lock:
+            series = [(label_values, list(counts)) for label_values, counts in self.__series.items()]
+        for label_values, counts in series:
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket = format_labels(self.label_names, label_values,
+                                       'le="%s"' % ('+Inf' if bound == float('inf') else repr(bound)))
+                lines.append('%s_bucket%s %d' % (self.name, bucket, cumulative))
+            labels = format_labels(self.label_names, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels, repr(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Timer:
+    # observe the time spent in a with block
+
+    def __init__(self, histogram: Histogram, label_values: Tuple):
+        self.__histogram = histogram
+        self.__label_values = label_values
+        self.__start = 0.0
+
+    def __enter__(self):
+        self.__start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.__histogram.observe(perf_counter() - self.__start, *self.__label_values)
+
+
+class Gauge:
+    # a value read when the metrics are scraped, e.g. the number of online users
+
+    def __init__(self, name: str, description: str, read: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.__read = read
+
+    def render(self) -> List[str]:
+        return ['# HELP %s %s' % (self.name, self.description), '# TYPE %s gauge' % self.name,
+                '%s %s' % (self.name, repr(self.__read()))]
+
+
+class TimedLock:
+    # a lock that observes how long it took to get it
+
+    def __init__(self, lock, histogram: Histogram, *label_values):
+        self.__lock = lock
+        self.__histogram = histogram
+        self.__label_values = label_values
+
+    def __enter__(self):
+        start = perf_counter()
+        self.__lock.acquire()
+        self.__histogram.observe(perf_counter() - start, *self.__label_values)
+        return self
+
+    def __exit__(self, *_):
+        self.__lock.release()
+
+
+class Metrics:
+    # every metric of the server
+    # the instrumented code checks enabled before touching a metric, so turned off
+    # they cost one attribute lookup
+
+    def __init__(self):
+        self.enabled = False
+        self.__metrics = []
+
+    def counter(self, name: str, description: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.__add(Counter(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__add(Histogram(name, description, label_names, buckets))
+
+    def gauge(self, name: str, description: str, read: Callable[[], float]) -> Gauge:
+        return self.__add(Gauge(name, description, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, pages: Optional[Dict[str, Callable[[], str]]] = None):
+        # turn the metrics on and serve them at http://localhost:port/metrics from a thread
+        # pages maps more paths to functions returning their text
+        self.enabled = True
+        routes = {'/metrics': self.render}
+        routes.update(pages or dict())
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in routes:
+                    self.send_error(404)
+                    return
+                body = routes[self.path]().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        http_server = ThreadingHTTPServer(('localhost', port), MetricsHandler)
+        http_server.daemon_threads = True
+        server_thread = threading.Thread(name="MetricsServer", target=http_server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def __add(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+
+# the metrics of this process
+metrics = Metrics()
@@ -0,0 +1,115 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains a sampling profiler for the server
+# a thread takes the stacks of every other thread at a fixed interval, and counts
+# them in the folded format of flamegraph.pl, one line per distinct stack:
+#     message;handle_request (server.py:360);...;sendall (Connection.py:116) 42
+# the first element of a stack is the action the thread was handling, or "no request"
+
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+# seconds between two samples
+SAMPLE_INTERVAL = 0.005
+
+# the root of a stack sampled outside of any request
+NO_REQUEST = 'no request'
+
+
+def describe_frame(frame) -> str:
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    # samples the stacks of every thread while running
+    # a thread tells the profiler which action it handles with enter() and leave(),
+    # callers check running first, so a stopped profiler costs one attribute lookup
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.running = False
+        self.__interval = interval
+        # folded stack to number of samples
+        self.__stacks: Dict[str, int] = dict()
+        self.__samples = 0
+        # thread ident to the action the thread is handling
+        self.__actions: Dict[int, str] = dict()
+        self.__lock = threading.Lock()
+        self.__sampler: Optional[threading.Thread] = None
+
+    def start(self):
+        # start sampling, the samples of an earlier run are kept
+        with self.__lock:
+            if self.running:
+                return
+            self.running = True
+            self.__sampler = threading.Thread(name="Profiler", target=self.__sample_forever)
+            self.__sampler.daemon = True
+            self.__sampler.start()
+
+    def stop(self):
+        with self.__lock:
+            self.running = False
+
+    def toggle(self) -> bool:
+        # start if stopped, stop if running, return True if it is running now
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def enter(self, action: str):
+        # the calling thread starts handling action
+        self.__actions[threading.get_ident()] = action
+
+    def leave(self):
+        # the calling thread is done with its action
+        self.__actions.pop(threading.get_ident(), None)
+
+    def folded(self) -> str:
+        # the samples so far, one "stack count" line per distinct stack
+        with self.__lock:
+            stacks = sorted(self.__stacks.items())
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+    def dump(self, path: str) -> int:
+        # write the samples so far to path, then start counting from zero
+        # return the number of samples written
+        with self.__lock:
+            stacks, self.__stacks = self.__stacks, dict()
+            samples, self.__samples = self.__samples, 0
+        with open(path, 'w') as profile_file:
+            profile_file.writelines('%s %d\n' % (stack, count) for stack, count in sorted(stacks.items()))
+        return samples
+
+    def __sample_forever(self):
+        own_ident = threading.get_ident()
+        # a restarted profiler has a new sampler, this one stops
+        while self.running and self.__sampler is threading.current_thread():
+            frames = sys._current_frames()
+            actions = dict(self.__actions)
+            sampled = []
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(describe_frame(frame))
+                    frame = frame.f_back
+                stack.append(actions.get(ident, NO_REQUEST))
+                sampled.append(';'.join(reversed(stack)))
+            del frames
+            with self.__lock:
+                for stack in sampled:
+                    self.__stacks[stack] = self.__stacks.get(stack, 0) + 1
+                self.__samples += 1
+            time.sleep(self.__interval)
+
+
+# the profiler of this process
+profiler = SamplingProfiler()
@@ -0,0 +1,97 @@
+# Python 3.7
+# Author: Bofei Wang
+# coding: utf-8
+# this file contains the Session class for the server to use
+# a client that asks for acks at login gets a session: every message pushed to it is numbered,
+# the client acknowledges what it has read, and a client whose connection drops resumes the
+# session on a new connection with its token, getting only the messages it did not read
+
+import hmac
+import secrets
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+from Protocol import Codec, encode_message
+
+# most messages kept for a session until the client acknowledges them
+REPLAY_LIMIT = 1000
+
+
+class Session:
+    # the numbered messages sent to a user, and the ones it did not acknowledge yet
+    # a message is numbered and written to the connection under lock, so the numbers
+    # reach the client in order, hold lock to number several messages sent together
+
+    def __init__(self, username: str, limit: int = REPLAY_LIMIT):
+        self.username = username
+        self.token = secrets.token_urlsafe(16)
+        # reentrant, a frame spilled by the connection while sending comes back to forget
+        self.lock = threading.RLock()
+        self.__limit = limit
+        self.__next_seq = 1
+        # (seq, message) of every message sent and not acknowledged, oldest first
+        self.__unacked: Deque[Tuple[int, Dict]] = deque()
+        # seq of the messages pushed out of the buffer before they were acknowledged
+        self.__evicted: Deque[int] = deque()
+
+    def is_token(self, token: str) -> bool:
+        return hmac.compare_digest(self.token, token)
+
+    def send(self, connection, message: Dict):
+        # number message and send it on connection
+        with self.lock:
+            connection.sendall(self.frame(message, connection.codec))
+
+    def keep(self, message: Dict):
+        # number message without sending it, the connection is down, it is sent on resume
+        with self.lock:
+            self.__number(message)
+
+    def frame(self, message: Dict, codec: Codec) -> bytes:
+        # number message and return its frame, the caller holds lock and sends it
+        with self.lock:
+            return encode_message(dict(message, seq=self.__number(message)), codec)
+
+    def __number(self, message: Dict) -> int:
+        # keep message until it is acknowledged and return its seq, the caller holds lock
+        seq = self.__next_seq
+        self.__next_seq += 1
+        self.__unacked.append((seq, message))
+        if len(self.__unacked) > self.__limit:
+            # the client has not read this many, it can no longer be resent
+            self.__evicted.append(self.__unacked.popleft()[0])
+            if len(self.__evicted) > self.__limit:
+                self.__evicted.popleft()
+        return seq
+
+    def ack(self, seq: int):
+        # the client read every message up to seq
+        with self.lock:
+            while self.__unacked and self.__unacked[0][0] <= seq:
+                self.__unacked.popleft()
+            while self.__evicted and self.__evicted[0] <= seq:
+                self.__evicted.popleft()
+
+    def forget(self, seq: int):
+        # the message seq was not sent after all, e.g. spilled as an offline message
+        with self.lock:
+            for position, (unacked_seq, _) in enumerate(self.__unacked):
+                if unacked_seq == seq:
+                    del self.__unacked[position]
+                    return
+
+    def replay(self, seq: int, codec: Codec) -> Tuple[List[bytes], int]:
+        # the client read every message up to seq, return the frames of the messages after
+        # it and the number of those that can not be resent, the caller holds lock
+        with self.lock:
+            self.ack(seq)
+            missed = sum(1 for evicted in self.__evicted if evicted > seq)
+            return [encode_message(dict(message, seq=unacked_seq), codec)
+                    for unacked_seq, message in self.__unacked], missed
+
+    def take_unacked(self) -> List[Dict]:
+        # end the session, return the messages the client did not acknowledge, oldest first
+        with self.lock:
+            messages = [message for _, message in self.__unacked]
+            self.__unacked.clear()
+            return messages
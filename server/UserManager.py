@@ -3,45 +3,157 @@
 # coding: utf-8
 # this file contains the UserManager class for the server to use
 
-from typing import Dict, Set
+import threading
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future
+from typing import Dict, List, Set, Optional
 from time import time
+from DeadlineScheduler import DeadlineScheduler
+from CredentialStore import CredentialStore
+
+# number of locks the users are spread over
+LOCK_STRIPES = 64
+
+# the credentials of every user, and the index of them kept by the CredentialStore
+CREDENTIALS_FILE = "credentials.txt"
+CREDENTIALS_DATABASE = "credentials.db"
 
 
 class UserManager:
     # manage all user data, including credentials, block status,
     # user-to-user block status, time out, online status,
     # and last login status
-
-    def __init__(self, block_duration: int, time_out: int):
+    #
+    # it is safe to use from many threads, there is no lock for all of it:
+    # - the state of a user is guarded by one of LOCK_STRIPES locks, picked by username,
+    #   callers hold user_lock(username) to make several calls about a user atomic
+    # - the online users, the block index and the deadlines have a lock each,
+    #   only held for a few set or heap operations
+    # locks are taken in that order: user, online users, block index, deadlines,
+    # and a thread holds the locks of several users only if it took them all at once,
+    # in the order user_locks gives them
+    # lookups of a single key in a dict or a set need no lock
+    #
+    # passwords are kept as salted hashes by a CredentialStore, and a user is only
+    # loaded into the user map the first time it tries to log in
+
+    def __init__(self, block_duration: int, time_out: int, credentials_database: str = CREDENTIALS_DATABASE):
+        # every user loaded so far
         self.__user_map: Dict[str, UserManager.__User] = dict()
         self.__address_to_username_map: Dict[str, str] = dict()
         self.__username_to_address_map: Dict[str, str] = dict()
+        # every user currently logged in, kept up to date on login, logout and time out
+        self.__online_users: Set[str] = set()
+        # users who ever logged in, ordered by the time of their last login
+        # two parallel lists, so the users logged in since a time are one bisect away
+        self.__login_times: List[int] = []
+        self.__login_names: List[str] = []
+        # reverse of the block lists, username to the users who blocked that user
+        self.__blocked_by: Dict[str, Set[str]] = dict()
         self.__block_duration: int = block_duration
         self.__time_out: int = time_out
-        self.__read_credentials()
-
-    def __read_credentials(self):
+        # fires session time outs and the end of login blocks
+        # keys are ('timeout', username) and ('unblock', username)
+        self.__scheduler = DeadlineScheduler()
+        self.__user_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self.__online_lock = threading.Lock()
+        self.__block_lock = threading.Lock()
+        # notified whenever a deadline is scheduled, see wait_until_due
+        self.__scheduler_condition = threading.Condition()
         try:
-            with open("credentials.txt", "r") as credential_file:
-                for credential in credential_file:
-                    username, password = credential.strip().split()
-                    self.__user_map[username] = UserManager.__User(username, password,
-                                                                   self.__block_duration,
-                                                                   self.__time_out)
+            self.__credentials = CredentialStore(CREDENTIALS_FILE, credentials_database, self.__forget_users)
         except:
             print("FATAL: error reading credentials.txt")
             exit(1)
 
-    def authenticate(self, username_input: str, password_input: str):
+    def __load_user(self, username: str):
+        # return the user, loading it on first use, None if there is no such user
+        # must hold the lock of the user
+        user = self.__user_map.get(username)
+        if user is None and self.__credentials.has_user(username):
+            user = UserManager.__User()
+            self.__user_map[username] = user
+        return user
+
+    def __forget_users(self, usernames: Set[str]):
+        # drop users removed from the credentials file, unless they are logged in
+        for username in usernames:
+            with self.user_lock(username):
+                user = self.__user_map.get(username)
+                if user is None or user.is_online():
+                    continue
+                del self.__user_map[username]
+                with self.__online_lock:
+                    self.__remove_login(username, user.last_log_in())
+
+    def verify_password(self, username_input: str, password_input: str) -> Future:
+        # check a password in the worker pool of the credential store, without holding any lock
+        # return a future of True if the password is right, to pass on to authenticate,
+        # or of None if it was not checked
+        user = self.__user_map.get(username_input)
+        if user is not None and (user.is_online() or user.is_login_blocked()):
+            # the password does not matter, so do not spend a hash on it
+            verified = Future()
+            verified.set_result(None)
+            return verified
+        return self.__credentials.verify(username_input, password_input)
+
+    def authenticate(self, username_input: str, password_correct: Optional[bool], now: Optional[float] = None,
+                     watch_timeout: bool = True):
         # authenticate user and update status
+        # password_correct is the result of verify_password, None if it did not check the password
+        # now is the time of the attempt, replicas of a user given the same attempts
+        # at the same times end up in the same state
+        # watch_timeout is False when the session is timed out by someone else, e.g. the
+        # worker the user is connected to
         # return updated status in a string format
 
-        if username_input not in self.__user_map:
-            # username unknown
-            return "USERNAME_NOT_EXIST"
-
-        # else, delegate authenticate to specific user class
-        return self.__user_map[username_input].authenticate(password_input)
+        # delegate authenticate to specific user class
+        with self.user_lock(username_input):
+            user = self.__load_user(username_input)
+            if user is None:
+                # username unknown
+                return "USERNAME_NOT_EXIST"
+            previous_login = user.last_log_in()
+            status = user.authenticate(password_correct, self.__block_duration, time() if now is None else now)
+            if status == "SUCCESS":
+                with self.__online_lock:
+                    self.__online_users.add(username_input)
+                    self.__move_login(username_input, previous_login, user.last_log_in())
+                if watch_timeout:
+                    self.__schedule(('timeout', username_input), user.time_out_deadline(self.__time_out))
+            elif status == "INVALID_PASSWORD_BLOCKED":
+                self.__schedule(('unblock', username_input), user.unblock_deadline())
+            return status
+
+    def __move_login(self, username: str, previous_login: int, last_login: int):
+        # move username to its new place in the last login index, must hold the online lock
+        self.__remove_login(username, previous_login)
+        # logins only move forward in time, so this is nearly always an append
+        position = bisect_right(self.__login_times, last_login)
+        self.__login_times.insert(position, last_login)
+        self.__login_names.insert(position, username)
+
+    def __remove_login(self, username: str, last_login: int):
+        # remove username from the last login index, must hold the online lock
+        if last_login:
+            position = bisect_left(self.__login_times, last_login)
+            while self.__login_names[position] != username:
+                position += 1
+            del self.__login_times[position]
+            del self.__login_names[position]
+
+    def user_lock(self, username: str) -> threading.RLock:
+        # the lock guarding the state of username
+        # hold it to check and act on the state of a user atomically
+        return self.__user_locks[hash(username) % LOCK_STRIPES]
+
+    def user_locks(self, usernames) -> List[threading.RLock]:
+        # the locks guarding the state of every one of usernames, each once
+        # they are in one order for everyone, take them in it so that two threads
+        # taking several locks never wait for each other
+        stripes = sorted({hash(username) % LOCK_STRIPES for username in usernames})
+        return [self.__user_locks[stripe] for stripe in stripes]
 
     def set_address_username(self, address: str, username: str):
         self.__address_to_username_map[address] = username
@@ -61,60 +173,122 @@ class UserManager:
 
     def set_offline(self, username):
         if username in self.__user_map:
-            self.__user_map[username].set_offline()
+            with self.user_lock(username):
+                self.__user_map[username].set_offline()
+                with self.__online_lock:
+                    self.__online_users.discard(username)
+                with self.__scheduler_condition:
+                    self.__scheduler.cancel(('timeout', username))
+
+    def next_deadline(self) -> Optional[float]:
+        # return when expire_due next has work to do, None if never
+        with self.__scheduler_condition:
+            return self.__scheduler.next_deadline()
+
+    def wait_until_due(self):
+        # block until expire_due has work to do
+        with self.__scheduler_condition:
+            while True:
+                deadline = self.__scheduler.next_deadline()
+                if deadline is None:
+                    self.__scheduler_condition.wait()
+                elif deadline > time():
+                    self.__scheduler_condition.wait(deadline - time())
+                else:
+                    return
+
+    def expire_due(self, apply: bool = True) -> set:
+        # unblock users whose login block is over and time out inactive users
+        # return a set of all users that have been timed out
+        # with apply False nothing changes, the users due to time out are returned for the
+        # caller to time out, and a login block simply ends at its deadline
+        timed_out_users = set()
+        now = time()
+        with self.__scheduler_condition:
+            due = self.__scheduler.pop_due(now)
+        for event, username in due:
+            with self.user_lock(username):
+                user = self.__user_map.get(username)
+                if user is None:
+                    # removed from the credentials file meanwhile
+                    continue
+                if event == 'unblock':
+                    if apply:
+                        user.unblock_login()
+                elif user.is_online():
+                    # activity only moves the deadline of the user, so check it again
+                    deadline = user.time_out_deadline(self.__time_out)
+                    if deadline <= now:
+                        if apply:
+                            user.set_offline()
+                            with self.__online_lock:
+                                self.__online_users.discard(username)
+                        timed_out_users.add(username)
+                    else:
+                        self.__schedule(('timeout', username), deadline)
+        return timed_out_users
 
-    def update(self):
-        # update all user's block status
-        for user_credential in self.__user_map.values():
-            user_credential.update()
+    def __schedule(self, key, deadline: float):
+        with self.__scheduler_condition:
+            self.__scheduler.schedule(key, deadline)
+            self.__scheduler_condition.notify_all()
 
     def block(self, from_username: str, to_block_username: str):
         if from_username in self.__user_map:
-            self.__user_map[from_username].block(to_block_username)
+            with self.__block_lock:
+                self.__user_map[from_username].block(to_block_username)
+                self.__blocked_by.setdefault(to_block_username, set()).add(from_username)
 
     def unblock(self, from_username: str, to_block_username: str):
         if from_username in self.__user_map:
-            self.__user_map[from_username].unblock(to_block_username)
+            with self.__block_lock:
+                self.__user_map[from_username].unblock(to_block_username)
+                blockers = self.__blocked_by.get(to_block_username)
+                if blockers is not None:
+                    blockers.discard(from_username)
+                    if not blockers:
+                        del self.__blocked_by[to_block_username]
 
     def is_blocked_user(self, from_username: str, to_block_username: str):
         # if from user blocked to user
         return from_username in self.__user_map and self.__user_map[from_username].is_blocked_user(to_block_username)
 
+    def blocked_by(self, username: str) -> set:
+        # return a set of all users who blocked username
+        with self.__block_lock:
+            return set(self.__blocked_by.get(username, ()))
+
+    def get_online_users_not_blocking(self, username: str) -> set:
+        # return a set of online users, other than username, who did not block username
+        with self.__online_lock, self.__block_lock:
+            return self.__online_users.difference(self.__blocked_by.get(username, ()), (username,))
+
     def has_user(self, username):
-        return username in self.__user_map
+        return username in self.__user_map or self.__credentials.has_user(username)
 
     def is_online(self, username):
         return username in self.__user_map and self.__user_map[username].is_online()
 
     def all_users(self) -> list:
         # return a list of all username
-        return list(self.__user_map.keys())
-
-    def get_timed_out_users(self) -> set:
-        # return a set of all users that should be timed out
-        timed_out_users = set()
-        for user in self.__user_map:
-            if self.__user_map[user].update_time_out():
-                timed_out_users.add(user)
-        return timed_out_users
+        return list(self.__credentials.usernames())
 
     def get_online_users(self) -> set:
-        online_users = set()
-        for user in self.__user_map:
-            if self.__user_map[user].is_online():
-                online_users.add(user)
-        return online_users
+        with self.__online_lock:
+            return set(self.__online_users)
 
     def get_users_logged_in_since(self, since: int) -> set:
         # return a set of username tha is logged in since a time
-        users = set()
-        for user in self.__user_map:
-            if self.__user_map[user].last_log_in() > time() - since:
-                users.add(user)
-        return users
+        cutoff = time() - since
+        if cutoff < 0:
+            # even users who never logged in count
+            return set(self.__credentials.usernames())
+        with self.__online_lock:
+            return set(self.__login_names[bisect_right(self.__login_times, cutoff):])
 
     def refresh_user_timeout(self, username):
         # update a user's last active time
+        # the scheduled time out is left alone, it is moved when it fires
         if username in self.__user_map:
             self.__user_map[username].refresh_user_timeout()
 
@@ -127,30 +301,43 @@ class UserManager:
             return self.__user_map[username].get_private_port()
         return 0
 
+    def get_last_login(self, username: str) -> int:
+        if username in self.__user_map:
+            return self.__user_map[username].last_log_in()
+        return 0
+
     class __User:
-        # manage username, password, online status, number of consecutive fail trials,
-        # blocked timestamp, last active time, last login of a particular user
-
-        def __init__(self, username: str, password: str, block_duration: int, timeout: int):
-            self.__username: str = username
-            self.__password: str = password
-            self.__block_duration: int = block_duration
-            self.__timeout: int = timeout
+        # manage online status, number of consecutive fail trials, end of the login block,
+        # last active time, last login and blocked users of a particular user
+        # the password is checked by the CredentialStore, the username is the key of the
+        # user map, and the block duration and the time out are the same for every user
+        #
+        # there can be millions of users, so a user has slots instead of a __dict__,
+        # and the set of blocked users only exists once the user blocks someone
+
+        __slots__ = ('__online', '__consecutive_fails', '__blocked_until', '__inactive_since',
+                     '__last_login', '__private_port', '__blocked_users')
+
+        def __init__(self):
             self.__online: bool = False
-            self.__blocked: bool = False
             self.__consecutive_fails: int = 0
-            self.__blocked_since: int = 0
-            self.__inactive_since: int = int(time())
-            self.__blocked_users: Set[str] = set()
+            # 0 unless the user is blocked from logging in
+            self.__blocked_until: float = 0
+            self.__inactive_since: float = int(time())
             self.__last_login: int = 0
             self.__private_port: int = 0
+            self.__blocked_users: Optional[Set[str]] = None
 
         def block(self, username: str):
+            if self.__blocked_users is None:
+                self.__blocked_users = set()
             self.__blocked_users.add(username)
 
         def unblock(self, username: str):
-            if username in self.__blocked_users:
+            if self.__blocked_users is not None and username in self.__blocked_users:
                 self.__blocked_users.remove(username)
+                if not self.__blocked_users:
+                    self.__blocked_users = None
 
         def set_private_port(self, port: int):
             self.__private_port = port
@@ -159,28 +346,28 @@ class UserManager:
             return self.__private_port
 
         def is_blocked_user(self, username: str):
-            return username in self.__blocked_users
+            return self.__blocked_users is not None and username in self.__blocked_users
+
+        def unblock_deadline(self):
+            return self.__blocked_until
 
-        def update(self):
-            # unblock users if any
-            if self.__blocked and self.__blocked_since + self.__block_duration < time():
-                self.__blocked = False
+        def unblock_login(self):
+            self.__blocked_until = 0
+
+        def is_login_blocked(self):
+            return self.__blocked_until > time()
 
         def set_offline(self):
             self.__online = False
             self.__consecutive_fails = 0
-            self.__blocked_since = 0
             self.__private_port = 0
 
         def is_online(self):
             return self.__online
 
-        def update_time_out(self):
-            # update time out status, return true if should lof out this user because of timeout
-            if self.is_online() and self.__inactive_since + self.__timeout < time():
-                self.set_offline()
-                return True
-            return False
+        def time_out_deadline(self, timeout: int):
+            # the time this user times out unless it is active before then
+            return self.__inactive_since + timeout
 
         def refresh_user_timeout(self):
             self.__inactive_since = time()
@@ -188,28 +375,33 @@ class UserManager:
         def last_log_in(self):
             return self.__last_login
 
-        def authenticate(self, password_input: str):
-            # authenticate, return the status of the updated user
+        def authenticate(self, password_correct: Optional[bool], block_duration: int, now: float):
+            # authenticate at time now, return the status of the updated user
 
             if self.__online:
                 # user is already logged in
                 return "ALREADY_LOGGED_IN"
 
-            if self.__blocked:
+            if self.__blocked_until > now:
                 # user is blocked
                 return "BLOCKED"
 
-            if self.__password != password_input:
+            if password_correct is None:
+                # the password was not checked because the user was logged in or blocked,
+                # and logged out or was unblocked since, turn the attempt away as it was
+                # then without counting it as a fail
+                return "BLOCKED" if self.__blocked_until else "ALREADY_LOGGED_IN"
+
+            if not password_correct:
                 # incorrect password
                 self.__consecutive_fails += 1
                 if self.__consecutive_fails >= 3:
-                    self.__blocked_since = time()
-                    self.__blocked = True
+                    self.__blocked_until = now + block_duration
                     return "INVALID_PASSWORD_BLOCKED"
                 return "INVALID_PASSWORD"
 
             # is able to login. update status
             self.__online = True
-            self.__last_login = int(time())
-            self.refresh_user_timeout()
+            self.__last_login = int(now)
+            self.__inactive_since = now
             return "SUCCESS"
@@ -1,55 +1,212 @@
 # Python 3.7
 # Author: Bofei Wang
-# Usage: python3 server.py server_port block_duration timeout
+# Usage: python3 server.py server_port block_duration timeout [--engine thread|asyncio] [--metrics-port port]
+#                                                               [--profile] [--workers n]
+#                                                               [--node i --nodes host:port,host:port,...]
 # coding: utf-8
 # modified from the multi-threading sample code
 
+import os
 import threading
-import time
-import json
-import sys
 import atexit
 import signal
+import argparse
+import functools
+import contextlib
 from socket import *
-from typing import List, Dict
+from time import perf_counter, strftime, time
+from typing import Dict, Optional
 from UserManager import UserManager
+from MessageStore import MessageStore
+from HistoryStore import HistoryStore, BROADCAST
+from Session import Session
+from Dispatcher import Dispatcher, Deferred, InvalidMessage
+from Connection import Connection, SocketWriter, OutboundLimits, POLICIES, SPILL
+from Metrics import metrics, TimedLock
+from Profiler import profiler
+import AsyncEngine
+import Cluster
+from Protocol import FrameDecoder, FrameError, Codec, JSON, choose_codec, choose_compression, with_compression, \
+    encode_message, decode_message, RECV_SIZE
 
 # command line args
-if len(sys.argv) != 4:
-    print("Usage: python3 server.py server_port block_duration timeout")
-    exit(0)
-serverPort = int(sys.argv[1])
-block_duration = int(sys.argv[2])
-timeout = int(sys.argv[3])
-
-# exclusive lock for multi threading
-t_lock = threading.Condition()
+arg_parser = argparse.ArgumentParser(usage="python3 server.py server_port block_duration timeout "
+                                           "[--engine thread|asyncio] [--slow-consumer drop|disconnect|spill] "
+                                           "[--high-watermark bytes] [--low-watermark bytes] [--metrics-port port] "
+                                           "[--profile] [--workers n] [--node i --nodes host:port,...]")
+arg_parser.add_argument("server_port", type=int)
+arg_parser.add_argument("block_duration", type=int)
+arg_parser.add_argument("timeout", type=int)
+# thread: one thread per connection, asyncio: every connection in one event loop
+arg_parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+# what to do with messages for a client whose outbound queue is above the high watermark
+arg_parser.add_argument("--slow-consumer", choices=POLICIES, default=SPILL)
+arg_parser.add_argument("--high-watermark", type=int, default=1024 * 1024)
+arg_parser.add_argument("--low-watermark", type=int, default=256 * 1024)
+# serve the metrics at http://localhost:port/metrics, they are not collected without it
+arg_parser.add_argument("--metrics-port", type=int)
+# sample the stacks of every thread from the start, kill -USR2 turns it on and off
+# and kill -USR1 writes the samples so far to profile-<time>.folded
+arg_parser.add_argument("--profile", action="store_true")
+# serve from this many processes sharing the port, see Cluster.py
+arg_parser.add_argument("--workers", type=int, default=1)
+# given to the worker processes by Cluster.supervise
+arg_parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+arg_parser.add_argument("--hub-fd", type=int, help=argparse.SUPPRESS)
+# serve as node i of a cluster, the nodes link to each other on these addresses, see Cluster.py
+arg_parser.add_argument("--node", type=int)
+arg_parser.add_argument("--nodes", type=Cluster.parse_addresses)
+args = arg_parser.parse_args()
+serverPort = args.server_port
+block_duration = args.block_duration
+timeout = args.timeout
+try:
+    outbound_limits = OutboundLimits(args.high_watermark, args.low_watermark, args.slow_consumer)
+except ValueError as error:
+    arg_parser.error(str(error))
+if (args.node is None) != (args.nodes is None):
+    arg_parser.error("--node and --nodes go together")
+if args.node is not None and not 0 <= args.node < len(args.nodes):
+    arg_parser.error("--node must be the index of this node in --nodes")
+if args.node is not None and args.workers > 1:
+    arg_parser.error("a node is one process, --workers can not be used with --node")
+
+# with several workers this process only starts them and relays their events
+if args.workers > 1 and args.worker is None:
+    Cluster.supervise(args.workers)
+
+# the number of this worker or node, and its link to the others, None for a single process
+# the files of every worker or node are named after it, they may share a directory
+if args.node is not None:
+    worker_id = args.node
+    cluster = Cluster.NodeMesh(worker_id, args.nodes)
+    process_name = 'node-%d' % worker_id
+elif args.worker is not None:
+    worker_id = args.worker
+    cluster = Cluster.HubLink(worker_id, args.hub_fd)
+    process_name = 'worker-%d' % worker_id
+else:
+    worker_id = 0
+    cluster = None
+
+# most messages in one message_batch request
+MAX_BATCH = 1000
+
+# most offline messages taken from the store at once, the rest follow as the client reads them
+BACKLOG_CHUNK = 1000
+
+# messages in a page of history, unless the client asks for fewer, and the most it can ask for
+HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 500
 
 # will store clients info in this list
 clients = []
 
-# all unsent messages: from_user, to_user, message
-pending_messages: List[Dict] = []
+# messages to offline users are kept on disk in this directory until delivered
+OFFLINE_MESSAGE_DIRECTORY = 'offline_messages'
+
+# all unsent messages: from_user, to_user, message, queued per receiver
+# every worker keeps its own, and hands them over to the worker of the receiver at login
+if cluster is None:
+    pending_messages = MessageStore(OFFLINE_MESSAGE_DIRECTORY)
+else:
+    pending_messages = MessageStore(os.path.join(OFFLINE_MESSAGE_DIRECTORY, process_name))
+
+# every message and broadcast sent is kept on disk in this directory, for the history action
+HISTORY_DIRECTORY = 'history'
+
+# a single process only, with workers or nodes a process sees the messages of its own clients
+# alone, so the history action is not available and nothing is kept
+history = HistoryStore(HISTORY_DIRECTORY) if cluster is None else None
 
 # map username to connection socket
 name_to_socket: Dict = dict()
 
-# would communicate with clients after every second
-UPDATE_INTERVAL = 1
+# map username to the worker, or node, the user is connected to, every worker knows every user
+name_to_worker: Dict[str, int] = dict()
+
+# map username to its session, for the clients that acknowledge what they read, see Session.py
+sessions: Dict[str, Session] = dict()
+
+# a session is resumed on the process that has it, with --workers the kernel may hand the
+# new connection to any worker, so only a single process or a node offers sessions
+offer_sessions = not isinstance(cluster, Cluster.HubLink)
 
 # user manager manages all the user data
-user_manager = UserManager(block_duration, timeout)
+if cluster is None:
+    user_manager = UserManager(block_duration, timeout)
+else:
+    user_manager = UserManager(block_duration, timeout, 'credentials-%s.db' % process_name)
+
+# what the server is doing, see Metrics.py, only collected with --metrics-port
+REQUEST_SECONDS = metrics.histogram('chat_request_seconds', 'Time to handle and reply to a request, by action',
+                                    ['action'])
+USER_LOCK_WAIT_SECONDS = metrics.histogram('chat_user_lock_wait_seconds', 'Time spent waiting for the lock of a user')
+SEND_SECONDS = metrics.histogram('chat_send_seconds', 'Time to queue a message on the connection of its receiver, '
+                                                      'by action', ['action'])
+EXPIRY_SWEEP_SECONDS = metrics.histogram('chat_expiry_sweep_seconds', 'Time to fire the time outs and unblocks due')
+TIMEOUTS = metrics.counter('chat_timeouts_total', 'Users timed out for inactivity')
+metrics.gauge('chat_online_users', 'Users logged in', lambda: len(user_manager.get_online_users()))
+metrics.gauge('chat_pending_messages', 'Messages waiting for their receiver to log in', lambda: len(pending_messages))
+if history is not None:
+    metrics.gauge('chat_history_messages', 'Messages and broadcasts kept for the history', lambda: len(history))
+metrics.gauge('chat_outbound_queued_bytes', 'Bytes queued for clients that did not take them yet',
+              lambda: sum(connection.queued() for connection in list(name_to_socket.values())))
+metrics.gauge('chat_congested_connections', 'Clients above the high watermark of their outbound queue',
+              lambda: sum(connection.is_congested() for connection in list(name_to_socket.values())))
 
 
 # catch the ctrl+c exit signal
 def keyboard_interrupt_handler(signal, frame):
     print("\rServer is shutdown")
+    print_action_timings()
+    if profiler.running:
+        dump_profile()
     exit(0)
 
 
-# close the socket when exit
+# kill -USR1: write the profile so far to a file, for flamegraph.pl
+def profile_dump_handler(signal, frame):
+    dump_profile()
+
+
+# kill -USR2: start or stop the profiler
+def profile_toggle_handler(signal, frame):
+    print('Profiler is', 'on' if profiler.toggle() else 'off')
+
+
+def dump_profile():
+    path = 'profile-' + strftime('%Y%m%d-%H%M%S') + ('' if cluster is None else '-' + process_name) + '.folded'
+    print('Profile of', profiler.dump(path), 'samples written to', path)
+
+
+# print how many requests of every action were handled and how long they took
+def print_action_timings():
+    for action, timing in sorted(dispatcher.timings().items()):
+        print('%-14s %8d requests %10.1f us average %10.1f us max'
+              % (action, timing.count, timing.average() * 1e6, timing.max * 1e6))
+
+
+# close the socket and save the pending messages when exit
 def on_close():
     serverSocket.close()
+    pending_messages.sync()
+    if history is not None:
+        history.sync()
+
+
+# helper function to build a message to a user
+def user_message(from_user: str, message: str, action='receive_message') -> Dict:
+    return {
+        'action': action,
+        'from': from_user,
+        'message': message
+    }
+
+
+# helper function to encode a message to a user
+def encode_user_message(from_user: str, message: str, action='receive_message', codec: Codec = JSON) -> bytes:
+    return encode_message(user_message(from_user, message, action), codec)
 
 
 # helper function to send a message
@@ -66,182 +223,629 @@ def send_message(from_user: str, to_user: str, message: str, broadcast=False, lo
             action = 'login_broadcast'
         elif logout_broadcast:
             action = 'logout_broadcast'
-        to_user_socket.send(json.dumps({
-            'action': action,
-            'from': from_user,
-            'message': message
-        }).encode())
+        if metrics.enabled:
+            with SEND_SECONDS.time(action):
+                push(to_user, to_user_socket, user_message(from_user, message, action))
+        else:
+            push(to_user, to_user_socket, user_message(from_user, message, action))
+
+
+# send a message to a user on its connection, numbered if the user has a session
+# frame is the message already encoded with the codec of the connection, if there is one
+# the message to a user whose session waits to be resumed is kept by the session, connection
+# may be None then
+def push(to_user: str, connection, message: Dict, frame: Optional[bytes] = None):
+    session = sessions.get(to_user)
+    if session is not None:
+        with session.lock:
+            # the connection is replaced or dropped under the lock of the session, see attach
+            connection = name_to_socket.get(to_user)
+            if connection is None:
+                session.keep(message)
+            else:
+                session.send(connection, message)
+    elif connection is not None:
+        connection.sendall(encode_message(message, connection.codec) if frame is None else frame)
+
+
+# deliver a chat message to a user, wherever it is connected, or keep it until it logs in
+# must hold the lock of to_user
+def deliver(from_user: str, to_user: str, message: str):
+    if user_manager.is_online(to_user):
+        worker = name_to_worker.get(to_user, worker_id)
+        if worker != worker_id:
+            cluster.send(deliver_event(to_user, [[from_user, message]]), worker)
+            return
+        if to_user in name_to_socket:
+            send_message(from_user, to_user, message)
+            return
+    # offline, or logging in on this worker and not registered yet
+    pending_messages.push(from_user, to_user, message)
+
+
+# the event delivering messages [from_user, message] to a user of another worker
+def deliver_event(to_user: str, messages: list) -> Dict:
+    return {
+        'action': 'deliver',
+        'to': to_user,
+        'messages': messages
+    }
+
+
+# helper function to encode the oldest BACKLOG_CHUNK messages queued for a user, removing
+# them from the queue
+# they are numbered if the user has a session, hold the lock of the session until they are sent
+def encode_pending_messages(to_user: str, codec: Codec) -> list:
+    session = sessions.get(to_user)
+    if session is None:
+        return [encode_user_message(pending['from_user'], pending['message'], codec=codec)
+                for pending in pending_messages.drain(to_user, BACKLOG_CHUNK)]
+    return [session.frame(user_message(pending['from_user'], pending['message']), codec)
+            for pending in pending_messages.drain(to_user, BACKLOG_CHUNK)]
+
+
+# send the messages queued for a user, a chunk at a time, until none are left or the client
+# falls behind, then the resume handler sends the rest once it caught up
+# a congested client gets nothing, a frame it has no room for would be queued again behind
+# the newer messages
+# must hold the lock of the user and of its session
+def send_backlog(to_user: str, connection):
+    while pending_messages.pending(to_user) and not connection.is_congested() and not connection.hold():
+        connection.sendall(connection.codec.batch(encode_pending_messages(to_user, connection.codec)))
+
+
+# keep a message that a slow client has no room for as an offline message
+# the frame may be compressed, or a batch of messages
+def spill_message(to_user: str, connection, frame: bytes):
+    for payload in FrameDecoder().feed(frame):
+        message = decode_message(payload, connection.codec)
+        if 'seq' in message and to_user in sessions:
+            # it is delivered again with a number of its own, not replayed
+            sessions[to_user].forget(message['seq'])
+        if message['action'] in ['receive_message', 'receive_broadcast']:
+            pending_messages.push(message['from'], to_user, message['message'])
+
+
+# deliver the messages spilled while the client of a user was too slow, or the rest of
+# its backlog
+def deliver_spilled_messages(to_user: str, connection):
+    with user_lock(to_user), session_lock(to_user):
+        if name_to_socket.get(to_user) is connection:
+            send_backlog(to_user, connection)
+
+
+# helper function to send the same message to many users
+# the message is encoded once per codec and the frame is queued on every
+# connection, so no recipient waits for another
+# users of other workers are sent to their worker, one event per worker
+def fan_out(to_users, message: Dict) -> int:
+    frames = dict()
+    remote = dict()
+    n_sent = 0
+    for to_user in to_users:
+        worker = name_to_worker.get(to_user, worker_id)
+        connection = name_to_socket.get(to_user)
+        if worker != worker_id:
+            remote.setdefault(worker, []).append(to_user)
+            n_sent += 1
+        elif connection is not None or to_user in sessions:
+            # a user whose connection dropped keeps it in its session until it resumes
+            n_sent += 1
+            # a user with a session gets a frame of its own, with its number
+            frame = None
+            if to_user not in sessions and connection is not None:
+                if connection.codec not in frames:
+                    frames[connection.codec] = encode_message(message, connection.codec)
+                frame = frames[connection.codec]
+            if metrics.enabled:
+                with SEND_SECONDS.time(message['action']):
+                    push(to_user, connection, message, frame)
+            else:
+                push(to_user, connection, message, frame)
+    for worker, users in remote.items():
+        cluster.send({'action': 'fan_out', 'users': users, 'message': message}, worker)
+    return n_sent
+
+
+# the lock of a user, timing the wait for it when metrics are on
+def user_lock(username: str):
+    lock = user_manager.user_lock(username)
+    if metrics.enabled:
+        return TimedLock(lock, USER_LOCK_WAIT_SECONDS)
+    return lock
+
+
+# the lock of the session of a user, nothing if it has none
+# taken after the lock of the user, never before
+def session_lock(username: str):
+    session = sessions.get(username)
+    return contextlib.nullcontext() if session is None else session.lock
+
+
+# the locks of several users, taken once each and in an order that can not deadlock
+def user_locks(usernames) -> list:
+    locks = user_manager.user_locks(usernames)
+    if metrics.enabled:
+        return [TimedLock(lock, USER_LOCK_WAIT_SECONDS) for lock in locks]
+    return locks
+
+
+# every action a client can request, see handle_request
+# handlers with a lock field run under user_lock of that user, which makes
+# their check-then-act on that user atomic, e.g. "recipient offline, so queue the message"
+# against "user logs in, so drain the queue"
+dispatcher = Dispatcher(user_lock)
+
+
+class Request:
+    # a request being handled, the handler of its action fills in the reply
+
+    def __init__(self, connection_socket, client_address, action: str):
+        # a Connection or an AsyncConnection
+        self.connection = connection_socket
+        self.client_address = client_address
+        # current user name
+        self.user = user_manager.get_username(client_address)
+        # the data to reply to client
+        self.reply = {'action': action}
+        # messages to send right after the reply
+        self.followups = []
+        # True once the reply is sent, a handler may send it early
+        self.sent = False
+
+
+@dispatcher.register('login', {'username': str, 'password': str, 'private_port': (int, str)})
+def handle_login(data: Dict, request: Request):
+    # the password is hashed by a worker, the login goes on once it is checked
+    verified = user_manager.verify_password(data["username"], data["password"])
+    if cluster is not None:
+        # every worker authenticates the attempt, in the order of the user, see on_login
+        verified = Cluster.chain(verified, lambda password_correct: cluster.publish({
+            'action': 'login',
+            'username': data['username'],
+            'password_correct': password_correct,
+            'time': time(),
+            'private_port': int(data['private_port'])
+        }, data['username']))
+    return Deferred(verified, functools.partial(finish_login, data, request))
+
+
+def finish_login(data: Dict, request: Request, outcome):
+    # outcome is whether the password is correct, or with several workers the status
+    # of the login, already applied by every worker
+    # store client information (IP and Port No) in list
+    username = data["username"]
+    clients.append(request.client_address)
+    # auth the user and reply the status
+    # a message to this user either sees it offline and is queued before
+    # the queue is drained here, or sees it online with its socket in place
+    with user_lock(username):
+        status = user_manager.authenticate(username, outcome) if cluster is None else outcome
+        user_manager.set_address_username(request.client_address, username)
+        request.reply["status"] = status
+        if status == 'SUCCESS':
+            user_manager.set_private_port(username, int(data['private_port']))
+            # a client that acknowledges what it reads gets a session it can resume
+            if data.get('acks') is True and offer_sessions:
+                sessions[username] = Session(username)
+            attach(username, data, request)
+    if status == 'SUCCESS':
+        # broadcast new user login
+        fan_out(user_manager.get_online_users() - {username},
+                user_message(username, '', 'login_broadcast'))
+
+
+# make the connection of a request the one of a user logging in or resuming, and reply
+# the messages received while offline are sent together with the reply, after the frames
+# a resume sends again
+# must hold the lock of username
+def attach(username: str, data: Dict, request: Request, replay_after: Optional[int] = None):
+    connection_socket = request.connection
+    reply_codec = connection_socket.codec
+    session = sessions.get(username)
+    with session_lock(username):
+        # add the socket to the name-socket map
+        name_to_socket[username] = connection_socket
+        connection_socket.set_spill_handler(functools.partial(spill_message, username, connection_socket))
+        connection_socket.set_resume_handler(
+            functools.partial(deliver_spilled_messages, username, connection_socket))
+        if session is not None:
+            connection_socket.set_lost_handler(functools.partial(detach, username, connection_socket))
+            request.reply['token'] = session.token
+        # use the preferred codec of the client, json unless it offers another, and
+        # compress large frames if the client asks for it
+        compression = choose_compression(data.get('compression', []))
+        connection_socket.codec = with_compression(choose_codec(data.get('codecs', [])), compression)
+        request.reply['codec'] = connection_socket.codec.name
+        if compression is not None:
+            request.reply['compression'] = compression
+        frames = []
+        if replay_after is not None:
+            frames, missed = session.replay(replay_after, connection_socket.codec)
+            if missed:
+                request.reply['missed'] = missed
+        # compressed together if the client asked for compression
+        frames += encode_pending_messages(username, connection_socket.codec)
+        request.followups = [connection_socket.codec.batch(frames)]
+        # reply before releasing the locks, a message to the user sent once they are released,
+        # e.g. delivered by another worker, must not get ahead of the reply or the backlog
+        send_reply(request, reply_codec)
+        send_backlog(username, connection_socket)
+
+
+# the connection of a user with a session is gone without a logout, the messages to the
+# user are kept as offline messages until the session is resumed or the user times out
+def detach(username: str, connection):
+    with user_lock(username), session_lock(username):
+        if name_to_socket.get(username) is connection:
+            del name_to_socket[username]
+
+
+# end the session of a user, if it has one
+# unless the user logged out, the messages it did not acknowledge are kept as offline messages
+def end_session(username: str, logged_out: bool):
+    session = sessions.pop(username, None)
+    if session is None:
+        return
+    for message in session.take_unacked():
+        if not logged_out and message['action'] in ['receive_message', 'receive_broadcast']:
+            pending_messages.push(message['from'], username, message['message'])
+
+
+@dispatcher.register('resume', {'username': str, 'token': str, 'seq': int}, lock='username')
+def handle_resume(data: Dict, request: Request):
+    # a client with a session on a new connection, after the one before dropped
+    # instead of logging in again it is sent what it did not read, the messages after seq
+    # it did not acknowledge, then the ones kept meanwhile
+    username = data['username']
+    session = sessions.get(username)
+    if session is None or not session.is_token(data['token']) or not user_manager.is_online(username):
+        request.reply['status'] = 'INVALID_TOKEN'
+        return
+    previous = name_to_socket.get(username)
+    if previous is not None and previous is not request.connection:
+        # the client gave up on a connection this side did not see drop
+        previous.close()
+    clients.append(request.client_address)
+    user_manager.set_address_username(request.client_address, username)
+    user_manager.refresh_user_timeout(username)
+    request.reply['status'] = 'SUCCESS'
+    attach(username, data, request, data['seq'])
+
+
+@dispatcher.register('ack', {'seq': int})
+def handle_ack(data: Dict, request: Request):
+    # the client read every message numbered up to seq, there is no reply
+    session = sessions.get(request.user)
+    if session is not None:
+        session.ack(data['seq'])
+    request.sent = True
+
+
+@dispatcher.register('logout')
+def handle_logout(data: Dict, request: Request):
+    # check if client already subscribed or not
+    if cluster is not None and request.client_address in clients:
+        clients.remove(request.client_address)
+        request.reply["reply"] = "logged out"
+        # every worker sets the user offline, see on_offline, which broadcasts the logout
+        return Deferred(cluster.publish(offline_event(request.user, broadcast=True), request.user),
+                        lambda _: None)
+    user_manager.set_offline(request.user)
+    end_session(request.user, logged_out=True)
+    if request.client_address in clients:
+        clients.remove(request.client_address)
+        request.reply["reply"] = "logged out"
+        # broadcast user logout
+        fan_out(user_manager.get_online_users() - {request.user},
+                user_message(request.user, '', 'logout_broadcast'))
+    else:
+        request.reply["reply"] = "You are not logged in"
+
+
+@dispatcher.register('message', {'user': str, 'message': str}, lock='user')
+def handle_message(data: Dict, request: Request):
+    # user tries to send a message to other users
+    username = data['user']
+    request.reply['status'] = message_status(request.user, username)
+    if request.reply['status'] == 'SUCCESS':
+        # send the message to the user if online, otherwise add it to the pending list
+        deliver(request.user, username, data['message'])
+        record_history(request.user, username, data['message'])
+
+
+@dispatcher.register('message_batch', {'messages': list})
+def handle_message_batch(data: Dict, request: Request):
+    # several messages, [user, message] each, answered with one reply
+    # the lock of every receiver is taken once for the whole batch
+    messages = data['messages']
+    if len(messages) > MAX_BATCH:
+        raise InvalidMessage("a batch has at most " + str(MAX_BATCH) + " messages")
+    for message in messages:
+        if not (isinstance(message, list) and len(message) == 2 and isinstance(message[0], str)
+                and isinstance(message[1], str)):
+            raise InvalidMessage("every message of a batch must be [user, message]")
+    n_sent = 0
+    # the status of every receiver a message could not be sent to
+    failed = dict()
+    with contextlib.ExitStack() as locks:
+        for lock in user_locks({username for username, _ in messages}):
+            locks.enter_context(lock)
+        for username, message in messages:
+            status = message_status(request.user, username)
+            if status == 'SUCCESS':
+                deliver(request.user, username, message)
+                record_history(request.user, username, message)
+                n_sent += 1
+            else:
+                failed[username] = status
+    request.reply['n_sent'] = n_sent
+    request.reply['failed'] = failed
+
+
+# keep a message sent now for the history action, to_user is BROADCAST for a broadcast
+def record_history(from_user: str, to_user: str, message: str):
+    if history is not None:
+        history.append(time(), from_user, to_user, message)
+
+
+# helper function to check whether from_user can message to_user, return the status
+def message_status(from_user: str, to_user: str) -> str:
+    if from_user == to_user:
+        return 'MESSAGE_SELF'
+    elif not user_manager.has_user(to_user):
+        return 'USER_NOT_EXIST'
+    elif user_manager.is_blocked_user(to_user, from_user):
+        return 'USER_BLOCKED'
+    return 'SUCCESS'
+
+
+@dispatcher.register('broadcast', {'message': str})
+def handle_broadcast(data: Dict, request: Request):
+    # broadcast the message to online unblocked users
+    # record the statistics
+    recipients = user_manager.get_online_users_not_blocking(request.user)
+    # the message is encoded once per codec and shared by every recipient
+    n_sent = fan_out(recipients, user_message(request.user, data['message'], 'receive_broadcast'))
+    record_history(request.user, BROADCAST, data['message'])
+    request.reply['n_sent'] = n_sent
+    request.reply['n_blocked'] = len(user_manager.blocked_by(request.user))
+
+
+@dispatcher.register('block', {'user': str})
+def handle_block(data: Dict, request: Request):
+    user_to_block = data['user']
+    if request.user == user_to_block:
+        request.reply['status'] = 'MESSAGE_SELF'
+    elif not user_manager.has_user(user_to_block):
+        request.reply['status'] = 'USER_NOT_EXIST'
+    else:
+        request.reply['status'] = 'SUCCESS'
+        if cluster is not None:
+            return Deferred(cluster.publish({'action': 'block', 'user': request.user, 'blocked': user_to_block},
+                                            request.user), lambda _: None)
+        user_manager.block(request.user, user_to_block)
+
+
+@dispatcher.register('unblock', {'user': str})
+def handle_unblock(data: Dict, request: Request):
+    user_to_unblock = data['user']
+    if request.user == user_to_unblock:
+        request.reply['status'] = 'MESSAGE_SELF'
+    elif not user_manager.has_user(user_to_unblock):
+        request.reply['status'] = 'USER_NOT_EXIST'
+    else:
+        request.reply['status'] = 'SUCCESS'
+        if cluster is not None:
+            return Deferred(cluster.publish({'action': 'unblock', 'user': request.user,
+                                             'blocked': user_to_unblock}, request.user), lambda _: None)
+        user_manager.unblock(request.user, user_to_unblock)
+
+
+@dispatcher.register('whoelse')
+def handle_whoelse(data: Dict, request: Request):
+    online_users = user_manager.get_online_users()
+    # remove the user who requested
+    online_users.discard(request.user)
+    request.reply['reply'] = list(online_users)
+
+
+@dispatcher.register('whoelsesince', {'since': (int, str)})
+def handle_whoelsesince(data: Dict, request: Request):
+    users = user_manager.get_users_logged_in_since(int(data['since']))
+    # remove the user who requested
+    users.discard(request.user)
+    request.reply['reply'] = list(users)
+
+
+@dispatcher.register('history', {'user': str})
+def handle_history(data: Dict, request: Request):
+    # a page of the messages between the user and another user, or of the broadcasts
+    # when user is empty, newest first
+    # optional fields: limit, the most messages in the page, since, the time of the oldest
+    # message to return, and cursor, from the reply with the page before
+    # a reply with a cursor has older messages to page through
+    user = data['user']
+    limit = data.get('limit', HISTORY_PAGE)
+    since = data.get('since', 0)
+    cursor = data.get('cursor')
+    if type(limit) is not int or not 0 < limit <= MAX_HISTORY_PAGE:
+        raise InvalidMessage("limit must be from 1 to " + str(MAX_HISTORY_PAGE))
+    if type(since) not in (int, float) or (cursor is not None and type(cursor) is not int):
+        raise InvalidMessage("since and cursor must be numbers")
+    # a failed login still names the user of the connection, only its own session may read
+    if not user_manager.is_online(request.user) or name_to_socket.get(request.user) is not request.connection:
+        request.reply['status'] = 'NOT_LOGGED_IN'
+        return
+    if history is None:
+        # with workers or nodes, see history
+        request.reply['status'] = 'NOT_AVAILABLE'
+        return
+    if user != BROADCAST and not user_manager.has_user(user):
+        request.reply['status'] = 'USER_NOT_EXIST'
+        return
+    request.reply['status'] = 'SUCCESS'
+    request.reply['user'] = user
+    messages = []
+    for position, sent, from_user, message in history.read(request.user, user, cursor, since):
+        if len(messages) == limit:
+            # one more is there, the next page starts after the last one returned
+            request.reply['cursor'] = cursor
+            break
+        cursor = position
+        # skip the broadcasts of users blocking this one, they were never sent to it
+        if user == BROADCAST and user_manager.is_blocked_user(from_user, request.user):
+            continue
+        messages.append([sent, from_user, message])
+    request.reply['messages'] = messages
+
+
+@dispatcher.register('startprivate', {'user': str})
+def handle_startprivate(data: Dict, request: Request):
+    # return user address and port if available
+    user = data['user']
+    if not user_manager.has_user(user):
+        request.reply['reply'] = 'USER_NOT_EXIST'
+    elif user_manager.is_blocked_user(user, request.user):
+        request.reply['reply'] = 'USER_BLOCKED'
+    elif user == request.user:
+        request.reply['reply'] = 'USER_SELF'
+    elif not user_manager.is_online(user):
+        request.reply['reply'] = 'USER_OFFLINE'
+    else:
+        # can provide user details to user
+        request.reply['reply'] = 'SUCCESS'
+        # a user of another worker is on this host too
+        user_socket = name_to_socket.get(user, request.connection)
+        request.reply['address'] = user_socket.getsockname()[0]
+        request.reply['port'] = user_manager.get_private_port(user)
+        request.reply['username'] = user
+
+
+@dispatcher.fallback
+def handle_unknown(data: Dict, request: Request):
+    request.reply["reply"] = "Unknown action"
+
+
+# handle a request from a client and reply to it, shared by both engines
+# connection_socket is a Connection or an AsyncConnection, payload the payload of a frame
+# return a Deferred if the request waits for a worker, the engine resumes it when it is done
+# and must not handle the next request of the client before that
+def handle_request(connection_socket, client_address, payload: bytes) -> Optional[Deferred]:
+    try:
+        data = decode_message(payload, connection_socket.codec)
+    except (FrameError, ValueError) as error:
+        reply_invalid(connection_socket, "can not be decoded: " + str(error))
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('action'), str):
+        reply_invalid(connection_socket, "no action")
+        return None
+    if not profiler.running:
+        return process_request(connection_socket, client_address, data)
+    # samples taken meanwhile are put under the action
+    profiler.enter(str(data.get('action')))
+    try:
+        return process_request(connection_socket, client_address, data)
+    finally:
+        profiler.leave()
+
+
+def process_request(connection_socket, client_address, data: Dict) -> Optional[Deferred]:
+    # received data from the client, now we know who we are talking with
+    # there is no global lock, UserManager, the message store and the connections guard
+    # their own data, and handlers that act on a user hold the lock of that user
+    # debugging code, uncomment to use
+    # print(client_address, ':', data)
+    request = Request(connection_socket, client_address, data["action"])
+    start = perf_counter() if metrics.enabled else None
+
+    # the reply is encoded with the codec the request came in, a login may switch
+    # the codec of the connection for everything after the reply
+    reply_codec = connection_socket.codec
+
+    # update the time out when user send anything to server, but an ack, which the
+    # client sends on its own
+    if request.reply['action'] != 'ack':
+        user_manager.refresh_user_timeout(request.user)
+
+    try:
+        deferred = dispatcher.dispatch(data, request)
+    except InvalidMessage as error:
+        request.reply["reply"] = "Invalid request: " + str(error)
+        deferred = None
+    # send message to the client, once the handler is done
+    if isinstance(deferred, Deferred):
+        return deferred.then(lambda _: send_reply(request, reply_codec, start))
+    send_reply(request, reply_codec, start)
+    return None
+
+
+# reply to a request that can not be decoded or names no action, so the reply has no action
+def reply_invalid(connection_socket, reason: str):
+    connection_socket.sendall(encode_message({'reply': "Invalid request: " + reason}, connection_socket.codec))
+
+
+# send the reply to a request and the messages that go right after it, unless the handler did
+# start is when the request came in, if its time is measured
+def send_reply(request: Request, reply_codec: Codec, start: Optional[float] = None):
+    if not request.sent:
+        request.sent = True
+        request.connection.sendall(b''.join([encode_message(request.reply, reply_codec)] + request.followups))
+    if start is not None:
+        REQUEST_SECONDS.observe(perf_counter() - start, request.reply['action'])
 
 
 # return a function as connection handler for a specific socket for multi threading
-def connection_handler(connection_socket, client_address):
+# requests are read from connection_socket, replies are queued on connection
+def connection_handler(connection: Connection, connection_socket, client_address):
     def real_connection_handler():
+        decoder = FrameDecoder()
         while True:
-            data = connection_socket.recv(1024)
+            try:
+                data = connection_socket.recv(RECV_SIZE)
+            except OSError:
+                # the connection was closed by the slow consumer policy
+                data = b''
             if not data:
                 # if data is empty, the socket is closed or is in the
                 # process of closing. In this case, close this thread
+                connection.close()
+                connection.lost()
                 exit(0)
 
-            # received data from the client, now we know who we are talking with
-            data = data.decode()
-            data = json.loads(data)
-            action = data["action"]
-
-            # get lock as we might me accessing some shared data structures
-            with t_lock:
-                # debugging code, uncomment to use
-                # print(client_address, ':', data)
-
-                # the data to reply to client
-                server_message = dict()
-                server_message["action"] = action
-
-                # current user name
-                curr_user = user_manager.get_username(client_address)
-
-                # update the time out when user send anything to server
-                user_manager.refresh_user_timeout(curr_user)
-
-                if action == 'login':
-                    # store client information (IP and Port No) in list
-                    username = data["username"]
-                    password = data["password"]
-                    clients.append(client_address)
-                    # auth the user and reply the status
-                    status = user_manager.authenticate(username, password)
-                    user_manager.set_address_username(client_address, username)
-                    server_message["status"] = status
-                    if status == 'SUCCESS':
-                        # add the socket to the name-socket map
-                        name_to_socket[username] = connection_socket
-                        user_manager.set_private_port(username, int(data['private_port']))
-                        # broadcast new user login
-                        for user in user_manager.all_users():
-                            if user != username and user_manager.is_online(user):
-                                send_message(username, user, '', login_broadcast=True)
-                elif action == 'logout':
-                    # check if client already subscribed or not
-                    user_manager.set_offline(user_manager.get_username(client_address))
-                    if client_address in clients:
-                        clients.remove(client_address)
-                        server_message["reply"] = "logged out"
-                        # broadcast user logout
-                        for user in user_manager.all_users():
-                            if user != curr_user and user_manager.is_online(user):
-                                send_message(curr_user, user, '', logout_broadcast=True)
-                    else:
-                        server_message["reply"] = "You are not logged in"
-                elif action == 'message':
-                    # user tries to send a message to other users
-                    username = data['user']
-                    message = data['message']
-                    if curr_user == username:
-                        server_message['status'] = 'MESSAGE_SELF'
-                    elif not user_manager.has_user(username):
-                        server_message['status'] = 'USER_NOT_EXIST'
-                    elif user_manager.is_blocked_user(username, curr_user):
-                        server_message['status'] = 'USER_BLOCKED'
-                    else:
-                        server_message['status'] = 'SUCCESS'
-                        if user_manager.is_online(username):
-                            # user is online, send message to user
-                            send_message(curr_user, username, message)
-                        else:
-                            # user is offline, add message to pending list
-                            pending_messages.append({
-                                'from_user': curr_user,
-                                'to_user': username,
-                                'message': message
-                            })
-                elif action == 'broadcast':
-                    # broadcast the message to online unblocked users
-                    # record the statistics
-                    message = data['message']
-                    n_sent = 0
-                    n_blocked = 0
-                    for user in user_manager.all_users():
-                        if user_manager.is_blocked_user(user, curr_user):
-                            n_blocked += 1
-                        elif not user_manager.is_online(user):
-                            pass
-                        elif user == curr_user:
-                            pass
-                        else:
-                            n_sent += 1
-                            send_message(curr_user, user, message, broadcast=True)
-                    server_message['n_sent'] = n_sent
-                    server_message['n_blocked'] = n_blocked
-                elif action == 'block':
-                    user_to_block = data['user']
-                    if curr_user == user_to_block:
-                        server_message['status'] = 'MESSAGE_SELF'
-                    elif not user_manager.has_user(user_to_block):
-                        server_message['status'] = 'USER_NOT_EXIST'
-                    else:
-                        server_message['status'] = 'SUCCESS'
-                        user_manager.block(curr_user, user_to_block)
-                elif action == 'unblock':
-                    user_to_unblock = data['user']
-                    if curr_user == user_to_unblock:
-                        server_message['status'] = 'MESSAGE_SELF'
-                    elif not user_manager.has_user(user_to_unblock):
-                        server_message['status'] = 'USER_NOT_EXIST'
-                    else:
-                        server_message['status'] = 'SUCCESS'
-                        user_manager.unblock(curr_user, user_to_unblock)
-                elif action == 'whoelse':
-                    online_users = user_manager.get_online_users()
-                    # remove the user who requested
-                    online_users.remove(curr_user)
-                    server_message['reply'] = list(online_users)
-                elif action == 'whoelsesince':
-                    users = user_manager.get_users_logged_in_since(int(data['since']))
-                    if curr_user in users:
-                        # remove the user who requested
-                        users.remove(curr_user)
-                    server_message['reply'] = list(users)
-                elif action == 'startprivate':
-                    # return user address and port if available
-                    user = data['user']
-                    if not user_manager.has_user(user):
-                        server_message['reply'] = 'USER_NOT_EXIST'
-                    elif user_manager.is_blocked_user(user, curr_user):
-                        server_message['reply'] = 'USER_BLOCKED'
-                    elif user == curr_user:
-                        server_message['reply'] = 'USER_SELF'
-                    elif not user_manager.is_online(user):
-                        server_message['reply'] = 'USER_OFFLINE'
-                    else:
-                        # can provide user details to user
-                        server_message['reply'] = 'SUCCESS'
-                        user_socket = name_to_socket[user]
-                        user_address = user_socket.getsockname()[0]
-                        server_message['address'] = user_address
-                        server_message['port'] = user_manager.get_private_port(user)
-                        server_message['username'] = user
-                else:
-                    server_message["reply"] = "Unknown action"
-                # send message to the client
-                connection_socket.send(json.dumps(server_message).encode())
-                # notify the thread waiting
-                t_lock.notify()
+            # one read may carry several requests, or only a part of one
+            try:
+                payloads = decoder.feed(data)
+            except FrameError:
+                # the stream can not be split into requests any more
+                connection.close()
+                connection.lost()
+                exit(0)
+            for payload in payloads:
+                deferred = handle_request(connection, client_address, payload)
+                if deferred is not None:
+                    # wait for the worker, without holding any lock, the next request
+                    # of this client may depend on the result
+                    deferred.resume()
 
     return real_connection_handler
 
 
 # handles all incoming data and replies to those
 def recv_handler():
-    global t_lock
     global clients
     global serverSocket
     print('Server is up.')
     while True:
         # create a new connection for a new client
         connection_socket, client_address = serverSocket.accept()
+        # replies are small, send them right away instead of waiting for the ack of
+        # the previous one, the asyncio engine does the same
+        connection_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
 
         # create a new function handler for the client
-        socket_handler = connection_handler(connection_socket, client_address)
+        connection = Connection(connection_socket, socket_writer, outbound_limits)
+        socket_handler = connection_handler(connection, connection_socket, client_address)
 
         # create a new thread for the client socket
         socket_thread = threading.Thread(name=str(client_address), target=socket_handler)
@@ -249,54 +853,157 @@ def recv_handler():
         socket_thread.start()
 
 
-# handles all out going data that can not be handled by recev_dandler
-def send_handler():
-    global t_lock
-    global clients
-    global serverSocket
+# time out users and end login blocks that are due
+def expire_users():
+    start = perf_counter() if metrics.enabled else None
+    for user in user_manager.expire_due(apply=cluster is None):
+        if cluster is not None:
+            # every worker times the user out, see on_offline
+            cluster.publish(offline_event(user, broadcast=False), user)
+        else:
+            end_session(user, logged_out=False)
+            if user in name_to_socket:
+                connection = name_to_socket[user]
+                connection.sendall(encode_message({
+                    'action': 'timeout'
+                }, connection.codec))
+                if start is not None:
+                    TIMEOUTS.inc()
+    if start is not None:
+        EXPIRY_SWEEP_SECONDS.observe(perf_counter() - start)
+
+
+# sleep until the next time out or unblock is due, then fire it
+def time_out_handler():
     while True:
-        # get lock
-        with t_lock:
-            # check if any pending messages can be send to any users who is online
-            for message in pending_messages:
-                if user_manager.is_online(message['to_user']):
-                    send_message(message['from_user'], message['to_user'], message['message'])
-                    pending_messages.remove(message)
-            # time out users
-            for user in user_manager.get_timed_out_users():
-                if user in name_to_socket:
-                    user_manager.set_offline(user)
-                    name_to_socket[user].send(json.dumps({
-                        'action': 'timeout'
-                    }).encode())
-            # notify other thread
-            t_lock.notify()
-        # sleep for UPDATE_INTERVAL
-        time.sleep(UPDATE_INTERVAL)
+        user_manager.wait_until_due()
+        expire_users()
+
+
+# the events every worker or node applies, the ones about a user in the same order everywhere,
+# see Cluster.py
+# handlers with a lock field run under user_lock of that user, like the requests
+events = Dispatcher(user_lock)
+
+
+# helper function to build the event setting a user offline on every worker
+# it only ends the session the user has when it is published, not a later one
+def offline_event(username: str, broadcast: bool) -> Dict:
+    return {
+        'action': 'offline',
+        'user': username,
+        'last_login': user_manager.get_last_login(username),
+        'broadcast': broadcast
+    }
+
+
+@events.register('login', lock='username')
+def on_login(event: Dict):
+    # a login attempt on the worker origin, return its status
+    username = event['username']
+    origin = event['origin']
+    # only the worker of the client times the session out, it is the one seeing the activity
+    status = user_manager.authenticate(username, event['password_correct'], event['time'], origin == worker_id)
+    if status == 'SUCCESS':
+        name_to_worker[username] = origin
+        user_manager.set_private_port(username, event['private_port'])
+        if origin != worker_id:
+            # hand the messages kept here while the user was offline over to its worker
+            while pending_messages.pending(username):
+                backlog = [[pending['from_user'], pending['message']]
+                           for pending in pending_messages.drain(username, BACKLOG_CHUNK)]
+                cluster.send(deliver_event(username, backlog), origin)
+    return status
+
+
+@events.register('offline', lock='user')
+def on_offline(event: Dict):
+    # a logout, or a time out when broadcast is False
+    username = event['user']
+    if name_to_worker.get(username) != event['origin'] or user_manager.get_last_login(username) != event['last_login']:
+        # the user logged in again meanwhile
+        return
+    user_manager.set_offline(username)
+    del name_to_worker[username]
+    if event['origin'] == worker_id:
+        connection = name_to_socket.pop(username, None)
+        end_session(username, logged_out=event['broadcast'])
+        if event['broadcast']:
+            # broadcast user logout
+            fan_out(user_manager.get_online_users() - {username}, user_message(username, '', 'logout_broadcast'))
+        elif connection is not None:
+            connection.sendall(encode_message({
+                'action': 'timeout'
+            }, connection.codec))
+
+
+@events.register('block')
+def on_block(event: Dict):
+    user_manager.block(event['user'], event['blocked'])
+
+
+@events.register('unblock')
+def on_unblock(event: Dict):
+    user_manager.unblock(event['user'], event['blocked'])
+
+
+@events.register('deliver', lock='to')
+def on_deliver(event: Dict):
+    # messages to a user who was connected to this worker when they were sent
+    for from_user, message in event['messages']:
+        deliver(from_user, event['to'], message)
+
+
+@events.register('fan_out')
+def on_fan_out(event: Dict):
+    # a broadcast to users who were connected to this worker when it was sent
+    fan_out(event['users'], event['message'])
 
 
 # we will use two sockets, one for sending and one for receiving
 serverSocket = socket(AF_INET, SOCK_STREAM)
+if args.worker is not None:
+    # every worker listens on the port, the kernel spreads the connections over them
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
 serverSocket.bind(('localhost', serverPort))
-serverSocket.listen(1)
 
-recv_thread = threading.Thread(name="RecvHandler", target=recv_handler)
-recv_thread.daemon = True
-recv_thread.start()
+if args.profile:
+    profiler.start()
 
-send_thread = threading.Thread(name="SendHandler", target=send_handler)
-send_thread.daemon = True
-send_thread.start()
+if args.metrics_port is not None:
+    # the profile so far is at /profile too
+    # every worker serves its own, on the port after the one of the worker before
+    metrics.serve(args.metrics_port + worker_id, {'/profile': profiler.folded})
 
 # register keyboard interrupt handler
 signal.signal(signal.SIGINT, keyboard_interrupt_handler)
 
+# register the profiler handlers
+signal.signal(signal.SIGUSR1, profile_dump_handler)
+signal.signal(signal.SIGUSR2, profile_toggle_handler)
+
 # register exist handler
 atexit.register(on_close)
 
-# this is the main thread
-while True:
-    time.sleep(0.1)
+if args.engine == "asyncio":
+    # the event loop runs in the main thread and fires the time outs too
+    print('Server is up.')
+    # the events of the other workers are applied in the loop too
+    AsyncEngine.serve_forever(serverSocket, handle_request, outbound_limits,
+                              user_manager.next_deadline, expire_users,
+                              None if cluster is None else functools.partial(cluster.start, events.dispatch))
+
+serverSocket.listen(1)
+
+# writes whatever the clients do not take right away
+socket_writer = SocketWriter()
+
+if cluster is not None:
+    cluster.start(events.dispatch)
+
+recv_thread = threading.Thread(name="RecvHandler", target=recv_handler)
+recv_thread.daemon = True
+recv_thread.start()
 
-    # update any information of all user data
-    user_manager.update()
+# this is the main thread, it fires time outs when they are due
+time_out_handler()